@@ -0,0 +1,402 @@
+import configparser
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from fake_es import FakeElasticsearch
+from features import pa
+from index import create_document_list, reindex
+from mapping import QueriedFields, lean_mapping
+from search import first_phase_query, search_batch
+from serve import SearchServer, SearchService
+from train import collect_train_data, save_model, train_model
+from utils import Logger, Profiler, QueryTemplate, elastic_connection, es_request, http_session, FEATURE_SET_FILE
+
+GENDERS = np.array(["MALE", "FEMALE"])
+
+
+def _words(rng, vocabulary, count):
+    # zipf distributed words, like the terms of a real corpus
+    return vocabulary[np.minimum(rng.zipf(1.3, count), len(vocabulary)) - 1]
+
+
+def generate(output_dir: str, pairs=10000, docs_per_query=50, corpus_docs=None, vocabulary_size=20000,
+             docs_per_file=1000, feature_set_file: str = FEATURE_SET_FILE, seed=42):
+    """
+    Generates a synthetic corpus, queries and judgements in the shape of the files in `data/`: ZIP archives of
+    candidate JSONs, `queries.csv`, `judgements.csv` and a copy of the feature set
+    :param output_dir:              the directory where the data is written
+    :param pairs:                   the number of judged (query, document) pairs
+    :param docs_per_query:          the number of judged documents of every query
+    :param corpus_docs:             the number of documents, 10 times the judged documents of a query (at most
+                                    100000) if not set
+    :param vocabulary_size:         the number of distinct words
+    :param docs_per_file:           the number of documents per ZIP archive
+    :param feature_set_file:        the feature set copied next to the data
+    :param seed:                    the random seed
+    :return:                        dict with the paths of the generated files
+    """
+    rng = np.random.RandomState(seed)
+    corpus_docs = corpus_docs or max(docs_per_query * 10, min(pairs, 100000))
+    queries = max(1, pairs // docs_per_query)
+    vocabulary = np.array(["term%d" % i for i in range(vocabulary_size)])
+    candidates_dir = os.path.join(output_dir, "candidates")
+    os.makedirs(candidates_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    for first in range(0, corpus_docs, docs_per_file):
+        last = min(corpus_docs, first + docs_per_file)
+        archive = os.path.join(candidates_dir, "candidates_%d-%d.zip" % (first + 1, last))
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as z:
+            for i in range(first, last):
+                doc_id = "candidate-%07d" % (i + 1)
+                mails = [{"subject": " ".join(_words(rng, vocabulary, rng.randint(3, 10))),
+                          "body": " ".join(_words(rng, vocabulary, rng.randint(20, 200))),
+                          "email": "user%d@example.org" % rng.randint(corpus_docs)}
+                         for _ in range(rng.randint(1, 4))]
+                z.writestr(doc_id + ".json", json.dumps({"id": doc_id, "name": "Candidate %d" % (i + 1),
+                                                         "gender": GENDERS[rng.randint(2)],
+                                                         "email": "candidate%d@example.org" % (i + 1),
+                                                         "mails": mails}))
+
+    keywords = [" ".join(_words(rng, vocabulary, rng.randint(1, 4))) for _ in range(queries)]
+    queries_file = os.path.join(output_dir, "queries.csv")
+    pd.DataFrame({"query_id": np.arange(1, queries + 1), "keywords": keywords}).to_csv(queries_file, index=False)
+
+    judgements_file = os.path.join(output_dir, "judgements.csv")
+    header = True
+    for first in range(0, queries, 10000):
+        chunk = min(queries, first + 10000) - first
+        documents = np.array([rng.choice(corpus_docs, min(docs_per_query, corpus_docs), replace=False)
+                              for _ in range(chunk)]).ravel()
+        pd.DataFrame({"query_id": np.repeat(np.arange(first + 1, first + chunk + 1), min(docs_per_query,
+                                                                                          corpus_docs)),
+                      "document_id": np.char.add("candidate-", np.char.zfill((documents + 1).astype(str), 7)),
+                      "judgement": rng.choice(4, len(documents), p=[0.5, 0.25, 0.15, 0.1])}) \
+            .to_csv(judgements_file, index=False, header=header, mode='w' if header else 'a')
+        header = False
+
+    shutil.copy(feature_set_file, os.path.join(output_dir, "features.json"))
+    Logger.logger.info("*** Generated %d documents, %d queries and %d judgements in %.1fs"
+                       % (corpus_docs, queries, queries * min(docs_per_query, corpus_docs),
+                          time.perf_counter() - start))
+    return {"documents": candidates_dir, "queries": queries_file, "judgements": judgements_file,
+            "feature_set": os.path.join(output_dir, "features.json")}
+
+
+def _rss():
+    """ returns the resident memory of the process in bytes """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # ru_maxrss is in kilobytes on Linux and only grows
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakMemory(object):
+    """ Samples the resident memory of the process in the background and keeps its peak """
+
+    def __init__(self, interval=0.02):
+        self._interval = interval
+        self._stop = threading.Event()
+        self.start = self.peak = 0
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            self.peak = max(self.peak, _rss())
+
+    def __enter__(self):
+        self.start = self.peak = _rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+
+
+def _stage(report, name, items, request_span, fn):
+    Profiler.reset()
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+    count = items(result) if callable(items) else items
+    row = {"stage": name, "items": count, "seconds": elapsed, "items_per_second": count / elapsed if elapsed else 0.0,
+           "requests": Profiler.timers.get(request_span, (0,))[0] if request_span else 0,
+           "peak_rss_mb": memory.peak / 1e6, "rss_growth_mb": (memory.peak - memory.start) / 1e6}
+    for q, value in Profiler.percentiles(request_span).items() if request_span else []:
+        row["p%d_ms" % q] = value * 1000
+    report.append(row)
+    return result
+
+
+def run(data: dict, work_dir: str, latency=0.0, index_threads=2, log_batch_size=50, log_concurrency=4,
+        iterations=100, search_queries=1000, search_chunk_size=50, search_concurrency=4, report_file=None):
+    """
+    Runs the pipeline stages against a `FakeElasticsearch` and reports their throughput, request latency
+    percentiles and peak memory. The memory includes the fake, which runs in the same process.
+    :param data:                    the generated files (see `generate`)
+    :param work_dir:                the directory where the features and the model are written
+    :param latency:                 the latency of every request to the fake in seconds
+    :param index_threads:           the bulk indexing threads
+    :param log_batch_size:          the queries per `_msearch` feature logging request
+    :param log_concurrency:         the feature logging requests in flight
+    :param iterations:              the training iterations
+    :param search_queries:          the number of queries of the search stage
+    :param search_chunk_size:       the queries per `_msearch` search request
+    :param search_concurrency:      the search requests in flight
+    :param report_file:             CSV or JSON file where the report is written (optional)
+    :return:                        the report data frame
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    features_file = os.path.join(work_dir, "features.arrow" if pa is not None else "features.csv")
+    model_file = os.path.join(work_dir, "model.json")
+    index_name, feature_set, model = "benchmark", "benchmark_features", "benchmark_model"
+    queries = pd.read_csv(data["queries"])
+    pairs = sum(1 for _ in open(data["judgements"])) - 1
+
+    report = []
+    level = Logger.logger.level
+    with FakeElasticsearch(latency=latency) as fake:
+        es = elastic_connection(url=fake.url, http_auth=None,
+                                maxsize=max(index_threads, log_concurrency, search_concurrency))
+        Logger.logger.setLevel("WARNING")
+        try:
+            _stage(report, "index", lambda stats: stats.docs, "bulk_chunk",
+                   lambda: reindex(es, document_list=create_document_list(data["documents"]), index=index_name,
+                                   threads=index_threads))
+
+            def prepare():
+                es_request('PUT', '_ltr', url=fake.url)
+                with open(data["feature_set"]) as f:
+                    es_request('POST', '_ltr/_featureset/%s' % feature_set, json.load(f), url=fake.url)
+            _stage(report, "prepare", 1, None, prepare)
+
+            _stage(report, "collect_train_data", pairs, "log_features_batch",
+                   lambda: collect_train_data(es, data["queries"], data["judgements"], feature_set, index_name,
+                                              features_file, log_batch_size, log_concurrency))
+            _stage(report, "train_model", pairs, "train",
+                   lambda: train_model(features_file, model_file, number_of_iterations=iterations))
+            _stage(report, "save_model", 1, "save_model",
+                   lambda: save_model(model, feature_set, model_file, url=fake.url))
+
+            keywords = list(zip(queries["query_id"].tolist(), queries["keywords"].tolist()))
+            keywords = (keywords * (search_queries // max(1, len(keywords)) + 1))[:search_queries]
+            _stage(report, "search", len(keywords), "search_msearch",
+                   lambda: sum(1 for _ in search_batch(es, keywords, index_name, model, search_chunk_size,
+                                                       search_concurrency)))
+        finally:
+            Logger.logger.setLevel(level)
+
+    report = pd.DataFrame(report)
+    Logger.logger.info(report.to_string(index=False, float_format=lambda v: "%.2f" % v))
+    if report_file:
+        if report_file.endswith(".json"):
+            report.to_json(report_file, orient="records", indent=2)
+        else:
+            report.to_csv(report_file, index=False)
+    return report
+
+
+def compare_mappings(data: dict, work_dir: str, latency=0.0, index_threads=2, log_batch_size=50, log_concurrency=4,
+                     search_fields=None, report_file=None):
+    """
+    Indexes the corpus with the dynamic mapping and with the lean mapping derived from the feature set (see
+    `mapping.lean_mapping`) and reports the index size, the indexing throughput and the feature logging latency of
+    both. The size is the `store` size reported by `_stats`, which the fake only estimates. The features logged from
+    both indices and the top hits of the first-phase query are compared, the lean mapping must not change them.
+    :param data:                    the generated files (see `generate`)
+    :param work_dir:                the directory where the features are written
+    :param search_fields:           the fields searched by the first-phase query, the text fields of the features if
+                                    not set
+    :param report_file:             CSV or JSON file where the report is written (optional)
+    :return:                        the report data frame
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    feature_set = "benchmark_features"
+    pairs = sum(1 for _ in open(data["judgements"])) - 1
+    if not search_fields:
+        queried = QueriedFields()
+        with open(data["feature_set"]) as f:
+            queried.add_feature_set(json.load(f))
+        search_fields = sorted(queried.text)
+    mappings = (("dynamic", None), ("lean", lean_mapping(data["feature_set"], search_fields)))
+    first_phase = QueryTemplate({"query": first_phase_query("multi_match", search_fields), "_source": False})
+    keywords = pd.read_csv(data["queries"])["keywords"].tolist()
+
+    report, features_files, hits = [], [], []
+    level = Logger.logger.level
+    for name, mapping in mappings:
+        with FakeElasticsearch(latency=latency) as fake:
+            es = elastic_connection(url=fake.url, http_auth=None, maxsize=max(index_threads, log_concurrency))
+            Logger.logger.setLevel("WARNING")
+            try:
+                Profiler.reset()
+                start = time.perf_counter()
+                stats = reindex(es, mapping_settings=mapping, document_list=create_document_list(data["documents"]),
+                                index=name, threads=index_threads)
+                indexing = time.perf_counter() - start
+                es_request('PUT', '_ltr', url=fake.url)
+                with open(data["feature_set"]) as f:
+                    es_request('POST', '_ltr/_featureset/%s' % feature_set, json.load(f), url=fake.url)
+
+                features_files.append(os.path.join(work_dir, "features_%s.csv" % name))
+                Profiler.reset()
+                start = time.perf_counter()
+                collect_train_data(es, data["queries"], data["judgements"], feature_set, name, features_files[-1],
+                                   log_batch_size, log_concurrency)
+                logging = time.perf_counter() - start
+                latencies = Profiler.percentiles("log_features_batch")
+                size = es.indices.stats(index=name)["_all"]["primaries"]["store"]["size_in_bytes"]
+                hits.append([[hit["_id"] for hit in es.search(index=name, body=first_phase.render(keywords=kw))
+                              ["hits"]["hits"]] for kw in keywords])
+            finally:
+                Logger.logger.setLevel(level)
+        report.append({"mapping": name, "index_mb": size / 1e6, "docs": stats.docs,
+                       "index_docs_per_second": stats.docs / indexing if indexing else 0.0,
+                       "log_pairs_per_second": pairs / logging if logging else 0.0,
+                       "log_p50_ms": latencies[50] * 1000, "log_p95_ms": latencies[95] * 1000})
+
+    report = pd.DataFrame(report)
+    Logger.logger.info(report.to_string(index=False, float_format=lambda v: "%.2f" % v))
+    with open(features_files[0]) as dynamic, open(features_files[1]) as lean:
+        if dynamic.read() != lean.read():
+            Logger.logger.warning("*** The features logged with the lean mapping differ from the dynamic mapping")
+    changed = sum(dynamic != lean for dynamic, lean in zip(*hits))
+    if changed:
+        Logger.logger.warning("*** The first phase returns other hits with the lean mapping for %d of %d queries"
+                              % (changed, len(keywords)))
+    if report_file:
+        if report_file.endswith(".json"):
+            report.to_json(report_file, orient="records", indent=2)
+        else:
+            report.to_csv(report_file, index=False)
+    return report
+
+
+def startup(data: dict, work_dir: str, runs=20, latency=0.0, report_file=None):
+    """
+    Compares the latency of a search run as a new `deltr.py --search` process (cold: interpreter start, imports,
+    configuration and a new connection) with the latency of the same search sent to a warm `serve.SearchServer`
+    :param data:                    the generated files (see `generate`)
+    :param work_dir:                the directory where the configuration of the cold runs is written
+    :param runs:                    the number of searches of each kind
+    :param latency:                 the latency of every request to the fake in seconds
+    :param report_file:             CSV or JSON file where the report is written (optional)
+    :return:                        the report data frame
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    index_name, feature_set, model = "benchmark", "benchmark_features", "benchmark_model"
+    keywords = pd.read_csv(data["queries"])["keywords"].tolist()
+    keywords = (keywords * (runs // max(1, len(keywords)) + 1))[:runs]
+    deltr = os.path.join(os.path.dirname(os.path.abspath(__file__)), "deltr.py")
+
+    report = []
+    level = Logger.logger.level
+    with FakeElasticsearch(latency=latency) as fake:
+        Logger.logger.setLevel("WARNING")
+        try:
+            es = elastic_connection(url=fake.url, http_auth=None)
+            reindex(es, document_list=create_document_list(data["documents"]), index=index_name)
+            es_request('PUT', '_ltr', url=fake.url)
+            with open(data["feature_set"]) as f:
+                features = json.load(f)
+            es_request('POST', '_ltr/_featureset/%s' % feature_set, features, url=fake.url)
+            model_file = os.path.join(work_dir, "startup_model.json")
+            with open(model_file, 'w') as f:
+                json.dump({feature["name"]: 1.0 for feature in features["featureset"]["features"]}, f)
+            save_model(model, feature_set, model_file, url=fake.url)
+
+            # the cold runs read the configuration of their working directory
+            config = configparser.ConfigParser()
+            config.read('setup.cfg')
+            config['default'].update({"ESHost": fake.url, "IndexName": index_name, "ModelName": model,
+                                      "RegistryFile": os.path.join(work_dir, "startup_registry.json")})
+            with open(os.path.join(work_dir, "setup.cfg"), 'w') as f:
+                config.write(f)
+            cold = []
+            for kw in keywords:
+                start = time.perf_counter()
+                subprocess.run([sys.executable, deltr, "--search", "--query", kw], cwd=work_dir, check=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                cold.append(time.perf_counter() - start)
+
+            service = SearchService(index_name, model, model_file, os.path.join(work_dir, "startup_registry.json"),
+                                    fake.url)
+            with SearchServer(service, port=0) as server:
+                service.warm_up()
+                session = http_session()
+                warm = []
+                for kw in keywords:
+                    start = time.perf_counter()
+                    response = session.post(server.url + "/search", data=json.dumps({"query": kw}))
+                    response.raise_for_status()
+                    warm.append(time.perf_counter() - start)
+        finally:
+            Logger.logger.setLevel(level)
+
+    for name, samples in (("cold_cli", cold), ("warm_serve", warm)):
+        samples = np.array(samples) * 1000
+        report.append({"mode": name, "runs": len(samples), "p50_ms": np.percentile(samples, 50),
+                       "p95_ms": np.percentile(samples, 95), "mean_ms": samples.mean()})
+    report = pd.DataFrame(report)
+    Logger.logger.info(report.to_string(index=False, float_format=lambda v: "%.2f" % v))
+    if report_file:
+        if report_file.endswith(".json"):
+            report.to_json(report_file, orient="records", indent=2)
+        else:
+            report.to_csv(report_file, index=False)
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline against a local Elasticsearch stand-in')
+    parser.add_argument('--data-dir', default="benchmark_data",
+                        help='The directory with the synthetic data, generated if it does not exist.')
+    parser.add_argument('--pairs', type=int, default=10000, help='Number of judged (query, document) pairs.')
+    parser.add_argument('--docs-per-query', type=int, default=50, help='Number of judged documents per query.')
+    parser.add_argument('--corpus-docs', type=int, default=None, help='Number of documents in the corpus.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Latency of every request in seconds.')
+    parser.add_argument('--iterations', type=int, default=100, help='Number of training iterations.')
+    parser.add_argument('--search-queries', type=int, default=1000, help='Number of queries of the search stage.')
+    parser.add_argument('--concurrency', type=int, default=4, help='Requests in flight while logging and searching.')
+    parser.add_argument('--report', default=None, help='CSV or JSON file where the report is written.')
+    parser.add_argument('--compare-mapping', action='store_true',
+                        help='Compare the dynamic mapping with the lean mapping derived from the feature set, instead '
+                             'of benchmarking the pipeline.')
+    parser.add_argument('--startup-runs', type=int, default=0,
+                        help='Compare this many cold `deltr.py --search` runs with searches sent to a warm server, '
+                             'instead of benchmarking the pipeline.')
+    args = parser.parse_args()
+
+    data_files = {"documents": os.path.join(args.data_dir, "candidates"),
+                  "queries": os.path.join(args.data_dir, "queries.csv"),
+                  "judgements": os.path.join(args.data_dir, "judgements.csv"),
+                  "feature_set": os.path.join(args.data_dir, "features.json")}
+    if not os.path.exists(data_files["judgements"]):
+        data_files = generate(args.data_dir, args.pairs, args.docs_per_query, args.corpus_docs)
+    if args.compare_mapping:
+        compare_mappings(data_files, os.path.join(args.data_dir, "work"), args.latency,
+                         log_concurrency=args.concurrency, report_file=args.report)
+    elif args.startup_runs:
+        startup(data_files, os.path.abspath(os.path.join(args.data_dir, "work")), args.startup_runs, args.latency,
+                args.report)
+    else:
+        run(data_files, os.path.join(args.data_dir, "work"), args.latency, log_concurrency=args.concurrency,
+            iterations=args.iterations, search_queries=args.search_queries, search_concurrency=args.concurrency,
+            report_file=args.report)
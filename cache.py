@@ -0,0 +1,105 @@
+import hashlib
+import json
+import sqlite3
+
+from utils import Logger
+
+
+def feature_set_digest(es, feature_set_name: str):
+    """
+    Hashes the definition of a feature set stored in the LTR plugin
+    :param es:                      Elasticsearch client
+    :param feature_set_name:        the name of the feature set
+    :return:                        hex digest of the feature set definition
+    """
+    resp = es.transport.perform_request('GET', '/_ltr/_featureset/%s' % feature_set_name)
+    if not resp.get('found', False):
+        raise ValueError("Feature set `%s` was not found in the LTR store" % feature_set_name)
+    definition = json.dumps(resp['_source'], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(definition.encode('utf-8')).hexdigest()
+
+
+class FeatureCache(object):
+    """
+    Persistent cache of logged feature vectors, stored in a SQLite file. An entry is keyed by the index name,
+    the feature set name and the hash of its definition, the query keywords and the document id, so changing
+    the feature set invalidates its entries while changes to the queries or judgements only require logging
+    the new (keywords, document) pairs. Documents that Elasticsearch did not return are cached as missing.
+    """
+
+    def __init__(self, cache_file: str, index_name: str, feature_set_name: str, feature_set_hash: str,
+                 commit_every=100):
+        """
+        :param cache_file:              the SQLite file path
+        :param index_name:              the index the features are logged from
+        :param feature_set_name:        the name of the logged feature set
+        :param feature_set_hash:        the hash of the feature set definition (see `feature_set_digest`)
+        :param commit_every:            number of `put` calls between two commits
+        """
+        self._key = (index_name, feature_set_name, feature_set_hash)
+        self._commit_every = commit_every
+        self._uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._db = sqlite3.connect(cache_file)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS features ("
+                         "index_name TEXT, feature_set TEXT, feature_set_hash TEXT, keywords TEXT, doc_id TEXT, "
+                         "names TEXT, vals TEXT, "
+                         "PRIMARY KEY (index_name, feature_set, feature_set_hash, keywords, doc_id))")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self, keywords: str, ids: list):
+        """
+        Reads the cached features of the judged documents of a query
+        :param keywords:                the query keywords
+        :param ids:                     the judged document ids
+        :return:                        dict with doc id -> (feature names, feature values), or None for a document
+                                        that is known to be missing from the index
+        """
+        rows = self._db.execute("SELECT doc_id, names, vals FROM features WHERE index_name=? AND feature_set=? "
+                                "AND feature_set_hash=? AND keywords=?", self._key + (keywords,))
+        cached = {doc_id: (json.loads(names), json.loads(vals)) if names is not None else None
+                  for doc_id, names, vals in rows}
+        found = {doc_id: cached[doc_id] for doc_id in ids if doc_id in cached}
+        self.hits += len(found)
+        self.misses += len(ids) - len(found)
+        return found
+
+    def put(self, keywords: str, ids: list, logged: dict):
+        """
+        Stores the features logged for a query
+        :param keywords:                the query keywords
+        :param ids:                     the document ids that were requested from Elasticsearch
+        :param logged:                  dict with doc id -> (feature names, feature values) for the returned documents
+        """
+        rows = []
+        for doc_id in ids:
+            names, values = logged.get(doc_id, (None, None))
+            rows.append(self._key + (keywords, doc_id,
+                                     json.dumps(names) if names is not None else None,
+                                     json.dumps(values) if values is not None else None))
+        self._db.executemany("INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+        self._uncommitted += 1
+        if self._uncommitted >= self._commit_every:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def report(self):
+        total = self.hits + self.misses
+        Logger.logger.info("*** Feature cache: %d hits, %d misses (%.1f%% hit rate)"
+                           % (self.hits, self.misses, 100.0 * self.hits / total if total else 0.0))
+
+    def close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
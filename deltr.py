@@ -1,70 +1,280 @@
 import argparse
+import os
 import sys
+import time
 
-from index import create_document_list, reindex
-from prepare import load_features, init_default_store
-from search import ltr_query
-from train import save_model, train_model, collect_train_data
-from utils import Logger, elastic_connection, FEATURE_SET_FILE, JUDGMENTS_FILE, QUERIES_FILE, \
-    FEATURE_SET_NAME, MODEL_FILE, INDEX_NAME, DOCUMENT_DIR, MODEL_NAME, FEATURES_FILE, TRAIN_LOG_FILE
+# the stage modules are imported by the commands that use them, so e.g. a search does not load pandas and the
+# training stack
+from registry import Registry
+from utils import Logger, Profiler, elastic_connection, FEATURE_SET_FILE, JUDGMENTS_FILE, QUERIES_FILE, \
+    FEATURE_SET_NAME, MODEL_FILE, INDEX_NAME, DOCUMENT_DIR, MODEL_NAME, FEATURES_FILE, TRAIN_LOG_FILE, REGISTRY_FILE
 
 
-def index(index_name, document_dir):
+def index(index_name, document_dir, chunk_docs=500, chunk_bytes=10 * 1024 * 1024, threads=1, max_retries=3,
+          alias_swap=False, shards=1, replicas=0, force_merge=False, keep_generations=2, delta=False,
+          manifest_file=None, lean=False, feature_set_file=FEATURE_SET_FILE, search_fields=None,
+          first_phase="multi_match"):
     """
     Index the data
     :param index_name:          Name of the created index
     :param document_dir:        Path to the directory containing the JSONs to be uploaded. Each JSON :must: have an "id".
+                                JSON files, NDJSON files, their gzip'd versions and ZIP archives are read.
+    :param chunk_docs:          Maximum number of documents in a bulk request
+    :param chunk_bytes:         Maximum size of a bulk request in bytes
+    :param threads:             Number of bulk requests sent in parallel
+    :param max_retries:         Number of retries of requests and documents rejected with 429 (Too Many Requests)
+    :param alias_swap:          Whether to build a new timestamped index and move the `index_name` alias to it
+                                instead of deleting and recreating the index
+    :param shards:              Number of primary shards of the index
+    :param replicas:            Number of replicas of the index
+    :param force_merge:         Whether to force merge the new index before moving the alias
+    :param keep_generations:    Number of timestamped indices kept for the alias
+    :param delta:               Whether to index only the documents that changed since the last run
+    :param manifest_file:       The manifest of the indexed documents used with `delta`
+    :param lean:                Whether to index only the fields read by the features and the first-phase query
+                                (see `mapping.lean_mapping`) instead of mapping every field dynamically
+    :param feature_set_file:    The feature set the lean mapping is derived from
+    :param search_fields:       The fields searched by the first-phase query
+    :param first_phase:         The first-phase query
     :return:
     """
-    es = elastic_connection(timeout=30)
-    reindex(es, document_list=create_document_list(document_dir), index=index_name)
+    from index import IndexingStats, create_document_list, reindex, reindex_delta, reindex_with_alias
+    from mapping import lean_mapping
 
+    mapping_settings = lean_mapping(feature_set_file, search_fields, first_phase) if lean else None
 
-def prepare(feature_set_file, feature_set_name):
+    es = elastic_connection(timeout=30, max_retries=max_retries, retry_on_timeout=True)
+    stats = IndexingStats()
+    bulk_options = dict(chunk_docs=chunk_docs, chunk_bytes=chunk_bytes, threads=threads, max_retries=max_retries,
+                        stats=stats)
+    if delta:
+        reindex_delta(es, document_dir, index_name, manifest_file, mapping_settings=mapping_settings, shards=shards,
+                      replicas=replicas, **bulk_options)
+    elif alias_swap:
+        reindex_with_alias(es, mapping_settings=mapping_settings,
+                           document_list=create_document_list(document_dir, stats), alias=index_name, shards=shards,
+                           replicas=replicas, force_merge=force_merge, keep_generations=keep_generations,
+                           **bulk_options)
+    else:
+        reindex(es, mapping_settings=mapping_settings, document_list=create_document_list(document_dir, stats),
+                index=index_name, shards=shards, replicas=replicas, **bulk_options)
+
+
+def prepare(feature_set_file, feature_set_name, registry):
     """
-    Upload the feature set
+    Upload the feature set under a versioned name, unless it is already deployed
     :param feature_set_file:        The file path to the feature set JSON definition
     :param feature_set_name:        The name of the feature set
+    :param registry:                The registry of the deployed feature sets and models
     :return:
     """
+    from prepare import init_default_store
+
     init_default_store()
-    load_features(feature_set_file, feature_set_name)
+    registry.deploy_feature_set(feature_set_file, feature_set_name)
 
 
-def train(feature_set_name: str, model_name: str, queries_file: str, judgments_file: str, index_name:str,
-          features_file: str, model_output: str,
+def train(registry: Registry, feature_set_name: str, model_name: str, queries_file: str, judgments_file: str,
+          index_name: str, features_file: str, model_output: str,
           protected_feature_name="1", gamma=1, number_of_iterations=3000, learning_rate=0.001,
-          lambdaa=0.001, init_var=0.01, standardize=False, log=None):
+          lambdaa=0.001, init_var=0.01, standardize=False, log=None, log_batch_size=None, log_concurrency=1,
+          features_value_type="float64", features_compression=None, features_cache=None, engine="numpy",
+          processes=None, batch_queries=None, optimizer="gd", tolerance=None, patience=10, time_budget=None,
+          log_max_ids=None):
     """
     Train and upload model with specified parameters
     """
-    es = elastic_connection(timeout=1000)
-    collect_train_data(es, queries_file, judgments_file, feature_set_name, index_name, features_file)
+    from train import train_model, collect_train_data, MAX_LOG_IDS
+
+    feature_set_name = registry.resolve("feature_sets", feature_set_name)
+    es = elastic_connection()
+    collect_train_data(es, queries_file, judgments_file, feature_set_name, index_name, features_file,
+                       log_batch_size, log_concurrency, features_value_type, features_compression, features_cache,
+                       log_max_ids or MAX_LOG_IDS)
     train_model(features_file, model_output, protected_feature_name, gamma,
-                number_of_iterations, learning_rate, lambdaa, init_var, standardize, log)
+                number_of_iterations, learning_rate, lambdaa, init_var, standardize, log, engine, processes,
+                batch_queries, optimizer, tolerance, patience, time_budget)
+
+    registry.deploy_model(model_output, model_name, feature_set_name)
+
+
+def train_pipelined(registry: Registry, feature_set_name: str, model_name: str, queries_file: str,
+                    judgments_file: str, index_name: str, features_file: str, model_output: str, stages_file=None,
+                    queue_size=64, force=False, protected_feature_name="1", log=None, log_batch_size=None,
+                    log_concurrency=1, features_value_type="float64", features_compression=None, features_cache=None,
+                    log_max_ids=None, **train_parameters):
+    """
+    Logs the features straight into the training arrays, trains and uploads the model in one pass, skipping the
+    stages whose inputs did not change since the last run
+    """
+    from pipeline import train_pipeline
+    from train import MAX_LOG_IDS
+
+    es = elastic_connection(maxsize=max(10, log_concurrency))
+    train_pipeline(es, registry, registry.resolve("feature_sets", feature_set_name), model_name, queries_file,
+                   judgments_file, index_name, features_file, model_output, stages_file, queue_size, log_batch_size,
+                   log_concurrency, features_value_type, features_compression, features_cache,
+                   log_max_ids or MAX_LOG_IDS, force, protected_feature_name, log, **train_parameters)
+
 
-    save_model(model_name, feature_set_name, model_output)
+def sweep(registry: Registry, feature_set_name: str, model_name: str, features_file: str, model_output: str,
+          leaderboard_file: str,
+          gammas: list, learning_rates: list, lambdas: list, init_vars: list, samples=None, holdout=0.2, k=10,
+          rank_by="ndcg", sweep_processes=None, protected_feature_name="1", **train_parameters):
+    """
+    Trains a grid of models on an already logged features file and uploads the best one
+    """
+    from sweep import configurations, sweep as run_sweep
 
+    configs = configurations(gammas, learning_rates, lambdas, init_vars, samples)
+    run_sweep(features_file, configs, leaderboard_file, model_output, protected_feature_name, holdout, k, rank_by,
+              sweep_processes, **train_parameters)
+    registry.deploy_model(model_output, model_name, registry.resolve("feature_sets", feature_set_name))
 
-def search(index_name, query, model, verbose):
+
+def deploy(registry: Registry, feature_set_name: str, model_name: str, model_file: str):
+    """
+    Uploads an already trained model under a versioned name, unless it is already deployed, and activates it
+    """
+    registry.deploy_model(model_file, model_name, registry.resolve("feature_sets", feature_set_name))
+
+
+@Profiler.timed("search")
+def search(index_name, query, model, verbose, **options):
     """
     Peforms a search request on Elasticseach using LTR and a specified (DELTR) model
     :param index_name:      The index to search on
     :param query:           The query to search by
     :param model:           The model to search with
     :param verbose:         Whether or not the output should contain the weights
+    :param options:         The search options of `search.search_template`
     :return:
     """
-    es = elastic_connection(timeout=1000)
-    results = es.search(index=index_name, body=ltr_query(query, model))
+    from search import ltr_query
+
+    es = elastic_connection()
+    results = es.search(index=index_name, body=ltr_query(query, model, log_features=verbose, **options))
     for result in results['hits']['hits']:
-        message = result['_source']['id']
+        message = result.get('_source', {}).get('id', result['_id'])
         if verbose:
             features = result['fields']['_ltrlog'][0]['log_entry']
             message += ' ' + ' '.join(['{0}:{1}'.format(ll['name'], ll['value']) for ll in features])
         Logger.logger.info(message)
 
 
+def batch_search(index_name, model, input_file, output_file, chunk_size=100, concurrency=1, use_async=False,
+                 verbose=False, **options):
+    """
+    Runs many queries with a (DELTR) model and writes the results as NDJSON, e.g. to replay a query log
+    :param index_name:      The index to search on
+    :param model:           The model to search with
+    :param input_file:      File with one query per line (see `search.read_queries`), `-` reads stdin
+    :param output_file:     File where the results are written, `-` writes to stdout
+    :param chunk_size:      Number of queries per `_msearch` request
+    :param concurrency:     Number of requests in flight
+    :param use_async:       Whether to send single searches over the async client instead of `_msearch` chunks
+    :param verbose:         Whether or not the output should contain the logged features
+    :param options:         The search options of `search.search_template`
+    :return:
+    """
+    from search import read_queries, run_async_batch, search_batch, write_results
+
+    source = sys.stdin if input_file == '-' else open(input_file)
+    output = sys.stdout if output_file == '-' else open(output_file, 'w')
+    start = time.perf_counter()
+    try:
+        queries = read_queries(source)
+        if use_async:
+            count, failures = run_async_batch(queries, output, index_name, model, concurrency, verbose, **options)
+        else:
+            es = elastic_connection(maxsize=concurrency)
+            count, failures = write_results(search_batch(es, queries, index_name, model, chunk_size, concurrency,
+                                                         verbose, **options), output)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+    Logger.logger.info("*** Searched %d queries (%d failed) in %.1fs, %.1f queries/s"
+                       % (count, failures, elapsed, count / elapsed if elapsed else 0.0))
+
+
+def serve(index_name, model, model_file, registry_file, host="127.0.0.1", port=8765, **options):
+    """
+    Runs a search server that keeps the Elasticsearch client, the templates and the models warm between requests
+    :param index_name:      The default index to search on
+    :param model:           The default model to search with, resolved in the registry at every request
+    :param model_file:      The default model file of the local scoring
+    :param registry_file:   The local manifest of the deployed models
+    :param host:            The address the server listens on
+    :param port:            The port the server listens on
+    :param options:         The default search options of `search.search_template`
+    """
+    from serve import SearchServer, SearchService
+
+    service = SearchService(index_name, model, model_file, registry_file, **options)
+    service.warm_up()
+    SearchServer(service, host, port).serve_forever()
+
+
+def rerank(features_file, model_file, output_file, k=10):
+    """
+    Reranks logged features with a trained model file locally, without Elasticsearch
+    :param features_file:       The features file with the candidates of every query
+    :param model_file:          The model JSON written by the training (and its standardization sidecar)
+    :param output_file:         The CSV file where the top-k documents of every query are written
+    :param k:                   Number of top documents per query
+    """
+    from rerank import rerank_file
+
+    rerank_file(features_file, model_file, output_file, k)
+
+
+def evaluate(features_file, model_files, summary_file, per_query_file, protected_feature_name="1", k=10,
+             bootstrap=0, processes=None):
+    """
+    Computes NDCG@k, MAP@k and the exposure ratio@k of one or more models on the logged features
+    :param features_file:           The features file with the judged documents of every query
+    :param model_files:             The model JSON files to compare
+    :param summary_file:            The CSV file where the mean metrics of every model are written
+    :param per_query_file:          The CSV file where the metrics of every query are written
+    :param protected_feature_name:  The name of the column in the data that contains protected attribute
+    :param k:                       Cut-off of the metrics
+    :param bootstrap:               Number of bootstrap samples of the confidence intervals, none if 0
+    :param processes:               Number of processes computing the bootstrap samples
+    """
+    from evaluate import evaluate as run_evaluate
+
+    run_evaluate(features_file, model_files, summary_file, per_query_file, protected_feature_name, k, bootstrap,
+                 processes=processes)
+
+
+def window_sweep(index_name, model, queries_file, judgments_file, window_sizes, k, output_file, **options):
+    """
+    Reports the search latency against the NDCG of the judged queries for growing rescore windows
+    """
+    from search import window_sweep as run_window_sweep
+
+    es = elastic_connection()
+    run_window_sweep(es, window_sizes, index_name, model, queries_file, judgments_file, k, output_file, **options)
+
+
+def feature_cost(feature_set_file, feature_set_name, model_file, features_file, queries_file, index_name,
+                 sample_queries, repeats, protected_feature_name, k, max_loss, report_file, pruned_feature_set_file,
+                 **options):
+    """
+    Times the features of the feature set, joins their cost with the model weights and suggests a pruned feature set
+    within an NDCG@k loss of `max_loss`
+    """
+    from feature_cost import feature_cost as run_feature_cost
+
+    es = elastic_connection()
+    run_feature_cost(es, feature_set_file, feature_set_name, model_file, features_file, queries_file, index_name,
+                     sample_queries, repeats, protected_feature_name, k, max_loss, report_file,
+                     pruned_feature_set_file, **options)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Read command line arguments for DELTR LTR integration.')
 
@@ -77,6 +287,36 @@ if __name__ == "__main__":
                         help='Command to train the model')
     parser.add_argument('--search', action='store_true',
                         help='Command to make a search query.')
+    parser.add_argument('--batch-search', action='store_true',
+                        help='Run many queries with the model and write the results as NDJSON.')
+    parser.add_argument('--deploy', action='store_true',
+                        help='Upload the model file under a versioned name, unless it is already deployed.')
+    parser.add_argument('--activate-model', required=False, default=None,
+                        help='Switch the model name to one of its deployed versions (the versioned name or hash).')
+    parser.add_argument('--activate-feature-set', required=False, default=None,
+                        help='Switch the feature set name to one of its deployed versions (the versioned name or '
+                             'hash).')
+    parser.add_argument('--registry', action='store_true',
+                        help='List the deployed versions of the feature sets and models.')
+    parser.add_argument('--registry-file', required=False, default=REGISTRY_FILE,
+                        help='The local manifest of the deployed feature sets and models.')
+    parser.add_argument('--publish-plain-name', action='store_true',
+                        help='Also keep a copy of the active version under the plain feature set and model name, '
+                             'for clients that do not resolve the versions through the registry.')
+    parser.add_argument('--evaluate', action='store_true',
+                        help='Compute NDCG, MAP and the exposure ratio of the models on the logged features.')
+    parser.add_argument('--rerank', action='store_true',
+                        help='Rerank the logged features with the model file locally, without Elasticsearch.')
+    parser.add_argument('--window-sweep', action='store_true',
+                        help='Report the search latency against the NDCG of the judged queries for growing rescore '
+                             'windows.')
+    parser.add_argument('--sweep', action='store_true',
+                        help='Command to train a grid of models on the logged features and upload the best one.')
+    parser.add_argument('--serve', action='store_true',
+                        help='Run a local HTTP server answering search and score requests with a warm client.')
+    parser.add_argument('--feature-cost', action='store_true',
+                        help='Time every feature of the feature set, join the costs with the model weights and '
+                             'suggest a pruned feature set.')
 
 
     # add prepare arguments
@@ -89,7 +329,33 @@ if __name__ == "__main__":
     parser.add_argument('--index-name', required=False, default=INDEX_NAME,
                         help='The name of the index to create, train a model or run a query on.')
     parser.add_argument('--document-dir', required=False, default=DOCUMENT_DIR,
-                        help='The directory with documents to index.')
+                        help='The directory with documents to index (JSON, NDJSON, gzip and ZIP files).')
+    parser.add_argument('--chunk-docs', required=False, type=int, default=500,
+                        help='Maximum number of documents in a bulk request.')
+    parser.add_argument('--chunk-bytes', required=False, type=int, default=10 * 1024 * 1024,
+                        help='Maximum size of a bulk request in bytes.')
+    parser.add_argument('--index-threads', required=False, type=int, default=1,
+                        help='Number of bulk requests sent in parallel.')
+    parser.add_argument('--max-retries', required=False, type=int, default=3,
+                        help='Number of retries of bulk requests and documents rejected with 429.')
+    parser.add_argument('--lean-mapping', required=False, action='store_true',
+                        help='Index only the fields read by the feature set and the first-phase query, with an '
+                             'explicit mapping derived from them, instead of mapping every field dynamically.')
+    parser.add_argument('--alias-swap', required=False, action='store_true',
+                        help='Build a new timestamped index and atomically move the index name alias to it.')
+    parser.add_argument('--shards', required=False, type=int, default=1,
+                        help='Number of primary shards of the index.')
+    parser.add_argument('--replicas', required=False, type=int, default=0,
+                        help='Number of replicas of the index.')
+    parser.add_argument('--force-merge', required=False, action='store_true',
+                        help='Force merge the new index to one segment before moving the alias.')
+    parser.add_argument('--delta', required=False, action='store_true',
+                        help='Index only new or changed documents and delete removed ones.')
+    parser.add_argument('--manifest', required=False, default=None,
+                        help='The manifest of the indexed documents used with --delta '
+                             '(default: <index name>.manifest.json).')
+    parser.add_argument('--keep-generations', required=False, type=int, default=2,
+                        help='Number of timestamped indices kept when using --alias-swap.')
 
     # add train arguments
     parser.add_argument('--model', required=False, default=MODEL_NAME,
@@ -97,7 +363,15 @@ if __name__ == "__main__":
     parser.add_argument('--model-file', required=False, default=MODEL_FILE,
                         help='The file path where the model will be stored.')
     parser.add_argument('--features-log-file', required=False, default=FEATURES_FILE,
-                        help='The file path where the features will be logged.')
+                        help='The file path where the features will be logged '
+                             '(files ending with .arrow or .feather are stored in the Arrow format).')
+    parser.add_argument('--features-value-type', required=False, default="float64", choices=["float32", "float64"],
+                        help='The type of the feature values in an Arrow features log file.')
+    parser.add_argument('--features-compression', required=False, default=None, choices=["lz4", "zstd"],
+                        help='The compression of an Arrow features log file.')
+    parser.add_argument('--features-cache', required=False, default=None,
+                        help='The file path of a cache with the logged features. Only features missing from the '
+                             'cache are logged from Elasticsearch, which also allows resuming an interrupted run.')
     parser.add_argument('--queries', required=False, default=QUERIES_FILE,
                         help='The file path with the queries.')
     parser.add_argument('--judgements', required=False, default=JUDGMENTS_FILE,
@@ -105,6 +379,24 @@ if __name__ == "__main__":
 
     parser.add_argument('--log', required=False, default=TRAIN_LOG_FILE,
                         help='The name of the file to store the train log to.')
+    parser.add_argument('--log-batch-size', required=False, type=int, default=0,
+                        help='Number of queries to log features for in a single _msearch request '
+                             '(0 logs every query with a separate request).')
+    parser.add_argument('--log-concurrency', required=False, type=int, default=1,
+                        help='Number of _msearch feature logging requests to keep in flight.')
+    parser.add_argument('--pipeline', required=False, action='store_true',
+                        help='Train on the logged features as they arrive, without reading the features file back, '
+                             'upload the model right after and skip the stages whose inputs did not change.')
+    parser.add_argument('--pipeline-queue', required=False, type=int, default=64,
+                        help='The most queries logged ahead of the training data assembly in the pipelined training.')
+    parser.add_argument('--stages-file', required=False, default=None,
+                        help='The fingerprints of the pipelined training stages, <model file>.stages.json by '
+                             'default.')
+    parser.add_argument('--force', required=False, action='store_true',
+                        help='Run every stage of the pipelined training, even if its inputs did not change.')
+    parser.add_argument('--log-max-ids', required=False, type=int, default=None,
+                        help='The most judged documents logged by a single search (1000 by default). Queries with '
+                             'more judged documents are logged with several searches.')
 
     # deltr arguments
     parser.add_argument('--protected-feature', required=False, default="1",
@@ -112,22 +404,125 @@ if __name__ == "__main__":
     parser.add_argument('--gamma', required=False, type=float, default=1,
                         help='Gamma parameter for the cost calculation in the training phase.')
     parser.add_argument('--number-of-iterations', required=False, type=int, default=10,
-                        help='Number of iteration in gradient descent.')
+                        help='(Maximum) number of iteration in gradient descent.')
     parser.add_argument('--learning-rate', required=False, type=float, default=0.001,
                         help='Learning rate in gradient descent.')
     parser.add_argument('--lambdaa', required=False, type=float, default=0.001,
                         help='Regularization constant.')
     parser.add_argument('--init-var', required=False, type=float, default=0.01,
                         help='Range of values for initialization of weights.')
+    parser.add_argument('--engine', required=False, default="numpy", choices=["numpy", "deltr"],
+                        help='The training engine: the vectorized numpy engine or the reference DELTR library.')
+    parser.add_argument('--processes', required=False, type=int, default=None,
+                        help='Number of processes the numpy engine splits the queries over.')
+    parser.add_argument('--batch-queries', required=False, type=int, default=None,
+                        help='Number of queries sampled per gradient descent step (numpy engine).')
+    parser.add_argument('--optimizer', required=False, default="gd", choices=["gd", "momentum", "adam"],
+                        help='The gradient descent update (numpy engine).')
+    parser.add_argument('--tolerance', required=False, type=float, default=None,
+                        help='Stop early when the relative change of the loss stays below this value (numpy engine).')
+    parser.add_argument('--patience', required=False, type=int, default=10,
+                        help='Number of iterations the loss change has to stay below the tolerance.')
+    parser.add_argument('--time-budget', required=False, type=float, default=None,
+                        help='Maximum training time in seconds (numpy engine).')
     parser.add_argument('--standardize', required=False, type=bool, default=True,
                         help='Boolean indicating whether the data should be standardized or not.')
 
+    # add sweep arguments
+    def float_list(value):
+        return [float(v) for v in value.split(",")]
+
+    parser.add_argument('--sweep-gamma', required=False, type=float_list, default=[0, 0.5, 1],
+                        help='Comma separated gamma values of the sweep.')
+    parser.add_argument('--sweep-learning-rate', required=False, type=float_list, default=[0.001, 0.01],
+                        help='Comma separated learning rates of the sweep.')
+    parser.add_argument('--sweep-lambdaa', required=False, type=float_list, default=[0.001],
+                        help='Comma separated regularization constants of the sweep.')
+    parser.add_argument('--sweep-init-var', required=False, type=float_list, default=[0.01],
+                        help='Comma separated weight initialization ranges of the sweep.')
+    parser.add_argument('--sweep-samples', required=False, type=int, default=None,
+                        help='Train only a random sample of this many configurations of the grid.')
+    parser.add_argument('--sweep-processes', required=False, type=int, default=None,
+                        help='Number of processes training the configurations.')
+    parser.add_argument('--holdout', required=False, type=float, default=0.2,
+                        help='Fraction of the queries held out to score the configurations.')
+    parser.add_argument('--k', required=False, type=int, default=10,
+                        help='Cut-off of the rankings for NDCG and exposure.')
+    parser.add_argument('--rank-by', required=False, default="ndcg", choices=["ndcg", "exposure_disparity"],
+                        help='The metric the configurations are ranked by.')
+    parser.add_argument('--leaderboard', required=False, default="leaderboard.csv",
+                        help='The file path where the scores of the configurations are stored.')
+
     # add search arguments
     parser.add_argument('-q', '--query', required=False, default="Test",
                         help='The keywords to run the query on.')
     parser.add_argument('-v', '--verbose', required=False, action='store_true',
                         help='Show verbose output in search')
+    parser.add_argument('--search-input', required=False, default='-',
+                        help='The file with the queries of a batch search, one per line as plain keywords or as '
+                             'a JSON object with `query` and `id`. Reads stdin by default.')
+    parser.add_argument('--search-output', required=False, default='-',
+                        help='The NDJSON file where the batch search results are written. Writes stdout by default.')
+    parser.add_argument('--search-chunk-size', required=False, type=int, default=100,
+                        help='Number of queries per _msearch request in a batch search.')
+    parser.add_argument('--search-concurrency', required=False, type=int, default=1,
+                        help='Number of requests in flight in a batch search.')
+    parser.add_argument('--async-search', required=False, action='store_true',
+                        help='Send the batch search queries over the async client (requires elasticsearch[async]).')
+
+    def str_tuple(value):
+        return tuple(v.strip() for v in value.split(",") if v.strip())
 
+    def source_fields(value):
+        return False if value == "none" else str_tuple(value)
+
+    parser.add_argument('--window-size', required=False, type=int, default=None,
+                        help='Number of top first-phase hits per shard rescored by the model.')
+    parser.add_argument('--first-phase', required=False, default="multi_match",
+                        help='The first-phase query: multi_match, cross_fields, phrase or the path of a JSON query '
+                             'clause using "{{keywords}}" for the keywords.')
+    parser.add_argument('--search-fields', required=False, type=str_tuple, default=None,
+                        help='Comma separated fields searched by the first-phase query, all fields by default.')
+    parser.add_argument('--source-fields', required=False, type=source_fields, default=None,
+                        help='Comma separated _source fields returned with the hits, `none` for no _source.')
+    parser.add_argument('--models', required=False, type=lambda value: value.split(","), default=None,
+                        help='Comma separated model files to evaluate, the model file by default.')
+    parser.add_argument('--evaluation-summary', required=False, default="evaluation.csv",
+                        help='The CSV file where the mean metrics of every evaluated model are written.')
+    parser.add_argument('--evaluation-per-query', required=False, default="evaluation_per_query.csv",
+                        help='The CSV file where the metrics of every evaluated query are written.')
+    parser.add_argument('--bootstrap', required=False, type=int, default=0,
+                        help='Number of bootstrap samples of the confidence intervals of the evaluation.')
+    parser.add_argument('--bootstrap-processes', required=False, type=int, default=None,
+                        help='Number of processes computing the bootstrap samples.')
+    parser.add_argument('--ranking-output', required=False, default="ranking.csv",
+                        help='The CSV file where the local reranking is written.')
+    parser.add_argument('--window-sizes', required=False, type=lambda value: [int(v) for v in value.split(",")],
+                        default=[10, 25, 50, 100, 250, 500, 1000],
+                        help='Comma separated rescore window sizes of the window sweep.')
+    parser.add_argument('--window-report', required=False, default=None,
+                        help='CSV file where the window sweep report is written.')
+    parser.add_argument('--serve-host', required=False, default="127.0.0.1",
+                        help='The address the search server listens on.')
+    parser.add_argument('--serve-port', required=False, type=int, default=8765,
+                        help='The port the search server listens on.')
+    parser.add_argument('--cost-queries', required=False, type=int, default=50,
+                        help='Number of queries sampled from the queries file to time the features.')
+    parser.add_argument('--cost-repeats', required=False, type=int, default=5,
+                        help='Number of timed runs of every sampled query and feature.')
+    parser.add_argument('--accuracy-budget', required=False, type=float, default=0.01,
+                        help='The largest drop of the mean NDCG@k allowed for the pruned feature set.')
+    parser.add_argument('--feature-cost-report', required=False, default="feature_cost.csv",
+                        help='CSV file where the cost, weight and importance of every feature are written.')
+    parser.add_argument('--pruned-feature-set', required=False, default="features_pruned.json",
+                        help='The file where the suggested pruned feature set is written.')
+    parser.add_argument('--profile', required=False, default=None,
+                        help='Write the timings and counters of the pipeline stages to this file, as JSON for a .json '
+                             'file and in the Prometheus text format otherwise.')
+    parser.add_argument('--cprofile-dir', required=False, default=None,
+                        help='Dump a cProfile of every pipeline stage to this directory.')
+    parser.add_argument('--debug', required=False, action='store_true',
+                        help='Log at DEBUG level, including the request bodies sent to Elasticsearch.')
 
     # parse the arguments
     args = None
@@ -137,20 +532,91 @@ if __name__ == "__main__":
         parser.print_help()
         exit(-1)
 
+    if args.debug:
+        Logger.logger.setLevel("DEBUG")
+    if args.cprofile_dir:
+        os.makedirs(args.cprofile_dir, exist_ok=True)
+        Profiler.cprofile_dir = args.cprofile_dir
+
+    registry = Registry(args.registry_file, publish_plain_names=args.publish_plain_name)
+    search_options = dict(window_size=args.window_size, first_phase=args.first_phase, fields=args.search_fields,
+                          source=args.source_fields)
+
     # run a command based on the arguments
-    if args.prepare:
-        prepare(args.feature_set_file, args.feature_set_name)
-    elif args.index:
-        index(args.index_name, args.document_dir)
-    elif args.train:
-        train(args.feature_set_name, args.model, args.queries,
-              args.judgements, args.index_name, args.features_log_file,
-              args.model_file,
-              args.protected_feature, args.gamma, args.number_of_iterations, args.learning_rate,
-              args.lambdaa, args.init_var, args.standardize, args.log)
-    elif args.search:
-        verbose = True if args.verbose else False
-        search(args.index_name, args.query, args.model, verbose)
-    else:
-        parser.print_help(sys.stderr)
-        sys.exit(1)
+    try:
+        if args.prepare:
+            prepare(args.feature_set_file, args.feature_set_name, registry)
+        elif args.index:
+            index(args.index_name, args.document_dir, args.chunk_docs, args.chunk_bytes, args.index_threads,
+                  args.max_retries, args.alias_swap, args.shards, args.replicas, args.force_merge,
+                  args.keep_generations, args.delta, args.manifest, args.lean_mapping, args.feature_set_file,
+                  args.search_fields, args.first_phase)
+        elif args.train and args.pipeline:
+            train_pipelined(registry, args.feature_set_name, args.model, args.queries, args.judgements,
+                            args.index_name, args.features_log_file, args.model_file, args.stages_file,
+                            args.pipeline_queue, args.force, args.protected_feature, args.log, args.log_batch_size,
+                            args.log_concurrency, args.features_value_type, args.features_compression,
+                            args.features_cache, args.log_max_ids, gamma=args.gamma,
+                            number_of_iterations=args.number_of_iterations, learning_rate=args.learning_rate,
+                            lambdaa=args.lambdaa, init_var=args.init_var, standardize=args.standardize,
+                            engine=args.engine, processes=args.processes, batch_queries=args.batch_queries,
+                            optimizer=args.optimizer, tolerance=args.tolerance, patience=args.patience,
+                            time_budget=args.time_budget)
+        elif args.train:
+            train(registry, args.feature_set_name, args.model, args.queries,
+                  args.judgements, args.index_name, args.features_log_file,
+                  args.model_file,
+                  args.protected_feature, args.gamma, args.number_of_iterations, args.learning_rate,
+                  args.lambdaa, args.init_var, args.standardize, args.log,
+                  args.log_batch_size, args.log_concurrency, args.features_value_type, args.features_compression,
+                  args.features_cache, args.engine, args.processes,
+                  args.batch_queries, args.optimizer, args.tolerance, args.patience, args.time_budget,
+                  args.log_max_ids)
+        elif args.sweep:
+            sweep(registry, args.feature_set_name, args.model, args.features_log_file, args.model_file,
+                  args.leaderboard,
+                  args.sweep_gamma, args.sweep_learning_rate, args.sweep_lambdaa, args.sweep_init_var,
+                  args.sweep_samples, args.holdout, args.k, args.rank_by, args.sweep_processes, args.protected_feature,
+                  number_of_iterations=args.number_of_iterations, standardize=args.standardize,
+                  batch_queries=args.batch_queries, optimizer=args.optimizer, tolerance=args.tolerance,
+                  patience=args.patience, time_budget=args.time_budget)
+        elif args.search:
+            verbose = True if args.verbose else False
+            search(args.index_name, args.query, registry.resolve("models", args.model), verbose, **search_options)
+        elif args.batch_search:
+            batch_search(args.index_name, registry.resolve("models", args.model), args.search_input, args.search_output,
+                         args.search_chunk_size, args.search_concurrency, args.async_search, args.verbose,
+                         **search_options)
+        elif args.deploy:
+            deploy(registry, args.feature_set_name, args.model, args.model_file)
+        elif args.activate_model:
+            registry.activate("models", args.model, args.activate_model)
+        elif args.activate_feature_set:
+            registry.activate("feature_sets", args.feature_set_name, args.activate_feature_set)
+        elif args.registry:
+            registry.report()
+        elif args.evaluate:
+            evaluate(args.features_log_file, args.models or [args.model_file], args.evaluation_summary,
+                     args.evaluation_per_query, args.protected_feature, args.k, args.bootstrap,
+                     args.bootstrap_processes)
+        elif args.rerank:
+            rerank(args.features_log_file, args.model_file, args.ranking_output, args.k)
+        elif args.window_sweep:
+            window_sweep(args.index_name, registry.resolve("models", args.model), args.queries, args.judgements,
+                         args.window_sizes, args.k, args.window_report, first_phase=args.first_phase,
+                         fields=args.search_fields, source=args.source_fields)
+        elif args.serve:
+            serve(args.index_name, args.model, args.model_file, args.registry_file, args.serve_host, args.serve_port,
+                  **search_options)
+        elif args.feature_cost:
+            feature_cost(args.feature_set_file, registry.resolve("feature_sets", args.feature_set_name),
+                         args.model_file, args.features_log_file, args.queries, args.index_name, args.cost_queries,
+                         args.cost_repeats, args.protected_feature, args.k, args.accuracy_budget,
+                         args.feature_cost_report, args.pruned_feature_set, window_size=args.window_size,
+                         first_phase=args.first_phase, fields=args.search_fields)
+        else:
+            parser.print_help(sys.stderr)
+            sys.exit(1)
+    finally:
+        if args.profile:
+            Profiler.write(args.profile)
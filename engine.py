@@ -0,0 +1,409 @@
+from multiprocessing import Pipe, Process
+from time import time
+
+import numpy as np
+import pandas as pd
+from fairsearchdeltr.models import TrainStep
+
+from utils import Logger
+
+
+class _Segments(object):
+    """
+    Training data of a set of queries, sorted by query so that the rows of every query form a contiguous segment.
+    Per-query sums are computed for all queries at once with `np.add.reduceat`.
+    """
+
+    def __init__(self, feature_matrix, judgements, protected, starts, total_rows):
+        self.features = feature_matrix
+        self.judgements = judgements
+        self.protected_values = protected
+        self.total_rows = total_rows
+        self.starts = starts
+        self.counts = np.diff(np.append(starts, feature_matrix.shape[0]))
+        self.rows = np.repeat(np.arange(len(starts)), self.counts)
+        # the reference implementation normalizes the listwise loss by the log of the size of the whole training set
+        self.log_m = np.log(total_rows)
+
+        self.protected = (protected == 1).astype(feature_matrix.dtype)
+        self.nonprotected = (protected == 0).astype(feature_matrix.dtype)
+        self.n_protected = self.sum(self.protected)
+        self.n_nonprotected = self.sum(self.nonprotected)
+
+        # the top-1 probabilities of the judgements do not change during training
+        exp_judgements = np.exp(judgements - np.maximum.reduceat(judgements, starts)[self.rows])
+        self.topp_judgements = exp_judgements / self.sum(exp_judgements)[self.rows]
+        self.features_topp_judgements = self.sum(feature_matrix * self.topp_judgements[:, None])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def sum(self, values):
+        return np.add.reduceat(values, self.starts, axis=0)
+
+    def subset(self, queries):
+        """
+        :param queries:     sorted indices of the queries to keep
+        :return:            the segments of the selected queries
+        """
+        counts = self.counts[queries]
+        starts = np.cumsum(np.r_[0, counts[:-1]])
+        rows = np.arange(counts.sum()) + np.repeat(self.starts[queries] - starts, counts)
+        return _Segments(self.features[rows], self.judgements[rows], self.protected_values[rows], starts,
+                         self.total_rows)
+
+    def step(self, omega, gamma):
+        """
+        Computes the losses and the gradient of all queries in the segment for the current weights
+        :return:        (gradient, loss_standard, loss_exposure), summed over the rows like the reference implementation
+        """
+        predictions = np.dot(self.features, omega)
+        shifted = predictions - np.maximum.reduceat(predictions, self.starts)[self.rows]
+        exp_predictions = np.exp(shifted)
+        total = self.sum(exp_predictions)
+
+        # listwise loss: cross entropy of the top-1 probabilities
+        loss = -self.sum(self.topp_judgements * (shifted - np.log(total)[self.rows])) / self.log_m
+
+        features_exp = self.sum(self.features * exp_predictions[:, None])
+        gradient = (features_exp / total[:, None] - self.features_topp_judgements) / self.log_m
+
+        # exposure of the protected and the non-protected group
+        exp_protected = self.sum(exp_predictions * self.protected)
+        exp_nonprotected = self.sum(exp_predictions * self.nonprotected)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            exposure_protected = np.where(self.n_protected > 0,
+                                          exp_protected / total / np.log(2) / self.n_protected, 0)
+            exposure_nonprotected = np.where(self.n_nonprotected > 0,
+                                             exp_nonprotected / total / np.log(2) / self.n_nonprotected, 0)
+        exposure_diff = np.maximum(0, exposure_nonprotected - exposure_protected)
+
+        if gamma != 0:
+            loss = loss + gamma * exposure_diff ** 2
+
+            # derivative of the normalized top-1 probability of each group (second factor of eq. 12 in the paper)
+            features_exp_total = features_exp.sum(axis=1)
+            denominator = (total ** 2 * np.log(2))[:, None]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean_exp_protected = np.where(self.n_protected > 0, exp_protected / self.n_protected, 0)
+                mean_exp_nonprotected = np.where(self.n_nonprotected > 0, exp_nonprotected / self.n_nonprotected, 0)
+            deriv_protected = (self.sum(self.features * (exp_predictions * self.protected)[:, None]) * total[:, None]
+                               - (mean_exp_protected * features_exp_total)[:, None]) / denominator
+            deriv_nonprotected = (self.sum(self.features * (exp_predictions * self.nonprotected)[:, None])
+                                  * total[:, None]
+                                  - (mean_exp_nonprotected * features_exp_total)[:, None]) / denominator
+            deriv_protected[self.n_protected == 0] = 0
+            deriv_nonprotected[self.n_nonprotected == 0] = 0
+
+            gradient += gamma * 2 * exposure_diff[:, None] * (deriv_nonprotected - deriv_protected)
+
+        # the reference implementation iterates over the query id of every row, i.e. every query is weighted
+        # by its number of documents
+        return np.dot(self.counts, gradient), np.dot(self.counts, loss), np.dot(self.counts, exposure_diff)
+
+
+def _shard_worker(shard, connection):
+    """ runs the steps of one shard until it receives None, the shard is only sent to this process """
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        omega, gamma, queries = message
+        try:
+            connection.send((shard if queries is None else shard.subset(queries)).step(omega, gamma))
+        except Exception as e:
+            connection.send(e)
+    connection.close()
+
+
+class _ShardWorkers(object):
+    """ One process per shard, which keeps its shard for the whole training and computes its step every iteration """
+
+    def __init__(self, shards):
+        self._connections, self._processes = [], []
+        for shard in shards:
+            parent, child = Pipe()
+            process = Process(target=_shard_worker, args=(shard, child), daemon=True)
+            process.start()
+            child.close()
+            self._connections.append(parent)
+            self._processes.append(process)
+
+    def step(self, omega, gamma, batches):
+        for connection, queries in zip(self._connections, batches):
+            connection.send((omega, gamma, queries))
+        results = [connection.recv() for connection in self._connections]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def close(self):
+        for connection in self._connections:
+            try:
+                connection.send(None)
+            except (OSError, BrokenPipeError):
+                pass
+        for connection, process in zip(self._connections, self._processes):
+            process.join()
+            connection.close()
+
+
+class DeltrEngine(object):
+    """
+    Vectorized DELTR trainer. Takes the same parameters as `fairsearchdeltr.Deltr` and reproduces its weights,
+    but computes the losses and gradients of all queries at once on query-segmented NumPy arrays instead of looping
+    over the queries in Python. The queries can also be split in shards, each processed by its own process.
+
+    Besides the full-batch gradient descent of the reference implementation, the trainer can sample a mini-batch of
+    queries per step, use momentum or Adam updates and stop early once the loss converges or a time budget is spent.
+    In that case `number_of_iterations` is only an upper bound.
+    """
+
+    def __init__(self, protected_feature: str, gamma: float, number_of_iterations=3000, learning_rate=0.001,
+                 lambdaa=0.001, init_var=0.01, standardize=False, processes=None, batch_queries=None,
+                 optimizer="gd", tolerance=None, patience=10, time_budget=None):
+        """
+        :param protected_feature:       name of the column in data that contains protected attribute
+        :param gamma:                   gamma parameter for the cost calculation in the training phase
+                                        (recommended to be around 1)
+        :param number_of_iterations     number of iteration in gradient descent (optional)
+        :param learning_rate            learning rate in gradient descent (optional)
+        :param lambdaa                  regularization constant (optional)
+        :param init_var                 range of values for initialization of weights (optional)
+        :param standardize              boolean indicating whether the data should be standardized or not (optional)
+        :param processes                number of processes to split the queries over (optional)
+        :param batch_queries            number of queries sampled per step, all queries are used if not set (optional)
+        :param optimizer                `gd`, `momentum` or `adam` (optional)
+        :param tolerance                stop when the relative change of loss_standard + loss_exposure stays below
+                                        this value for `patience` iterations (optional)
+        :param patience                 number of iterations the loss has to stay converged (optional)
+        :param time_budget              maximum training time in seconds (optional)
+        """
+        if protected_feature is None:
+            raise ValueError("The name of column in data `protected_feature` must be initialized")
+        if gamma is None:
+            raise ValueError("The `gamma` parameter must be initialized")
+
+        self._protected_feature_name = protected_feature
+        self._gamma = gamma
+        self._number_of_iterations = number_of_iterations
+        self._learning_rate = learning_rate
+        self._lambda = lambdaa
+        self._init_var = init_var
+        self._standardize = standardize
+        self._processes = processes
+        self._batch_queries = batch_queries
+        self._optimizer = optimizer
+        self._tolerance = tolerance
+        self._patience = patience
+        self._time_budget = time_budget
+
+        if optimizer not in ("gd", "momentum", "adam"):
+            raise ValueError("Unknown optimizer `%s`" % optimizer)
+
+        self._omega = None
+        self._log = None
+        self._protected_column = None
+        self.mus = None
+        self.sigmas = None
+
+        # statistics of the last training run
+        self.iterations = 0
+        self.converged = False
+        self.training_time = None
+
+    @property
+    def log(self):
+        if self._omega is None:
+            raise SystemError("You need to train a model first!")
+        return self._log
+
+    def train(self, training_set: pd.DataFrame):
+        """
+        Trains a DELTR model on a given training set
+        :param training_set:        requires first column to contain the query ids, second column the document ids
+                                    and last column to contain the training judgements in descending order
+                                    i.e. higher scores are better
+        :return:                    returns the model
+        """
+        names = training_set.columns.tolist()
+        if self._protected_feature_name not in names:
+            raise ValueError("The name of the protected feature does not appear in the `DataFrame`")
+        # the first 2 columns should ALWAYS be query id and document id
+        protected_column = names.index(self._protected_feature_name) - 2
+
+        return self.train_arrays(np.asarray(training_set.iloc[:, 0]),
+                                 np.asarray(training_set.iloc[:, 2:-1], dtype=np.float64),
+                                 np.asarray(training_set.iloc[:, -1], dtype=np.float64),
+                                 protected_column)
+
+    def train_arrays(self, query_ids, feature_matrix, judgements, protected_column: int):
+        """
+        Trains a DELTR model on training data that is already split in arrays
+        :param query_ids:           the query id of every row
+        :param feature_matrix:      the features of every row
+        :param judgements:          the judgement of every row
+        :param protected_column:    the index of the protected feature in the feature matrix
+        :return:                    returns the model
+        """
+        self._protected_column = protected_column
+        protected = feature_matrix[:, protected_column].copy()
+        if self._standardize:
+            # same as the reference implementation: one mean and deviation over the whole matrix,
+            # the protected feature is kept as is
+            self.mus = feature_matrix.mean()
+            self.sigmas = feature_matrix.std()
+            feature_matrix = (feature_matrix - self.mus) / self.sigmas
+            feature_matrix[:, protected_column] = protected
+
+        shards = self._segments(query_ids, feature_matrix, judgements, protected)
+        self._omega, self._log = self._gradient_descent(shards, feature_matrix.shape[1])
+        return self._omega
+
+    def predict(self, feature_matrix):
+        """
+        Scores documents with the trained model, applying the same standardization as in training
+        :param feature_matrix:      the features of every document
+        :return:                    the score of every document
+        """
+        if self._omega is None:
+            raise SystemError("You need to train a model first!")
+        if self._standardize:
+            protected = feature_matrix[:, self._protected_column].copy()
+            feature_matrix = (feature_matrix - self.mus) / self.sigmas
+            feature_matrix[:, self._protected_column] = protected
+        return np.dot(feature_matrix, self._omega)
+
+    def _segments(self, query_ids, feature_matrix, judgements, protected):
+        order = np.argsort(query_ids, kind='stable')
+        query_ids = query_ids[order]
+        starts = np.flatnonzero(np.r_[True, query_ids[1:] != query_ids[:-1]])
+
+        shard_count = max(1, min(self._processes or 1, len(starts)))
+        bounds = np.append(starts[np.linspace(0, len(starts), shard_count, endpoint=False).astype(int)],
+                           len(query_ids))
+        shards = []
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            rows = order[first:last]
+            shard_starts = starts[(starts >= first) & (starts < last)] - first
+            shards.append(_Segments(feature_matrix[rows], judgements[rows], protected[rows], shard_starts,
+                                    len(query_ids)))
+        return shards
+
+    def _sample(self, shards):
+        """ samples a mini-batch of queries, proportionally from every shard """
+        if not self._batch_queries:
+            return [None] * len(shards)
+        total = sum(len(shard) for shard in shards)
+        if self._batch_queries >= total:
+            return [None] * len(shards)
+        return [np.sort(np.random.choice(len(shard), max(1, int(round(self._batch_queries * len(shard) / total))),
+                                         replace=False))
+                for shard in shards]
+
+    def _gradient_descent(self, shards, n_features):
+        omega = (np.random.rand(n_features, 1) * self._init_var).reshape(-1)
+        log = []
+
+        velocity = np.zeros(n_features)
+        second_moment = np.zeros(n_features)
+        smoothed_loss = None
+        stable = 0
+        self.converged = False
+
+        start = time()
+        workers = _ShardWorkers(shards) if len(shards) > 1 else None
+        try:
+            for t in range(self._number_of_iterations):
+                batches = self._sample(shards)
+                if workers is not None:
+                    results = workers.step(omega, self._gamma, batches)
+                else:
+                    results = [(shard if queries is None else shard.subset(queries)).step(omega, self._gamma)
+                               for shard, queries in zip(shards, batches)]
+
+                # scale the sums of a mini-batch up to an estimate for all queries
+                scale = sum(len(shard) for shard in shards) / float(sum(len(shard) if queries is None else len(queries)
+                                                                        for shard, queries in zip(shards, batches)))
+                gradient = scale * sum(r[0] for r in results)
+                loss_standard = scale * sum(r[1] for r in results)
+                loss_exposure = scale * sum(r[2] for r in results)
+
+                if self._optimizer == "momentum":
+                    velocity = 0.9 * velocity + gradient
+                    omega = omega - self._learning_rate * velocity
+                elif self._optimizer == "adam":
+                    velocity = 0.9 * velocity + 0.1 * gradient
+                    second_moment = 0.999 * second_moment + 0.001 * gradient ** 2
+                    omega = omega - self._learning_rate * (velocity / (1 - 0.9 ** (t + 1))) \
+                        / (np.sqrt(second_moment / (1 - 0.999 ** (t + 1))) + 1e-8)
+                else:
+                    omega = omega - self._learning_rate * gradient
+
+                log.append(TrainStep(int(time() * 1000), omega, gradient, loss_standard, loss_exposure,
+                                     loss_standard))
+
+                if self._tolerance is not None:
+                    # stop when the relative change of the loss stayed below the tolerance for `patience` iterations,
+                    # the loss of a mini-batch is noisy so its moving average is used instead
+                    loss = loss_standard + loss_exposure
+                    previous = smoothed_loss
+                    smoothed_loss = loss if previous is None or batches[0] is None else 0.9 * previous + 0.1 * loss
+                    if previous is not None and abs(smoothed_loss - previous) <= self._tolerance * abs(previous):
+                        stable += 1
+                    else:
+                        stable = 0
+                    if stable >= self._patience:
+                        self.converged = True
+                        break
+
+                if self._time_budget is not None and time() - start >= self._time_budget:
+                    break
+        finally:
+            if workers is not None:
+                workers.close()
+
+        self.iterations = len(log)
+        self.training_time = time() - start
+        Logger.logger.info("*** %d iterations in %.3fs (%s)" % (self.iterations, self.training_time,
+                                                              "converged" if self.converged else "not converged"))
+        return omega, log
+
+
+def compare_with_reference(features_file: str, protected_feature_name="1", gamma=1, number_of_iterations=100,
+                           learning_rate=0.001, lambdaa=0.001, init_var=0.01, standardize=True, processes=None,
+                           seed=42):
+    """
+    Trains the reference `fairsearchdeltr.Deltr` and the `DeltrEngine` from the same initial weights and reports
+    the difference between the weights and the speedup
+    :return:                        (max absolute weight difference, speedup)
+    """
+    from fairsearchdeltr import Deltr
+    from features import read_features
+
+    train_data = read_features(features_file)
+
+    np.random.seed(seed)
+    start = time()
+    reference = Deltr(protected_feature_name, gamma, number_of_iterations, learning_rate, lambdaa, init_var,
+                      standardize).train(train_data)
+    reference_time = time() - start
+
+    np.random.seed(seed)
+    start = time()
+    omega = DeltrEngine(protected_feature_name, gamma, number_of_iterations, learning_rate, lambdaa, init_var,
+                        standardize, processes).train(train_data)
+    engine_time = time() - start
+
+    difference = float(np.max(np.abs(reference - omega)))
+    Logger.logger.info("*** Reference: %.3fs, engine: %.3fs, speedup: %.1fx, max weight difference: %.3g"
+                       % (reference_time, engine_time, reference_time / engine_time, difference))
+    return difference, reference_time / engine_time
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    compare_with_reference(argv[1], number_of_iterations=int(argv[2]) if len(argv) > 2 else 100,
+                           processes=int(argv[3]) if len(argv) > 3 else None)
@@ -0,0 +1,134 @@
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from features import iter_features
+from metrics import average_precision, exposure_ratio, ndcg
+from rerank import Reranker
+from utils import Logger, FEATURES_FILE, MODEL_FILE
+
+
+def model_name(model_file: str):
+    """ names a model after its file, without the directory and the extension """
+    return os.path.splitext(os.path.basename(model_file))[0]
+
+
+def evaluate_chunk(reranker: Reranker, features: pd.DataFrame, protected_feature_name="1", k=10):
+    """
+    Scores the queries of a features chunk with a model and computes the metrics of every query
+    :param reranker:                the model (see `rerank.Reranker`)
+    :param features:                data frame with the query id, document id, feature and judgement columns
+    :param protected_feature_name:  the name of the feature that is 1 for the documents of the protected group
+    :param k:                       cut-off of the metrics
+    :return:                        data frame with the query id, NDCG@k, AP@k and exposure ratio@k of every query
+    """
+    feature_names = features.columns.tolist()[2:-1]
+    if protected_feature_name not in feature_names:
+        raise ValueError("The name of the protected feature does not appear in the features file")
+    feature_matrix = np.asarray(features.iloc[:, 2:-1], dtype=np.float64)
+    query_ids = np.asarray(features.iloc[:, 0])
+    judgements = np.asarray(features.iloc[:, -1], dtype=np.float64)
+    protected = feature_matrix[:, feature_names.index(protected_feature_name)] == 1
+
+    scores = reranker.score(feature_matrix, feature_names)
+    return pd.DataFrame({"query_id": np.unique(query_ids),
+                         "ndcg": ndcg(query_ids, scores, judgements, k),
+                         "map": average_precision(query_ids, scores, judgements, k),
+                         "exposure_ratio": exposure_ratio(query_ids, scores, protected, k)})
+
+
+def _bootstrap_means(args):
+    values, samples, seed = args
+    rng = np.random.RandomState(seed)
+    means = np.empty((samples, values.shape[1]))
+    for i in range(samples):
+        sample = values[rng.randint(0, len(values), len(values))]
+        with np.errstate(invalid='ignore'):
+            means[i] = np.nanmean(sample, axis=0)
+    return means
+
+
+def bootstrap_intervals(values, samples=1000, confidence=0.95, processes=None, seed=42):
+    """
+    Computes bootstrap confidence intervals of the means of per-query metrics by resampling the queries. The
+    samples are split over a process pool.
+    :param values:                  (queries x metrics) array, NaN values are left out of the means
+    :param samples:                 number of bootstrap samples
+    :param confidence:              the confidence level of the intervals
+    :param processes:               number of worker processes
+    :return:                        (lower bounds, upper bounds) arrays with a value per metric
+    """
+    values = np.asarray(values, dtype=np.float64)
+    jobs = max(1, min(processes or os.cpu_count() or 1, samples))
+    sizes = np.diff(np.linspace(0, samples, jobs + 1).astype(int))
+    with Pool(jobs) as pool:
+        means = np.concatenate(pool.map(_bootstrap_means, [(values, int(size), seed + i)
+                                                           for i, size in enumerate(sizes) if size]))
+    alpha = (1 - confidence) / 2
+    with np.errstate(invalid='ignore'):
+        return np.nanquantile(means, alpha, axis=0), np.nanquantile(means, 1 - alpha, axis=0)
+
+
+def evaluate(features_file: str, model_files: list, summary_file=None, per_query_file=None,
+             protected_feature_name="1", k=10, bootstrap=0, confidence=0.95, processes=None, chunk_rows=1000000):
+    """
+    Evaluates models on the logged features of judged queries. The features file is read in chunks of whole
+    queries, so only the per-query metrics are kept in memory.
+    :param features_file:           the features file with the judged documents of every query
+    :param model_files:             the model JSON files to evaluate (see `rerank.Reranker.from_files`)
+    :param summary_file:            CSV file where the mean metrics of every model are written (optional)
+    :param per_query_file:          CSV file where the metrics of every model and query are written (optional)
+    :param protected_feature_name:  the name of the feature that is 1 for the documents of the protected group
+    :param k:                       cut-off of the metrics
+    :param bootstrap:               number of bootstrap samples of the confidence intervals, no intervals if 0
+    :param confidence:              the confidence level of the intervals
+    :param processes:               number of worker processes of the bootstrap
+    :param chunk_rows:              number of rows of the features file read at once
+    :return:                        the summary data frame
+    """
+    rerankers = {model_name(model_file): Reranker.from_files(model_file) for model_file in model_files}
+    metrics = ["ndcg", "map", "exposure_ratio"]
+    per_query = {name: [] for name in rerankers}
+
+    per_query_output = open(per_query_file, 'w') if per_query_file else None
+    try:
+        header = True
+        for chunk in iter_features(features_file, chunk_rows):
+            for name, reranker in rerankers.items():
+                results = evaluate_chunk(reranker, chunk, protected_feature_name, k)
+                per_query[name].append(results[metrics].to_numpy())
+                if per_query_output is not None:
+                    results.insert(0, "model", name)
+                    results.to_csv(per_query_output, index=False, header=header)
+                    header = False
+    finally:
+        if per_query_output is not None:
+            per_query_output.close()
+
+    summary = []
+    for name, values in per_query.items():
+        values = np.concatenate(values) if values else np.empty((0, len(metrics)))
+        with np.errstate(invalid='ignore'):
+            row = {"model": name, "queries": len(values)}
+            row.update({"%s@%d" % (metric, k): np.nanmean(values[:, i]) if len(values) else np.nan
+                        for i, metric in enumerate(metrics)})
+        if bootstrap and len(values):
+            lower, upper = bootstrap_intervals(values, bootstrap, confidence, processes)
+            for i, metric in enumerate(metrics):
+                row["%s@%d_low" % (metric, k)] = lower[i]
+                row["%s@%d_high" % (metric, k)] = upper[i]
+        summary.append(row)
+
+    summary = pd.DataFrame(summary)
+    Logger.logger.info(summary.to_string(index=False))
+    if summary_file:
+        summary.to_csv(summary_file, index=False)
+    return summary
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    evaluate(argv[1] if len(argv) > 1 else FEATURES_FILE, argv[2:] or [MODEL_FILE], bootstrap=1000)
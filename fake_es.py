@@ -0,0 +1,481 @@
+import fnmatch
+import hashlib
+import heapq
+import json
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from utils import Logger
+
+TOKEN = re.compile(r"\w+")
+SCRIPT_EQUALS = re.compile(r"doc\['([^']+)'\]\.value\s*==\s*'([^']*)'")
+
+
+def tokenize(text):
+    return TOKEN.findall(str(text).lower())
+
+
+def field_values(document, field):
+    """ returns the values of a (dotted) field of a document, descending into lists of objects """
+    values = [document]
+    for part in field.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, list):
+                found.extend(v.get(part) for v in value if isinstance(v, dict))
+            elif isinstance(value, dict):
+                found.append(value.get(part))
+        values = [v for v in found if v is not None]
+    flat = []
+    for value in values:
+        flat.extend(value if isinstance(value, list) else [value])
+    return flat
+
+
+def _template_fields(query):
+    (kind, spec), = query.items()
+    return spec.get('fields') if kind == 'multi_match' else list(spec)
+
+
+def compile_feature(template):
+    """
+    Turns a feature template into a function of (index, doc id, keyword tokens, keywords). Match queries are
+    approximated by their term frequencies, `match_explorer` by the statistics of the term frequencies and script
+    scores comparing a field to a value by that comparison. Other features get a deterministic pseudo-random value.
+    """
+    (kind, spec), = template.items()
+    if kind == 'function_score':
+        match = SCRIPT_EQUALS.search(json.dumps(spec))
+        if match:
+            field, value = match.group(1), match.group(2)
+            field = field[:-len('.keyword')] if field.endswith('.keyword') else field
+            return lambda index, doc_id, tokens, keywords: \
+                1.0 if value in field_values(index.docs[doc_id], field) else 0.0
+    elif kind in ('match', 'multi_match'):
+        fields = _template_fields(template)
+        return lambda index, doc_id, tokens, keywords: \
+            float(sum(math.log1p(tf) for tf in index.frequencies(doc_id, fields, tokens)))
+    elif kind == 'match_explorer' and spec.get('type') in STATISTICS:
+        fields, statistic = _template_fields(spec['query']), STATISTICS[spec['type']]
+
+        def explore(index, doc_id, tokens, keywords):
+            return float(statistic(index.frequencies(doc_id, fields, sorted(set(tokens))) or [0]))
+        return explore
+
+    salt = json.dumps(template, sort_keys=True)
+    return lambda index, doc_id, tokens, keywords: \
+        int(hashlib.md5(("%s|%s|%s" % (doc_id, salt, keywords)).encode()).hexdigest()[:6], 16) / float(0xffffff)
+
+
+STATISTICS = {
+    "unique_terms_count": lambda tfs: sum(1 for tf in tfs if tf),
+    "sum_raw_tf": sum,
+    "max_raw_tf": max,
+    "min_raw_tf": min,
+    "mean_raw_tf": lambda tfs: sum(tfs) / len(tfs),
+}
+
+
+# rough size in bytes of a term of a document in the inverted index (term, frequency and positions), the fake has no
+# segments to measure
+POSTING_BYTES = 12
+
+
+def indexed_fields(mappings):
+    """ returns the indexed fields of a mapping that is not dynamic, None if every string field is indexed """
+    if str(mappings.get('dynamic', True)).lower() != 'false':
+        return None
+    fields = set()
+
+    def collect(properties, prefix):
+        for name, spec in properties.items():
+            if spec.get('enabled', True) is False:
+                continue
+            if 'properties' in spec:
+                collect(spec['properties'], prefix + name + ".")
+            elif spec.get('type', 'object') in ('text', 'keyword') and spec.get('index', True):
+                fields.add(prefix + name)
+    collect(mappings.get('properties', {}), "")
+    return fields
+
+
+class FakeIndex(object):
+    """ The documents of an index with the term frequencies of their indexed text fields """
+
+    def __init__(self, body=None):
+        self.settings = (body or {}).get('settings', {})
+        self.mappings = (body or {}).get('mappings', {})
+        self.indexed = indexed_fields(self.mappings)
+        self.docs = {}
+        self.sizes = {}
+        self.terms = {}
+        self.postings = defaultdict(dict)
+        self.source_bytes = 0
+        self.posting_count = 0
+
+    def _term_frequencies(self, document, prefix=""):
+        fields = {}
+        for key, value in document.items():
+            name = prefix + key
+            values = value if isinstance(value, list) else [value]
+            for v in values:
+                if isinstance(v, dict):
+                    for sub, counts in self._term_frequencies(v, name + ".").items():
+                        fields.setdefault(sub, Counter()).update(counts)
+                elif isinstance(v, str) and (self.indexed is None or name in self.indexed):
+                    fields.setdefault(name, Counter()).update(tokenize(v))
+        return fields
+
+    def put(self, doc_id, document, size):
+        self.delete(doc_id)
+        self.docs[doc_id] = document
+        self.sizes[doc_id] = size
+        self.terms[doc_id] = self._term_frequencies(document)
+        self.source_bytes += size
+        for counts in self.terms[doc_id].values():
+            self.posting_count += len(counts)
+            for token, tf in counts.items():
+                self.postings[token][doc_id] = self.postings[token].get(doc_id, 0) + tf
+
+    def delete(self, doc_id):
+        if doc_id not in self.docs:
+            return False
+        self.source_bytes -= self.sizes.pop(doc_id)
+        for counts in self.terms.pop(doc_id).values():
+            self.posting_count -= len(counts)
+            for token in counts:
+                self.postings[token].pop(doc_id, None)
+        del self.docs[doc_id]
+        return True
+
+    def frequencies(self, doc_id, fields, tokens):
+        """ returns the summed frequency of every token in the fields (all text fields if not set) of a document """
+        terms = self.terms[doc_id]
+        fields = [f.split('^')[0] for f in fields] if fields else list(terms)
+        return [sum(terms[f][token] for f in fields if f in terms) for token in tokens]
+
+
+class FakeElasticsearch(object):
+    """
+    An in-memory stand-in for an Elasticsearch node with the LTR plugin, served over HTTP so the real clients can be
+    pointed at it. It implements the APIs used by this project: `_bulk`, `_search` and `_msearch` with the `sltr`
+    query, the `ltr_log` extension and rescoring, the index and alias APIs and the `_ltr` store endpoints. Features
+    are computed from term frequencies, so the values are deterministic but only approximate the real queries.
+    Every request waits `latency` seconds before it is answered.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        self.latency = latency
+        self.indices = {}
+        self.aliases = {}
+        self.feature_sets = {}
+        self.models = {}
+        self.store = False
+        self.requests = 0
+        # the compiled features of every stored feature set, by the id of the definition
+        self._compiled = {}
+        self._lock = threading.RLock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                path = urlsplit(self.path).path
+                if fake.latency:
+                    time.sleep(fake.latency)
+                try:
+                    status, body = fake.handle(self.command, path, raw)
+                except Exception as e:
+                    status, body = 500, {"error": {"type": "exception", "reason": repr(e)}, "status": 500}
+                payload = b'' if body is None else json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('X-Elastic-Product', 'Elasticsearch')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(payload)
+
+            do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _handle
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        Logger.logger.info("*** Fake Elasticsearch listening on %s" % self.url)
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    # routing
+    def handle(self, method, path, raw):
+        self.requests += 1
+        parts = [p for p in path.split('/') if p]
+        if not parts:
+            return 200, {"name": "fake", "cluster_name": "fake", "tagline": "You Know, for Search",
+                         "version": {"number": "7.17.0", "build_flavor": "default"}}
+        if parts[0] == '_ltr':
+            return self._ltr(method, parts[1:], raw)
+        if parts[-1] == '_bulk':
+            return 200, self._bulk(parts[0] if len(parts) > 1 else None, raw)
+        if parts[-1] == '_msearch':
+            return 200, self._msearch(parts[0] if len(parts) > 1 else None, raw)
+        if parts[-1] == '_search':
+            return self._search_response(parts[0], json.loads(raw or b'{}'))
+        if parts[0] == '_cluster':
+            return 200, {"status": "green"}
+        if parts[0] == '_aliases':
+            return 200, self._update_aliases(json.loads(raw))
+        if '_alias' in parts:
+            name = parts[parts.index('_alias') + 1]
+            return (200, {}) if name in self.aliases else (404, {})
+        if parts[0] in ('_refresh', '_forcemerge') or parts[-1] in ('_refresh', '_forcemerge', '_settings'):
+            return 200, {"acknowledged": True}
+        if parts[-1] == '_stats':
+            return self._stats(parts[0])
+        if len(parts) == 1:
+            return self._index(method, parts[0], raw)
+        return 404, {"error": {"type": "unsupported", "reason": path}, "status": 404}
+
+    def _resolve(self, name):
+        return self.aliases.get(name, name)
+
+    def _index(self, method, name, raw):
+        with self._lock:
+            if method == 'PUT':
+                if name in self.indices:
+                    return 400, {"error": {"type": "resource_already_exists_exception"}, "status": 400}
+                self.indices[name] = FakeIndex(json.loads(raw) if raw else None)
+                return 200, {"acknowledged": True, "index": name}
+            names = [n for n in self.indices if fnmatch.fnmatch(n, name)] if '*' in name else \
+                [self._resolve(n) for n in name.split(',') if self._resolve(n) in self.indices]
+            if not names:
+                return 404, {"error": {"type": "index_not_found_exception"}, "status": 404}
+            if method == 'DELETE':
+                for n in names:
+                    del self.indices[n]
+                    self.aliases = {a: i for a, i in self.aliases.items() if i != n}
+                return 200, {"acknowledged": True}
+            return 200, {n: {"aliases": {a: {} for a, i in self.aliases.items() if i == n},
+                             "settings": self.indices[n].settings, "mappings": self.indices[n].mappings}
+                         for n in names}
+
+    def _update_aliases(self, body):
+        with self._lock:
+            for action in body.get('actions', []):
+                (kind, spec), = action.items()
+                if kind == 'add':
+                    self.aliases[spec['alias']] = spec['index']
+                elif kind == 'remove':
+                    self.aliases.pop(spec['alias'], None)
+                elif kind == 'remove_index':
+                    self.indices.pop(spec['index'], None)
+        return {"acknowledged": True}
+
+    def _stats(self, name):
+        index = self.indices.get(self._resolve(name))
+        if index is None:
+            return 404, {"error": {"type": "index_not_found_exception"}, "status": 404}
+        return 200, {"_all": {"primaries": {"docs": {"count": len(index.docs)},
+                                            "store": {"size_in_bytes": index.source_bytes
+                                                      + POSTING_BYTES * index.posting_count}}}}
+
+    def _bulk(self, default_index, raw):
+        raw_lines = [line for line in raw.splitlines() if line.strip()]
+        lines = [json.loads(line) for line in raw_lines]
+        items, i = [], 0
+        with self._lock:
+            while i < len(lines):
+                (op, meta), = lines[i].items()
+                index_name = self._resolve(meta.get('_index', default_index))
+                index = self.indices.setdefault(index_name, FakeIndex())
+                doc_id = str(meta.get('_id'))
+                if op == 'delete':
+                    found = index.delete(doc_id)
+                    items.append({op: {"_index": index_name, "_id": doc_id, "status": 200 if found else 404,
+                                       "result": "deleted" if found else "not_found"}})
+                    i += 1
+                    continue
+                source = lines[i + 1]
+                if op == 'update':
+                    source = dict(index.docs.get(doc_id, {}), **source.get('doc', {}))
+                index.put(doc_id, source, len(raw_lines[i + 1]))
+                items.append({op: {"_index": index_name, "_id": doc_id, "status": 201, "result": "created"}})
+                i += 2
+        return {"took": 1, "errors": False, "items": items}
+
+    def _msearch(self, default_index, raw):
+        lines = [json.loads(line) for line in raw.splitlines() if line.strip()]
+        responses = []
+        for header, body in zip(lines[0::2], lines[1::2]):
+            status, response = self._search_response(header.get('index', default_index), body)
+            response["status"] = status
+            responses.append(response)
+        return {"took": 1, "responses": responses}
+
+    # the LTR plugin
+    def _ltr(self, method, parts, raw):
+        with self._lock:
+            if not parts:
+                if method == 'PUT':
+                    if self.store:
+                        return 400, {"error": {"type": "resource_already_exists_exception"}, "status": 400}
+                    self.store = True
+                elif method == 'DELETE':
+                    self.store, self.feature_sets, self.models = False, {}, {}
+                return 200, {"acknowledged": True}
+            kind, name = parts[0], parts[1] if len(parts) > 1 else None
+            store = self.feature_sets if kind == '_featureset' else self.models
+            if len(parts) == 3 and parts[2] == '_createmodel':
+                if name not in self.feature_sets:
+                    return 404, {"error": {"type": "resource_not_found_exception"}, "status": 404}
+                model = json.loads(raw)['model']
+                if model['name'] in self.models:
+                    return 400, {"error": {"type": "resource_already_exists_exception"}, "status": 400}
+                definition = model['model']['definition']
+                self.models[model['name']] = {
+                    "feature_set": self.feature_sets[name],
+                    "weights": json.loads(definition) if isinstance(definition, str) else definition}
+                return 201, {"_id": model['name'], "result": "created"}
+            if method == 'GET':
+                if name not in store:
+                    return 404, {"found": False, "_id": name}
+                if kind == '_model':
+                    # the stored model as the plugin returns it, with the copy of its feature set
+                    model = store[name]
+                    return 200, {"found": True, "_id": name, "_source": {
+                        "name": name, "type": "model", "model": {
+                            "name": name, "feature_set": model["feature_set"],
+                            "model": {"type": "model/linear", "definition": json.dumps(model["weights"])}}}}
+                return 200, {"found": True, "_id": name, "_source": store[name]}
+            if method == 'DELETE':
+                return (200, {"result": "deleted"}) if store.pop(name, None) is not None else (404, {"found": False})
+            if name in store:
+                return 400, {"error": {"type": "resource_already_exists_exception"}, "status": 400}
+            definition = json.loads(raw)
+            store[name] = dict(definition['featureset'], name=name) if 'featureset' in definition else definition
+            return 201, {"_id": name, "result": "created"}
+
+    def _features(self, index, doc_id, feature_set, keywords, active=None):
+        compiled = self._compiled.get(id(feature_set))
+        if compiled is None:
+            compiled = self._compiled[id(feature_set)] = [(feature['name'], compile_feature(feature['template']))
+                                                          for feature in feature_set['features']]
+        tokens = tokenize(keywords)
+        return [{"name": name, "value": fn(index, doc_id, tokens, keywords)} for name, fn in compiled
+                if active is None or name in active]
+
+    # search
+    def _search_response(self, name, body):
+        index = self.indices.get(self._resolve(name))
+        if index is None:
+            return 404, {"error": {"type": "index_not_found_exception", "index": name}, "status": 404}
+        try:
+            return 200, self._search(index, body)
+        except KeyError as e:
+            return 400, {"error": {"type": "resource_not_found_exception", "reason": str(e)}, "status": 400}
+
+    def _search(self, index, body):
+        start = time.perf_counter()
+        size = body.get('size', 10)
+        query = body.get('query', {})
+        log_specs = body.get('ext', {}).get('ltr_log', {}).get('log_specs')
+        filters = query.get('bool', {}).get('filter', [])
+        sltr = next((f['sltr'] for f in filters if 'sltr' in f), None)
+
+        if sltr is not None:
+            # feature logging: the judged ids filtered by terms, all with the same score
+            ids = next((f['terms']['_id'] for f in filters if 'terms' in f), list(index.docs))
+            scored = [(str(doc_id), 0.0) for doc_id in ids if str(doc_id) in index.docs][:size]
+            feature_set, keywords = self.feature_sets[sltr['featureset']], sltr['params']['keywords']
+        else:
+            keywords = json.dumps(query)
+            match = query.get('multi_match') or query.get('match') or {}
+            keywords = match.get('query', keywords) if isinstance(match, dict) else keywords
+            fields = match.get('fields') if isinstance(match, dict) else None
+            tokens = tokenize(keywords)
+            scores = defaultdict(float)
+            for token in tokens:
+                for doc_id, tf in index.postings.get(token, {}).items():
+                    scores[doc_id] += math.log1p(tf)
+            if fields:
+                scores = {doc_id: float(sum(math.log1p(tf) for tf in index.frequencies(doc_id, fields, tokens)))
+                          for doc_id in scores}
+                scores = {doc_id: score for doc_id, score in scores.items() if score > 0}
+            total = len(scores)
+            rescore = body.get('rescore')
+            window = rescore.get('window_size', 10) if rescore else 0
+            scored = heapq.nsmallest(max(size, window), scores.items(), key=lambda item: (-item[1], item[0]))
+            feature_set = None
+            if rescore:
+                model_query = rescore['query']['rescore_query']['sltr']
+                if 'model' in model_query:
+                    model = self.models[model_query['model']]
+                    feature_set, weights = model['feature_set'], model['weights']
+                else:
+                    # a feature set without a model computes the features but does not change the scores
+                    feature_set, weights = self.feature_sets[model_query['featureset']], {}
+                active = model_query.get('active_features')
+                rescored = []
+                for doc_id, score in scored[:window]:
+                    values = self._features(index, doc_id, feature_set, model_query['params']['keywords'], active)
+                    rescored.append((doc_id, score + sum(weights.get(v['name'], 0) * v['value'] for v in values)))
+                scored = sorted(rescored, key=lambda item: -item[1]) + scored[window:]
+            scored = scored[:size]
+
+        source = body.get('_source', True)
+        hits = []
+        for doc_id, score in scored:
+            hit = {"_index": "fake", "_id": doc_id, "_score": score}
+            document = index.docs[doc_id]
+            if source is True:
+                hit["_source"] = document
+            elif source:
+                hit["_source"] = {field: document[field] for field in source if field in document}
+            if log_specs is not None and feature_set is not None:
+                hit["fields"] = {"_ltrlog": [{log_specs['name']: self._features(index, doc_id, feature_set,
+                                                                                keywords)}]}
+            hits.append(hit)
+        return {"took": int((time.perf_counter() - start) * 1000), "timed_out": False,
+                "hits": {"total": {"value": total if sltr is None else len(hits), "relation": "eq"},
+                         "max_score": hits[0]["_score"] if hits else None, "hits": hits}}
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    server = FakeElasticsearch(port=int(argv[1]) if len(argv) > 1 else 9200,
+                               latency=float(argv[2]) if len(argv) > 2 else 0.0).start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
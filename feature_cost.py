@@ -0,0 +1,237 @@
+import json
+import time
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from features import read_features
+from metrics import exposure_ratio, ndcg
+from rerank import Reranker
+from search import first_phase_query
+from utils import Logger, Param, QueryTemplate, FEATURE_SET_FILE, FEATURE_SET_NAME, FEATURES_FILE, INDEX_NAME, \
+    MODEL_FILE, QUERIES_FILE
+
+
+@lru_cache(maxsize=16)
+def cost_template(window_size=None, first_phase="multi_match", fields=None, rescore=True):
+    """
+    Compiles the query used to time features: the first-phase query with the top hits rescored by the `sltr` query
+    of the feature set, restricted to `active_features`. Without `rescore` it is only the first-phase query, the
+    baseline the cost of the features is measured against.
+    :return:                a `QueryTemplate` with `keywords`, `feature_set` and `active_features` parameters
+    """
+    body = {"query": first_phase_query(first_phase, fields), "_source": False}
+    if rescore:
+        body["rescore"] = {
+            "query": {
+                "rescore_query": {
+                    "sltr": {
+                        "params": {
+                            "keywords": Param("keywords")
+                        },
+                        "featureset": Param("feature_set"),
+                        "active_features": Param("active_features"),
+                    }
+                }
+            }
+        }
+        if window_size is not None:
+            body["rescore"]["window_size"] = window_size
+    return QueryTemplate(body)
+
+
+def feature_kind(feature: dict):
+    """ names the kind of a feature after its template, e.g. `match_explorer:unique_terms_count` """
+    template = feature["template"]
+    if isinstance(template, str):
+        return "mustache"
+    (kind, spec), = template.items()
+    return "%s:%s" % (kind, spec["type"]) if kind == "match_explorer" and "type" in spec else kind
+
+
+def time_features(es, keywords: list, feature_set_name: str, variants: dict, index_name: str = INDEX_NAME,
+                  repeats=5, seed=42, **options):
+    """
+    Times the queries with different active features. The variants run round-robin in a shuffled order after a
+    warm-up round, so drifts of the cluster affect them alike.
+    :param es:                      Elasticsearch client
+    :param keywords:                the keywords of the timed queries
+    :param feature_set_name:        the name of the stored feature set
+    :param variants:                variant name -> the active features, None for the first-phase query only
+    :param repeats:                 the number of timed runs of every query and variant
+    :param options:                 the `window_size`, `first_phase` and `fields` of the search (see
+                                    `search.search_template`)
+    :return:                        dicts variant -> (queries x repeats) array of the latency and of the `took` in ms
+    """
+    baseline, rescored = cost_template(rescore=False, **options), cost_template(**options)
+    latency = {variant: np.zeros((len(keywords), repeats)) for variant in variants}
+    took = {variant: np.zeros((len(keywords), repeats)) for variant in variants}
+
+    rng = np.random.RandomState(seed)
+    names = list(variants)
+    for repeat in range(-1, repeats):
+        for i, kw in enumerate(keywords):
+            for variant in rng.permutation(names):
+                active = variants[variant]
+                body = baseline.render(keywords=kw) if active is None else \
+                    rescored.render(keywords=kw, feature_set=feature_set_name, active_features=active)
+                start = time.perf_counter()
+                response = es.search(index=index_name, body=body)
+                if repeat >= 0:
+                    latency[variant][i, repeat] = (time.perf_counter() - start) * 1000
+                    took[variant][i, repeat] = response.get("took", np.nan)
+        if repeat >= 0:
+            Logger.logger.info("*** Timed round %d of %d" % (repeat + 1, repeats))
+    return latency, took
+
+
+def _cost(samples: dict, variant: str):
+    """ the mean over the queries of the median time of a variant above the median time of the baseline """
+    return float(np.mean(np.maximum(np.median(samples[variant], axis=1) - np.median(samples["baseline"], axis=1),
+                                    0.0)))
+
+
+class _Ablation(object):
+    """ Scores the logged features with a model in which some features are switched off (weight 0) """
+
+    def __init__(self, reranker: Reranker, features: pd.DataFrame, protected_feature_name="1", k=10):
+        feature_names = features.columns.tolist()[2:-1]
+        if protected_feature_name not in feature_names:
+            raise ValueError("The name of the protected feature does not appear in the features file")
+        self.reranker = reranker
+        self.k = k
+        self.matrix = np.asarray(features.iloc[:, 2:-1], dtype=np.float64)[:, reranker._columns(feature_names)]
+        self.query_ids = np.asarray(features.iloc[:, 0])
+        self.judgements = np.asarray(features.iloc[:, -1], dtype=np.float64)
+        self.protected = np.asarray(features[protected_feature_name], dtype=np.float64) == 1
+
+    def evaluate(self, dropped=()):
+        """ returns the mean NDCG@k and exposure ratio@k with the dropped features switched off """
+        omega = np.where(np.isin(self.reranker.feature_names, list(dropped)), 0.0, self.reranker.omega)
+        scores = self.matrix.dot(omega)
+        with np.errstate(invalid='ignore'):
+            return (float(np.nanmean(ndcg(self.query_ids, scores, self.judgements, self.k))),
+                    float(np.nanmean(exposure_ratio(self.query_ids, scores, self.protected, self.k))))
+
+    def importance(self):
+        """ returns the spread of the score contribution of every feature, |weight| x deviation of the feature """
+        return dict(zip(self.reranker.feature_names, np.abs(self.reranker.omega) * self.matrix.std(axis=0)))
+
+
+def prune(ablation: _Ablation, costs: dict, protected_feature_name="1", max_loss=0.01):
+    """
+    Greedily switches off the most expensive feature whose removal keeps the NDCG@k within `max_loss` of the full
+    model, until no feature fits the budget. The protected feature is always kept. The weights are not retrained,
+    so the loss is an upper bound of the loss of a model retrained on the kept features.
+    :param ablation:                the logged features and the model
+    :param costs:                   feature name -> cost in ms
+    :param max_loss:                the accuracy budget, the largest allowed drop of the mean NDCG@k
+    :return:                        list of (feature name, NDCG@k, exposure ratio@k) after every pruned feature
+    """
+    full, _ = ablation.evaluate()
+    dropped, steps = [], []
+    while True:
+        best = None
+        for name, cost in costs.items():
+            if name == protected_feature_name or name in dropped:
+                continue
+            score, exposure = ablation.evaluate(dropped + [name])
+            if full - score <= max_loss and (best is None or (cost, score) > (costs[best[0]], best[1])):
+                best = (name, score, exposure)
+        if best is None:
+            return steps
+        dropped.append(best[0])
+        steps.append(best)
+        Logger.logger.info("*** Pruned feature %s (%.2fms): NDCG %.4f" % (best[0], costs[best[0]], best[1]))
+
+
+def feature_cost(es, feature_set_file: str = FEATURE_SET_FILE, feature_set_name: str = FEATURE_SET_NAME,
+                 model_file: str = MODEL_FILE, features_file: str = FEATURES_FILE, queries_file: str = QUERIES_FILE,
+                 index_name: str = INDEX_NAME, sample_queries=50, repeats=5, protected_feature_name="1", k=10,
+                 max_loss=0.01, report_file=None, pruned_feature_set_file=None, seed=42, **options):
+    """
+    Attributes the query time of the LTR rescoring to the features of a feature set, joins it with the weights of a
+    trained model and suggests the cheapest feature set that stays within an accuracy budget
+    :param es:                      Elasticsearch client
+    :param feature_set_file:        the feature set JSON, which defines the features
+    :param feature_set_name:        the (versioned) name under which the feature set is stored
+    :param model_file:              the model JSON file (see `rerank.Reranker.from_files`)
+    :param features_file:           the logged features of the judged queries, to measure the accuracy
+    :param queries_file:            the queries CSV, a sample of its queries is timed
+    :param sample_queries:          the number of timed queries
+    :param repeats:                 the number of timed runs of every query and feature
+    :param k:                       cut-off of the metrics
+    :param max_loss:                the largest allowed drop of the mean NDCG@k of the pruned feature set
+    :param report_file:             CSV file where the per-feature report is written (optional)
+    :param pruned_feature_set_file: file where the pruned feature set JSON is written (optional)
+    :param options:                 the `window_size`, `first_phase` and `fields` of the search
+    :return:                        (report data frame, pruned feature set dict)
+    """
+    with open(feature_set_file) as f:
+        feature_set = json.load(f)
+    definitions = feature_set["featureset"]["features"]
+    feature_names = [feature["name"] for feature in definitions]
+
+    queries = pd.read_csv(queries_file)
+    sample = queries.sample(min(sample_queries, len(queries)), random_state=seed) if sample_queries else queries
+    keywords = sample["keywords"].tolist()
+    Logger.logger.info("*** Timing %d features on %d queries" % (len(feature_names), len(keywords)))
+    variants = {"baseline": None, "all": feature_names}
+    variants.update((name, [name]) for name in feature_names)
+    latency, took = time_features(es, keywords, feature_set_name, variants, index_name, repeats, seed, **options)
+    costs = {name: _cost(latency, name) for name in feature_names}
+
+    reranker = Reranker.from_files(model_file)
+    weights = dict(zip(reranker.feature_names, reranker.omega))
+    ablation = _Ablation(reranker, read_features(features_file), protected_feature_name, k)
+    importance = ablation.importance()
+    full_ndcg, full_exposure = ablation.evaluate()
+    steps = prune(ablation, costs, protected_feature_name, max_loss)
+    pruned = [name for name, _, _ in steps]
+
+    total = sum(costs.values())
+    report = pd.DataFrame([{
+        "feature": name,
+        "kind": feature_kind(feature),
+        "cost_ms": costs[name],
+        "cost_took_ms": _cost(took, name),
+        "cost_share": costs[name] / total if total else 0.0,
+        "weight": weights.get(name, 0.0),
+        "importance": importance.get(name, 0.0),
+        "ndcg_without": ablation.evaluate([name])[0],
+        "pruned": name in pruned,
+        "prune_order": pruned.index(name) + 1 if name in pruned else None,
+    } for name, feature in zip(feature_names, definitions)])
+
+    kept = {"featureset": dict(feature_set["featureset"],
+                               features=[feature for feature in definitions if feature["name"] not in pruned])}
+    Logger.logger.info(report.to_string(index=False, float_format=lambda v: "%.4f" % v))
+    Logger.logger.info("*** All features: +%.2fms over the first phase, NDCG@%d %.4f, exposure ratio %.4f"
+                       % (_cost(latency, "all"), k, full_ndcg, full_exposure))
+    if steps:
+        # the single feature costs include the fixed cost of rescoring, so the pruned set is timed as a whole
+        latency, _ = time_features(es, keywords, feature_set_name,
+                                   {"baseline": None, "all": feature_names,
+                                    "pruned": [feature["name"] for feature in kept["featureset"]["features"]]},
+                                   index_name, repeats, seed, **options)
+        Logger.logger.info("*** Pruned %s: +%.2fms instead of +%.2fms over the first phase, NDCG@%d %.4f, exposure "
+                           "ratio %.4f (weights not retrained)"
+                           % (", ".join(pruned), _cost(latency, "pruned"), _cost(latency, "all"), k, steps[-1][1],
+                              steps[-1][2]))
+    else:
+        Logger.logger.info("*** No feature can be pruned within an NDCG@%d loss of %s" % (k, max_loss))
+
+    if report_file:
+        report.to_csv(report_file, index=False)
+    if pruned_feature_set_file:
+        with open(pruned_feature_set_file, 'w') as f:
+            json.dump(kept, f, indent=2)
+    return report, kept
+
+
+if __name__ == "__main__":
+    from utils import elastic_connection
+
+    feature_cost(elastic_connection(), report_file="feature_cost.csv",
+                 pruned_feature_set_file="features_pruned.json")
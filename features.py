@@ -0,0 +1,222 @@
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+from utils import Logger, FEATURES_FILE
+
+ID_COLUMNS = ["query_id", "document_id"]
+JUDGEMENT_COLUMN = "judgement"
+
+# extensions of the files that are stored in the Arrow IPC (Feather v2) format, everything else is a CSV
+ARROW_EXTENSIONS = (".arrow", ".feather", ".ipc")
+
+
+def features_format(features_file: str):
+    """ returns the format (`arrow` or `csv`) of a features file based on its extension """
+    return "arrow" if features_file.lower().endswith(ARROW_EXTENSIONS) else "csv"
+
+
+def _require_arrow():
+    if pa is None:
+        raise ImportError("pyarrow is required to read or write features in the Arrow format, "
+                          "install it with `pip install pyarrow`")
+
+
+class FeaturesWriter(object):
+    """
+    Writes the logged features of the training queries. Rows are buffered and appended to the file in batches
+    as the logging responses arrive. The output is either a CSV file (the original text format) or an Arrow IPC
+    file with int64 query ids, float32/float64 feature values, int64 judgements (as read back from a CSV file)
+    and optional lz4/zstd compression.
+    """
+
+    def __init__(self, features_file: str = FEATURES_FILE, value_type="float64", compression=None,
+                 batch_rows=65536, file_format=None):
+        """
+        :param features_file:           the file path where the features will be written
+        :param value_type:              `float32` or `float64`, the type of the stored feature values (Arrow only)
+        :param compression:             `lz4`, `zstd` or None (Arrow only)
+        :param batch_rows:              number of rows buffered before a record batch is written
+        :param file_format:             `arrow` or `csv`, detected from the file extension if not set
+        """
+        self._features_file = features_file
+        self._format = file_format or features_format(features_file)
+        self._value_type = np.dtype(value_type)
+        self._compression = compression
+        self._batch_rows = batch_rows
+
+        if self._format == "arrow":
+            _require_arrow()
+        elif self._format != "csv":
+            raise ValueError("Unknown features file format `%s`" % self._format)
+
+        self._feature_names = None
+        self._file = None
+        self._writer = None
+        self._rows = 0
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def rows(self):
+        """ number of rows written so far """
+        return self._rows
+
+    def write(self, query_id, document_ids: list, feature_names: list, feature_values: list, judgements: list):
+        """
+        Appends the features logged for one query
+        :param query_id:                the id of the query
+        :param document_ids:            the ids of the logged documents
+        :param feature_names:           the names of the features, in the same order as the values
+        :param feature_values:          list with a list of feature values for every document
+        :param judgements:              the judgement for every document
+        """
+        if not document_ids:
+            return
+        if self._feature_names is None:
+            self._open(feature_names)
+        elif list(feature_names) != self._feature_names:
+            raise ValueError("Feature names of query %s do not match the names of the previous queries" % query_id)
+
+        self._buffer[0].extend([query_id] * len(document_ids))
+        self._buffer[1].extend(document_ids)
+        self._buffer[2].extend(feature_values)
+        self._buffer[3].extend(judgements)
+        self._rows += len(document_ids)
+
+        if len(self._buffer[0]) >= self._batch_rows:
+            self._flush()
+
+    def close(self):
+        if self._buffer is not None:
+            self._flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open(self, feature_names):
+        self._feature_names = list(feature_names)
+        self._buffer = ([], [], [], [])
+
+        if self._format == "csv":
+            self._file = open(self._features_file, 'w')
+            self._file.write(",".join(ID_COLUMNS + self._feature_names + [JUDGEMENT_COLUMN]) + "\n")
+        else:
+            value_type = pa.from_numpy_dtype(self._value_type)
+            self._schema = pa.schema([pa.field("query_id", pa.int64()), pa.field("document_id", pa.string())] +
+                                     [pa.field(name, value_type) for name in self._feature_names] +
+                                     [pa.field(JUDGEMENT_COLUMN, pa.int64())])
+            options = pa.ipc.IpcWriteOptions(compression=self._compression)
+            self._file = pa.OSFile(self._features_file, 'wb')
+            self._writer = pa.ipc.new_file(self._file, self._schema, options=options)
+
+    def _flush(self):
+        query_ids, document_ids, feature_values, judgements = self._buffer
+        if not query_ids:
+            return
+
+        if self._format == "csv":
+            self._file.write("".join(["{0},{1},{2},{3}\n".format(q_id, doc_id, ",".join([str(v) for v in values]),
+                                                                  judgement)
+                                      for q_id, doc_id, values, judgement in zip(*self._buffer)]))
+        else:
+            matrix = np.asarray(feature_values, dtype=self._value_type).reshape(len(query_ids), -1)
+            columns = [pa.array(query_ids, type=pa.int64()), pa.array([str(d) for d in document_ids], pa.string())] + \
+                      [pa.array(matrix[:, i]) for i in range(matrix.shape[1])] + \
+                      [pa.array(judgements, type=pa.int64())]
+            self._writer.write_batch(pa.record_batch(columns, schema=self._schema))
+
+        self._buffer = ([], [], [], [])
+
+
+def read_features(features_file: str = FEATURES_FILE):
+    """
+    Reads a features file written by `FeaturesWriter`. Arrow files are memory-mapped instead of parsed, but
+    `to_pandas` still copies the columns (and decompresses a compressed file) into the data frame.
+    :param features_file:           the features file path
+    :return:                        data frame with the query id, document id, feature and judgement columns
+    """
+    if features_format(features_file) == "csv":
+        return pd.read_csv(features_file)
+
+    _require_arrow()
+    with pa.memory_map(features_file, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas()
+
+
+def _whole_queries(frames):
+    """ regroups data frames so that the rows of a query are never split over two of them """
+    carry = None
+    for frame in frames:
+        if carry is not None:
+            frame = pd.concat([carry, frame], ignore_index=True)
+        if len(frame) == 0:
+            continue
+        last = frame.iloc[:, 0].to_numpy() == frame.iloc[-1, 0]
+        carry = frame[last]
+        if not last.all():
+            yield frame[~last]
+    if carry is not None and len(carry):
+        yield carry
+
+
+def iter_features(features_file: str = FEATURES_FILE, chunk_rows=1000000):
+    """
+    Reads a features file in chunks of about `chunk_rows` rows, to process files that do not fit in memory.
+    The rows of a query are never split over two chunks, which requires the rows to be grouped by query as
+    `FeaturesWriter` writes them.
+    :param features_file:           the features file path
+    :param chunk_rows:              the number of rows read at once
+    :return:                        generator of data frames like the one returned by `read_features`
+    """
+    if features_format(features_file) == "csv":
+        yield from _whole_queries(pd.read_csv(features_file, chunksize=chunk_rows))
+        return
+
+    _require_arrow()
+
+    def batches():
+        with pa.memory_map(features_file, 'r') as source:
+            reader = pa.ipc.open_file(source)
+            pending, rows = [], 0
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                pending.append(batch)
+                rows += batch.num_rows
+                if rows >= chunk_rows:
+                    yield pa.Table.from_batches(pending).to_pandas()
+                    pending, rows = [], 0
+            if pending:
+                yield pa.Table.from_batches(pending).to_pandas()
+
+    yield from _whole_queries(batches())
+
+
+def export_csv(features_file: str, csv_file: str):
+    """
+    Exports an Arrow features file to the CSV format
+    :param features_file:           the Arrow features file path
+    :param csv_file:                the CSV file path
+    """
+    read_features(features_file).to_csv(csv_file, index=False)
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    export_csv(argv[1], argv[2])
+    Logger.logger.info("Exported %s to %s" % (argv[1], argv[2]))
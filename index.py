@@ -1,49 +1,367 @@
+import gzip
+import hashlib
 import json
-from os import listdir
-from os.path import isfile, join
+import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from os import listdir, replace, stat
+from os.path import exists, isfile, join
+from time import gmtime, strftime, time
 
 import elasticsearch.helpers
 
-from utils import Logger, elastic_connection, INDEX_NAME, DOCUMENT_DIR
+from utils import Logger, Profiler, batches, elastic_connection, ordered_map, INDEX_NAME, DOCUMENT_DIR
 
+NDJSON_EXTENSIONS = (".ndjson", ".jsonl")
 
-def create_document_list(document_dir=DOCUMENT_DIR):
-    """ returns a list of JSON files in the directory """
 
-    for f in listdir(document_dir):
-        if isfile(join(document_dir, f)) and f.endswith(".json"):
-            try:
-                with open(join(document_dir, f)) as f_json:
-                    yield json.load(f_json)
-            except Exception as e:
-                Logger.logger.info("Failed to parse %s due to %s" % (f, str(e)))
-                continue
+class IndexingStats(object):
+    """ Counts the indexed documents, bytes and failures and periodically logs the throughput """
 
+    def __init__(self, report_every=10):
+        """
+        :param report_every:        number of seconds between two throughput reports
+        """
+        self.docs = 0
+        self.bytes = 0
+        self.failures = 0
+        self._report_every = report_every
+        self._start = time()
+        self._last_report = self._start
 
-def reindex(es_connection, analysis_settings=None, mapping_settings=None, document_list=None, index=INDEX_NAME):
-    """ Index/reindex the documents."""
-    if document_list is None:
-        document_list = {}
-    if mapping_settings is None:
-        mapping_settings = {}
-    if analysis_settings is None:
-        analysis_settings = {}
+    def add(self, docs, failures=0):
+        self.docs += docs
+        self.failures += failures
+        if time() - self._last_report >= self._report_every:
+            self.report()
+
+    def report(self, prefix="***"):
+        now = time()
+        elapsed = max(now - self._start, 1e-9)
+        Logger.logger.info("%s %d docs, %.1f MB read, %d failures in %.1fs (%.1f docs/s, %.2f MB/s)"
+                           % (prefix, self.docs, self.bytes / 1e6, self.failures, elapsed, self.docs / elapsed,
+                              self.bytes / 1e6 / elapsed))
+        self._last_report = now
+
+
+def _parse(name, stream, stats):
+    """ parses the documents of an open binary file, NDJSON files are streamed line by line """
+    if name.endswith(NDJSON_EXTENSIONS):
+        for line in stream:
+            if stats is not None:
+                stats.bytes += len(line)
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raw = stream.read()
+        if stats is not None:
+            stats.bytes += len(raw)
+        yield json.loads(raw)
+
+
+def _is_document_file(f):
+    return f.endswith((".zip", ".json") + NDJSON_EXTENSIONS) or \
+        (f.endswith(".gz") and f[:-3].endswith((".json",) + NDJSON_EXTENSIONS))
+
+
+def document_sources(document_dir=DOCUMENT_DIR):
+    """ returns a dict with the modification time and size of every document file in the directory """
+    sources = {}
+    for f in sorted(listdir(document_dir)):
+        path = join(document_dir, f)
+        if isfile(path) and _is_document_file(f):
+            info = stat(path)
+            sources[f] = {"mtime": info.st_mtime, "size": info.st_size}
+    return sources
+
+
+def read_documents(document_dir=DOCUMENT_DIR, stats=None, sources=None):
+    """
+    returns (file name, document) for the documents in the directory
+    :param document_dir:        the directory with the documents
+    :param stats:               `IndexingStats` that count the bytes read (optional)
+    :param sources:             names of the files to read, all document files are read if not set (optional)
+    """
+    for f in sorted(listdir(document_dir)) if sources is None else sorted(sources):
+        path = join(document_dir, f)
+        if not isfile(path):
+            continue
+        try:
+            if f.endswith(".zip"):
+                with zipfile.ZipFile(path) as archive:
+                    for member in archive.namelist():
+                        if member.endswith((".json",) + NDJSON_EXTENSIONS):
+                            try:
+                                with archive.open(member) as f_member:
+                                    for document in _parse(member, f_member, stats):
+                                        yield f, document
+                            except ValueError as e:
+                                Logger.logger.info("Failed to parse %s in %s due to %s" % (member, f, str(e)))
+            elif f.endswith(".gz") and f[:-3].endswith((".json",) + NDJSON_EXTENSIONS):
+                with gzip.open(path, 'rb') as f_gz:
+                    for document in _parse(f[:-3], f_gz, stats):
+                        yield f, document
+            elif f.endswith((".json",) + NDJSON_EXTENSIONS):
+                with open(path, 'rb') as f_json:
+                    for document in _parse(f, f_json, stats):
+                        yield f, document
+        except Exception as e:
+            Logger.logger.info("Failed to parse %s due to %s" % (f, str(e)))
+            continue
+
+
+def create_document_list(document_dir=DOCUMENT_DIR, stats=None):
+    """
+    returns the documents in the directory, read from JSON files, NDJSON files (.ndjson, .jsonl), their gzip'd
+    versions (.gz) and ZIP archives with any of those
+    :param document_dir:        the directory with the documents
+    :param stats:               `IndexingStats` that count the bytes read (optional)
+    """
+    for _, document in read_documents(document_dir, stats):
+        yield document
 
+
+@Profiler.timed("bulk_chunk")
+def _index_chunk(es_connection, actions, chunk_bytes, max_retries, initial_backoff):
+    """ sends the actions with `streaming_bulk`, which retries the documents rejected with 429 """
+    indexed, failures = 0, []
+    for ok, item in elasticsearch.helpers.streaming_bulk(es_connection, actions, chunk_size=len(actions),
+                                                          max_chunk_bytes=chunk_bytes, raise_on_error=False,
+                                                          raise_on_exception=False, max_retries=max_retries,
+                                                          initial_backoff=initial_backoff):
+        # deleting a document that is already gone is not a failure
+        if ok or item.get("delete", {}).get("status") == 404:
+            indexed += 1
+        else:
+            failures.append(item)
+    return indexed, failures
+
+
+def _index_settings(analysis_settings, mapping_settings, shards, replicas, refresh_interval=None):
     settings = {
         "settings": {
-            "number_of_shards": 1,
-            "number_of_replicas": 0,
+            "number_of_shards": shards,
+            "number_of_replicas": replicas,
             "index": {
-                "analysis": analysis_settings,
+                "analysis": analysis_settings or {},
             }}}
+    if refresh_interval is not None:
+        settings['settings']['index']['refresh_interval'] = refresh_interval
 
     if mapping_settings:
         settings['mappings'] = mapping_settings  # C
+    return settings
+
+
+def send_actions(es_connection, actions, chunk_docs=500, chunk_bytes=10 * 1024 * 1024, threads=1, max_retries=3,
+                 initial_backoff=2, stats=None):
+    """ Sends bulk actions to Elasticsearch.
+    :param actions:                 the bulk actions
+    :param chunk_docs:              maximum number of documents in a bulk request
+    :param chunk_bytes:             maximum size of a bulk request in bytes
+    :param threads:                 number of bulk requests sent in parallel
+    :param max_retries:             number of times a document rejected with 429 (Too Many Requests) is retried
+    :param initial_backoff:         seconds to wait before the first retry, doubled on every retry
+    :param stats:                   `IndexingStats` that count the indexed documents (optional)
+    :return:                        the stats and the failed bulk items
+    """
+    if stats is None:
+        stats = IndexingStats()
+    all_failures = []
+
+    def index_chunk(chunk):
+        return _index_chunk(es_connection, chunk, chunk_bytes, max_retries, initial_backoff)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for indexed, failures in ordered_map(executor, index_chunk, batches(actions, chunk_docs), threads * 2):
+            for failure in failures[:3]:
+                Logger.logger.error("Failed to index document: %s" % json.dumps(failure))
+            stats.add(indexed, len(failures))
+            all_failures.extend(failures)
+
+    stats.report("*** Done:")
+    Profiler.count("index.docs", stats.docs)
+    Profiler.count("index.bytes_read", stats.bytes)
+    Profiler.count("index.failures", stats.failures)
+    return stats, all_failures
+
+
+def bulk_load(es_connection, document_list, index, **bulk_options):
+    """ Sends the documents to an existing index with bulk requests.
+    :param bulk_options:            options of `send_actions`
+    """
+    return send_actions(es_connection, bulk_docs(document_list, index), **bulk_options)[0]
+
+
+@Profiler.timed("reindex")
+def reindex(es_connection, analysis_settings=None, mapping_settings=None, document_list=None, index=INDEX_NAME,
+            shards=1, replicas=0, **bulk_options):
+    """ Index/reindex the documents. The index is deleted and created again before the documents are loaded,
+    see `reindex_with_alias` for a reindex without downtime.
+    :param shards:                  number of primary shards of the index
+    :param replicas:                number of replicas of the index
+    :param bulk_options:            options of `bulk_load`
+    """
+    if document_list is None:
+        document_list = {}
+    if es_connection.indices.exists_alias(name=index):
+        raise ValueError("%s is an alias, reindex it with `reindex_with_alias`" % index)
 
     es_connection.indices.delete(index, ignore=[400, 404])
-    es_connection.indices.create(index, body=settings)
+    es_connection.indices.create(index, body=_index_settings(analysis_settings, mapping_settings, shards, replicas))
+
+    return bulk_load(es_connection, document_list, index, **bulk_options)
+
+
+def index_generations(es_connection, alias=INDEX_NAME):
+    """ returns the names of the timestamped indices built for the alias, newest first """
+    pattern = re.compile(r"^%s-\d{14}$" % re.escape(alias))
+    return sorted([name for name in es_connection.indices.get("%s-*" % alias) if pattern.match(name)], reverse=True)
+
+
+@Profiler.timed("reindex_with_alias")
+def reindex_with_alias(es_connection, analysis_settings=None, mapping_settings=None, document_list=None,
+                       alias=INDEX_NAME, shards=1, replicas=0, refresh_interval="1s", force_merge=False,
+                       keep_generations=2, **bulk_options):
+    """ Index/reindex the documents without downtime. The documents are loaded in a new timestamped index with
+    refresh and replicas disabled. Once loaded, the settings are restored and the alias is atomically moved to the
+    new index, so searches on the alias keep hitting the previous index during the load.
+    :param alias:                   name of the alias searches go to. An existing index with this name is replaced
+                                    by the alias.
+    :param shards:                  number of primary shards of the new index
+    :param replicas:                number of replicas of the new index, added after the load
+    :param refresh_interval:        refresh interval of the new index, set after the load
+    :param force_merge:             whether to merge the new index to a single segment before the alias is moved
+    :param keep_generations:        number of indices kept for the alias (including the new one), older ones are
+                                    deleted
+    :param bulk_options:            options of `send_actions`
+    :return:                        the name of the new index
+    :raises RuntimeError:           if a document failed to load, the new index is deleted and the alias not moved
+    """
+    if document_list is None:
+        document_list = {}
+
+    index = "%s-%s" % (alias, strftime("%Y%m%d%H%M%S", gmtime()))
+    Logger.logger.info("*** Building %s" % index)
+    es_connection.indices.create(index, body=_index_settings(analysis_settings, mapping_settings, shards, 0, "-1"))
+
+    try:
+        stats, failures = send_actions(es_connection, bulk_docs(document_list, index), **bulk_options)
+        if failures:
+            # the alias must not move to a partly loaded index, the old generations may be deleted afterwards
+            raise RuntimeError("%d of %d documents failed to load in %s, the alias %s is not moved"
+                               % (len(failures), stats.docs + len(failures), index, alias))
+
+        es_connection.indices.put_settings(index=index, body={"index": {"refresh_interval": refresh_interval,
+                                                                        "number_of_replicas": replicas}})
+        es_connection.indices.refresh(index)
+        if force_merge:
+            Logger.logger.info("*** Force merging %s" % index)
+            es_connection.indices.forcemerge(index, max_num_segments=1, request_timeout=3600)
+        es_connection.cluster.health(index=index, wait_for_status="yellow", request_timeout=600)
+    except Exception:
+        es_connection.indices.delete(index, ignore=[404])
+        raise
+
+    # move the alias in one atomic request, replacing a concrete index with the name of the alias
+    actions = [{"add": {"index": index, "alias": alias}}]
+    if es_connection.indices.exists_alias(name=alias):
+        actions.insert(0, {"remove": {"index": "*", "alias": alias}})
+    elif es_connection.indices.exists(alias):
+        actions.append({"remove_index": {"index": alias}})
+    es_connection.indices.update_aliases(body={"actions": actions})
+    Logger.logger.info("*** Alias %s points to %s" % (alias, index))
+
+    for old_index in index_generations(es_connection, alias)[keep_generations:]:
+        if old_index != index:
+            Logger.logger.info("*** Deleting old generation %s" % old_index)
+            es_connection.indices.delete(old_index, ignore=[404])
+
+    return index
+
+
+def _content_hash(document):
+    return hashlib.sha1(json.dumps(document, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+@Profiler.timed("reindex_delta")
+def reindex_delta(es_connection, document_dir=DOCUMENT_DIR, index=INDEX_NAME, manifest_file=None,
+                  analysis_settings=None, mapping_settings=None, shards=1, replicas=0, stats=None, **bulk_options):
+    """ Indexes only the documents that changed since the last run. A local manifest keeps the content hash and
+    the source file of every indexed document, and the modification time and size of every source file. Files that
+    did not change are not read at all, new or changed documents are indexed and documents that disappeared from
+    their source files are deleted.
+    :param manifest_file:           the manifest file path, `<index>.manifest.json` if not set
+    :param bulk_options:            options of `send_actions`
+    :return:                        number of indexed and deleted documents
+    """
+    if manifest_file is None:
+        manifest_file = "%s.manifest.json" % index
+    manifest = {"index": index, "sources": {}, "documents": {}}
+    if exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest.get("index") != index:
+            raise ValueError("The manifest %s belongs to the index %s" % (manifest_file, manifest.get("index")))
+
+    if not es_connection.indices.exists(index):
+        es_connection.indices.create(index, body=_index_settings(analysis_settings, mapping_settings, shards,
+                                                                 replicas))
+        manifest["sources"], manifest["documents"] = {}, {}
+
+    sources = document_sources(document_dir)
+    changed = [f for f, info in sources.items() if manifest["sources"].get(f) != info]
+    documents = manifest["documents"]
+    Logger.logger.info("*** %d of %d source files changed" % (len(changed), len(sources)))
+
+    seen = set()
+    updated = {}
+
+    def index_actions():
+        for source, document in read_documents(document_dir, stats, changed):
+            doc_id = document.get("id", None)
+            if doc_id is None:
+                Logger.logger.info("Skipping a document without id in %s" % source)
+                continue
+            seen.add(doc_id)
+            content_hash = _content_hash(document)
+            if documents.get(doc_id, {}).get("hash") != content_hash:
+                updated[doc_id] = {"hash": content_hash, "source": source}
+                yield {"_index": index, "_id": doc_id, "_type": "_doc", "_source": document}
+            else:
+                documents[doc_id]["source"] = source
+
+        # documents of changed or removed files that were not seen again
+        for doc_id, entry in list(documents.items()):
+            if doc_id not in seen and (entry["source"] in changed or entry["source"] not in sources):
+                updated[doc_id] = None
+                yield {"_op_type": "delete", "_index": index, "_id": doc_id, "_type": "_doc"}
+
+    stats, failures = send_actions(es_connection, index_actions(), stats=stats, **bulk_options)
+
+    # failed documents are sent again on the next run: their hash is not stored and their file is read again
+    failed = set()
+    for failure in failures:
+        for item in failure.values():
+            failed.add(item.get("_id"))
+    for doc_id, entry in updated.items():
+        if doc_id in failed:
+            if entry is not None:
+                documents.pop(doc_id, None)
+        elif entry is None:
+            documents.pop(doc_id, None)
+        else:
+            documents[doc_id] = entry
+    manifest["sources"] = {f: info for f, info in sources.items() if not (failed and f in changed)}
+
+    with open(manifest_file + ".tmp", 'w') as f:
+        json.dump(manifest, f)
+    replace(manifest_file + ".tmp", manifest_file)
 
-    elasticsearch.helpers.bulk(es_connection, bulk_docs(document_list, index))
+    deleted = sum(1 for entry in updated.values() if entry is None)
+    Logger.logger.info("*** %d documents indexed, %d deleted, %d failed" % (len(updated) - deleted, deleted,
+                                                                             len(failed)))
+    return len(updated) - deleted, deleted
 
 
 def bulk_docs(document_list, index):
@@ -54,10 +372,9 @@ def bulk_docs(document_list, index):
                    "_type": "_doc",
                    "_source": document}
         yield add_cmd
-        if 'id' in document:
-            Logger.logger.info("%s added to %s" % (document['id'].encode('utf-8'), index))
 
 
 if __name__ == "__main__":
     es = elastic_connection(timeout=30)
-    reindex(es, document_list=create_document_list(DOCUMENT_DIR))
+    stats = IndexingStats()
+    reindex(es, document_list=create_document_list(DOCUMENT_DIR, stats), stats=stats)
@@ -0,0 +1,61 @@
+import pandas as pd
+
+from utils import JUDGMENTS_FILE
+
+
+class JudgementStore(object):
+    """
+    Lookup structure for the training judgements. The judgements are grouped by query once, so that
+    the judged document ids for a query and the judgement of a (query, document) pair can be read
+    without scanning the whole judgements table.
+    """
+
+    def __init__(self, judgements: pd.DataFrame):
+        """
+        :param judgements:          data frame with `query_id`, `document_id` and `judgement` columns
+        """
+        self._ids = {}
+        self._judgements = {}
+
+        for q_id, group in judgements.groupby('query_id', sort=False):
+            per_query = {}
+            for doc_id, judgement in zip(group['document_id'].tolist(), group['judgement'].tolist()):
+                # keep the first judgement when a pair is judged more than once
+                per_query.setdefault(doc_id, judgement)
+            self._judgements[q_id] = per_query
+            self._ids[q_id] = list(per_query)
+
+    @classmethod
+    def from_csv(cls, judgments_file: str = JUDGMENTS_FILE):
+        """
+        Creates the store from a judgements CSV file
+        :param judgments_file:      path to a CSV with `query_id`, `document_id` and `judgement` columns
+        :return:
+        """
+        return cls(pd.read_csv(judgments_file, usecols=['query_id', 'document_id', 'judgement']))
+
+    def __len__(self):
+        return sum(len(per_query) for per_query in self._judgements.values())
+
+    def __contains__(self, query_id):
+        return query_id in self._judgements
+
+    def query_ids(self):
+        """ returns the ids of all judged queries """
+        return list(self._judgements)
+
+    def ids(self, query_id):
+        """
+        :param query_id:            the query id
+        :return:                    list with the judged document ids for the query (empty if not judged)
+        """
+        return self._ids.get(query_id, [])
+
+    def judgement(self, query_id, document_id, default=None):
+        """
+        :param query_id:            the query id
+        :param document_id:         the document id
+        :param default:             value returned when the pair is not judged
+        :return:                    the judgement for the (query, document) pair
+        """
+        return self._judgements.get(query_id, {}).get(document_id, default)
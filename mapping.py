@@ -0,0 +1,128 @@
+import json
+import re
+
+from utils import Logger, FEATURE_SET_FILE
+
+# queries on analyzed text, their fields are mapped as `text`
+TEXT_QUERIES = ("match", "match_phrase", "match_phrase_prefix", "match_bool_prefix")
+# queries on exact values, their fields are mapped as indexed `keyword` without doc values
+TERM_QUERIES = ("term", "terms", "prefix", "wildcard", "fuzzy", "regexp")
+PHRASE_QUERIES = ("match_phrase", "match_phrase_prefix")
+# fields read by scripts, which need doc values
+DOC_FIELD = re.compile(r"doc\[['\"]([^'\"]+)['\"]\]")
+# the `ignore_above` of the keyword fields of the dynamic mapping, kept so scripts see the same values
+IGNORE_ABOVE = 256
+
+
+class QueriedFields(object):
+    """ The fields a set of queries reads, by how they are read """
+
+    def __init__(self):
+        self.text = set()
+        self.phrase = set()
+        self.keyword = set()
+        self.doc_values = set()
+
+    def add_query(self, query):
+        """ collects the fields of a query clause, recursing into compound queries """
+        if isinstance(query, list):
+            for item in query:
+                self.add_query(item)
+            return
+        if isinstance(query, str):
+            self.doc_values.update(DOC_FIELD.findall(query))
+            return
+        if not isinstance(query, dict):
+            return
+        for key, value in query.items():
+            if key == "multi_match" and isinstance(value, dict):
+                fields = {field.split('^')[0] for field in value.get("fields", ["*"])}
+                self.text.update(fields)
+                if value.get("type") in ("phrase", "phrase_prefix"):
+                    self.phrase.update(fields)
+            elif key in TEXT_QUERIES and isinstance(value, dict):
+                self.text.update(value)
+                if key in PHRASE_QUERIES:
+                    self.phrase.update(value)
+            elif key in TERM_QUERIES and isinstance(value, dict):
+                self.keyword.update(field for field in value if field != "boost")
+            else:
+                self.add_query(value)
+
+    def add_feature_set(self, feature_set: dict):
+        for feature in feature_set["featureset"]["features"]:
+            template = feature["template"]
+            if isinstance(template, str):
+                Logger.logger.warning("*** The fields of the mustache template of feature %s are not mapped, add them "
+                                      "to the mapping by hand" % feature["name"])
+                continue
+            self.add_query(template)
+
+
+def _put(properties: dict, path: str, spec: dict):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        properties = properties.setdefault(part, {}).setdefault("properties", {})
+    properties.setdefault(parts[-1], {}).update(spec)
+
+
+def _put_keyword(properties: dict, field: str, fields: QueriedFields):
+    spec = {"type": "keyword", "index": field in fields.keyword, "doc_values": field in fields.doc_values,
+            "ignore_above": IGNORE_ABOVE}
+    parent, _, sub = field.rpartition('.')
+    if sub != "keyword" or not parent:
+        _put(properties, field, spec)
+        return
+    # the `.keyword` field of the dynamic mapping, the parent is only indexed if a query reads it
+    if parent not in fields.text and parent not in fields.keyword:
+        _put(properties, parent, {"type": "keyword", "index": False, "doc_values": False,
+                                  "ignore_above": IGNORE_ABOVE})
+    _put(properties, parent, {"fields": {"keyword": spec}})
+
+
+def lean_mapping(feature_set_file: str = FEATURE_SET_FILE, search_fields=None, first_phase="multi_match"):
+    """
+    Creates an explicit mapping that indexes only the fields the features and the first-phase query read. The
+    mapping is not dynamic, so the other fields are kept in `_source` but not indexed. The text fields keep no
+    positions unless a phrase query reads them, and only the fields read by scripts get doc values. The queried
+    fields are analyzed as with the dynamic mapping, so the features keep their values.
+    :param feature_set_file:        the feature set JSON
+    :param search_fields:           the fields searched by the first-phase query, required with a named first
+                                    phase, which otherwise searches all fields while the lean index only has the
+                                    fields of the features, so it would return other documents
+    :param first_phase:             the first-phase query (see `search.first_phase_query`)
+    :return:                        the mapping, to be passed to `index.reindex` as `mapping_settings`
+    :raises ValueError:             if the first-phase query searches all fields
+    """
+    with open(feature_set_file) as f:
+        feature_set = json.load(f)
+    fields = QueriedFields()
+    fields.add_feature_set(feature_set)
+    named = first_phase in ("multi_match", "cross_fields", "phrase")
+    if named and not search_fields:
+        raise ValueError("The `%s` first phase searches all fields, name the searched fields (`--search-fields`) to "
+                         "derive a mapping" % first_phase)
+    if search_fields:
+        fields.text.update(field.split('^')[0] for field in search_fields)
+    if not named:
+        with open(first_phase) as f:
+            fields.add_query(json.load(f))
+    elif first_phase == "phrase":
+        fields.phrase.update(fields.text)
+    if "*" in fields.text:
+        raise ValueError("A query searches all fields (`*`), name its fields to derive a mapping")
+
+    properties = {}
+    for field in sorted(fields.text):
+        _put(properties, field, {"type": "text"} if field in fields.phrase else
+             {"type": "text", "index_options": "freqs"})
+    for field in sorted((fields.keyword | fields.doc_values) - fields.text):
+        _put_keyword(properties, field, fields)
+    return {"dynamic": False, "properties": properties}
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    print(json.dumps(lean_mapping(argv[1] if len(argv) > 1 else FEATURE_SET_FILE, argv[2].split(",")
+                                  if len(argv) > 2 else None), indent=2))
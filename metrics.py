@@ -0,0 +1,103 @@
+import numpy as np
+
+
+def _segments(query_ids):
+    """ returns the start of every query segment in rows that are sorted by query """
+    return np.flatnonzero(np.r_[True, query_ids[1:] != query_ids[:-1]])
+
+
+def rank_positions(query_ids, scores):
+    """
+    Ranks the documents of every query by descending score
+    :param query_ids:           the query id of every row
+    :param scores:              the score of every row
+    :return:                    (order, starts, positions): the row order that sorts the rows by query and descending
+                                score, the start of every query in that order and the 0-based rank of every sorted row
+    """
+    order = np.lexsort((-np.asarray(scores), np.asarray(query_ids)))
+    starts = _segments(np.asarray(query_ids)[order])
+    counts = np.diff(np.append(starts, len(order)))
+    positions = np.arange(len(order)) - np.repeat(starts, counts)
+    return order, starts, positions
+
+
+def _dcg(query_ids, scores, judgements, k):
+    order, starts, positions = rank_positions(query_ids, scores)
+    gains = (2.0 ** np.asarray(judgements, dtype=np.float64)[order] - 1) / np.log2(positions + 2)
+    if k is not None:
+        gains[positions >= k] = 0
+    return np.add.reduceat(gains, starts)
+
+
+def ndcg(query_ids, scores, judgements, k=None):
+    """
+    Computes the NDCG (with exponential gains) of every query
+    :param query_ids:           the query id of every row
+    :param scores:              the predicted score of every row
+    :param judgements:          the judgement of every row
+    :param k:                   cut-off of the ranking, the whole ranking is used if not set
+    :return:                    array with the NDCG of every query, in ascending query id order
+    """
+    dcg = _dcg(query_ids, scores, judgements, k)
+    ideal = _dcg(query_ids, judgements, judgements, k)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(ideal > 0, dcg / ideal, 0.0)
+
+
+def average_precision(query_ids, scores, judgements, k=None):
+    """
+    Computes the average precision of every query, documents with a judgement above 0 are relevant
+    :param query_ids:           the query id of every row
+    :param scores:              the predicted score of every row
+    :param judgements:          the judgement of every row
+    :param k:                   cut-off of the ranking, the whole ranking is used if not set
+    :return:                    array with the average precision of every query, in ascending query id order
+    """
+    order, starts, positions = rank_positions(query_ids, scores)
+    relevant = (np.asarray(judgements)[order] > 0).astype(np.float64)
+    counts = np.diff(np.append(starts, len(order)))
+    cumulative = np.cumsum(relevant)
+    # relevant documents up to every position within its query
+    hits = cumulative - np.repeat(cumulative[starts] - relevant[starts], counts)
+    precision = relevant * hits / (positions + 1)
+    total = np.add.reduceat(relevant, starts)
+    if k is not None:
+        precision[positions >= k] = 0
+        total = np.minimum(total, k)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, np.add.reduceat(precision, starts) / total, 0.0)
+
+
+def group_exposure(query_ids, scores, protected, k=None):
+    """
+    Computes the average exposure (1 / log2(1 + rank)) of the protected and the non-protected documents of every query
+    :param query_ids:           the query id of every row
+    :param scores:              the predicted score of every row
+    :param protected:           boolean array, True for the documents of the protected group
+    :param k:                   cut-off of the ranking, documents below it get no exposure
+    :return:                    (protected exposure, non-protected exposure) arrays, NaN for an empty group
+    """
+    order, starts, positions = rank_positions(query_ids, scores)
+    exposure = 1 / np.log2(positions + 2)
+    if k is not None:
+        exposure[positions >= k] = 0
+    is_protected = np.asarray(protected, dtype=bool)[order]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exposure_protected = np.add.reduceat(exposure * is_protected, starts) / \
+            np.add.reduceat(is_protected.astype(np.float64), starts)
+        exposure_nonprotected = np.add.reduceat(exposure * ~is_protected, starts) / \
+            np.add.reduceat((~is_protected).astype(np.float64), starts)
+    return exposure_protected, exposure_nonprotected
+
+
+def exposure_ratio(query_ids, scores, protected, k=None):
+    """
+    :return:                    array with the ratio of the protected to the non-protected group exposure of every
+                                query, 1 means both groups get the same exposure. The ratio is NaN, and left out
+                                of the `np.nanmean` of the callers, for a query without non-protected documents or
+                                whose non-protected documents are all below the cut-off
+    """
+    exposure_protected, exposure_nonprotected = group_exposure(query_ids, scores, protected, k)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(exposure_nonprotected > 0, exposure_protected / exposure_nonprotected, np.nan)
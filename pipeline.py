@@ -0,0 +1,243 @@
+import hashlib
+import json
+import queue
+import threading
+import time
+from contextlib import closing
+from os import replace
+from os.path import exists
+
+import numpy as np
+
+from cache import feature_set_digest
+from features import FeaturesWriter, read_features
+from registry import Registry, content_hash
+from train import MAX_LOG_IDS, create_trainer, logged_queries, save_trained_model
+from utils import Logger, Profiler, FEATURES_FILE, INDEX_NAME, JUDGMENTS_FILE, MODEL_FILE, QUERIES_FILE
+
+# marks the end of the logged rows in the queue
+_DONE = object()
+
+
+def file_digest(path: str):
+    """ returns the SHA-1 of the content of a file """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def index_fingerprint(es, index_name: str):
+    """
+    Describes the state of an index: the concrete index behind the name (which changes with an alias swap), its
+    number of documents and its size. The size also changes with merges, so the fingerprint errs on logging again.
+    """
+    concrete = sorted(es.indices.get(index=index_name))
+    stats = es.indices.stats(index=index_name)["_all"]["primaries"]
+    return {"indices": concrete, "docs": stats["docs"]["count"], "size": stats.get("store", {}).get("size_in_bytes")}
+
+
+class StageManifest(object):
+    """
+    Records the fingerprint of the inputs of every pipeline stage next to its outputs. A stage whose fingerprint
+    is unchanged and whose outputs still exist does not have to run again.
+    """
+
+    def __init__(self, manifest_file: str):
+        self._manifest_file = manifest_file
+        self._stages = {}
+        if exists(manifest_file):
+            with open(manifest_file) as f:
+                self._stages = json.load(f)
+
+    def fresh(self, stage: str, fingerprint: str):
+        entry = self._stages.get(stage)
+        return entry is not None and entry["fingerprint"] == fingerprint and all(map(exists, entry["outputs"]))
+
+    def record(self, stage: str, fingerprint: str, outputs: list):
+        self._stages[stage] = {"fingerprint": fingerprint, "outputs": outputs,
+                               "finished": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        with open(self._manifest_file + ".tmp", 'w') as f:
+            json.dump(self._stages, f, indent=2)
+        replace(self._manifest_file + ".tmp", self._manifest_file)
+
+
+class TrainingArrays(object):
+    """ Assembles the logged rows of the queries into the arrays trained on by `engine.DeltrEngine.train_arrays` """
+
+    def __init__(self, value_type="float64"):
+        """
+        :param value_type:          the type the feature values are rounded to, the type of the features file, so
+                                    the arrays hold the same values as a features file written at the same time
+        """
+        self._value_type = np.dtype(value_type)
+        self.feature_names = None
+        self._query_ids, self._values, self._judgements = [], [], []
+        self.rows = 0
+
+    def add(self, query_id, document_ids: list, feature_names: list, feature_values: list, judgements: list):
+        if self.feature_names is None:
+            self.feature_names = list(feature_names)
+        elif list(feature_names) != self.feature_names:
+            raise ValueError("Query %s was logged with the features %s instead of %s"
+                             % (query_id, feature_names, self.feature_names))
+        self._query_ids.append(np.full(len(document_ids), query_id))
+        self._values.append(np.asarray(feature_values, dtype=self._value_type))
+        self._judgements.append(np.asarray(judgements, dtype=np.float64))
+        self.rows += len(document_ids)
+
+    def arrays(self):
+        """ returns the query ids, the feature matrix and the judgements of all the added rows """
+        if not self.rows:
+            raise ValueError("No features were logged")
+        return (np.concatenate(self._query_ids), np.concatenate(self._values).astype(np.float64),
+                np.concatenate(self._judgements))
+
+    @classmethod
+    def from_features_file(cls, features_file: str):
+        features = read_features(features_file)
+        arrays = cls()
+        arrays.feature_names = features.columns.tolist()[2:-1]
+        arrays._query_ids = [np.asarray(features.iloc[:, 0])]
+        arrays._values = [np.asarray(features.iloc[:, 2:-1], dtype=np.float64)]
+        arrays._judgements = [np.asarray(features.iloc[:, -1], dtype=np.float64)]
+        arrays.rows = len(features)
+        return arrays
+
+
+def _produce(rows, output: queue.Queue, stop: threading.Event):
+    """
+    puts the logged rows on the queue, followed by `_DONE` or by the exception that stopped the logging. The rows
+    are closed, which releases the executor and the cache of the logging, when they are exhausted or `stop` is set.
+    """
+    try:
+        with closing(rows):
+            for row in rows:
+                if stop.is_set():
+                    return
+                output.put(row)
+        output.put(_DONE)
+    except BaseException as e:
+        output.put(e)
+
+
+def log_to_arrays(rows, features_file: str, value_type="float64", compression=None, queue_size=64):
+    """
+    Streams the logged rows of the queries through a bounded queue into the training arrays. The logging runs in a
+    producer thread and the consumer assembles the arrays and writes the features file, so neither waits for the
+    other while the queue is neither empty nor full.
+    :param rows:                    the logged rows (see `train.logged_queries`)
+    :param features_file:           the features file written alongside, for `--evaluate` and to skip the logging
+                                    when nothing changed
+    :param queue_size:              the most queries logged ahead of the consumer
+    :return:                        the `TrainingArrays`
+    """
+    arrays = TrainingArrays(value_type)
+    rows_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    producer = threading.Thread(target=_produce, args=(rows, rows_queue, stop), daemon=True)
+    producer.start()
+    try:
+        with FeaturesWriter(features_file, value_type, compression) as writer:
+            while True:
+                row = rows_queue.get()
+                if row is _DONE:
+                    break
+                if isinstance(row, BaseException):
+                    raise row
+                with Profiler.span("assemble_features"):
+                    arrays.add(*row)
+                    writer.write(*row)
+    except BaseException:
+        # unblock a producer waiting on the full queue, so that it stops and closes the logging
+        stop.set()
+        while producer.is_alive():
+            try:
+                rows_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        raise
+    finally:
+        producer.join()
+    Profiler.count("features.rows", arrays.rows)
+    return arrays
+
+
+@Profiler.timed("train_pipeline")
+def train_pipeline(es, registry: Registry, feature_set_name: str, model_name: str, queries_file: str = QUERIES_FILE,
+                   judgments_file: str = JUDGMENTS_FILE, index_name: str = INDEX_NAME,
+                   features_file: str = FEATURES_FILE, model_output: str = MODEL_FILE, stages_file=None,
+                   queue_size=64, batch_size=None, concurrency=1, value_type="float64", compression=None,
+                   cache_file=None, max_ids=MAX_LOG_IDS, force=False, protected_feature_name="1", log=None,
+                   **train_parameters):
+    """
+    Logs the features, trains and uploads a model in one pass. The logged rows go straight into the training arrays
+    instead of being read back from the features file, and the model is uploaded through the registry as soon as it
+    is trained. The stages whose inputs did not change since the last run are skipped: the logging when the
+    queries, judgements, feature set and index are the same, the training when the features and the training
+    parameters are the same, and the upload when the same model is already deployed.
+    :param es:                      Elasticsearch client
+    :param registry:                the registry the model is deployed with
+    :param feature_set_name:        the (versioned) name of the logged feature set
+    :param model_name:              the name the model is deployed under
+    :param stages_file:             the stage manifest, `<model_output>.stages.json` if not set
+    :param queue_size:              the most queries logged ahead of the array assembly
+    :param force:                   whether to run every stage even if its inputs did not change
+    :param train_parameters:        the parameters of `train.create_trainer`, only the `numpy` engine trains on
+                                    arrays
+    :return:                        the deployed version of the model
+    """
+    if train_parameters.get("engine", "numpy") != "numpy":
+        raise ValueError("The pipelined training requires the `numpy` engine")
+    stages = StageManifest(stages_file or model_output + ".stages.json")
+
+    logging_fingerprint = content_hash({
+        "queries": file_digest(queries_file), "judgements": file_digest(judgments_file),
+        "feature_set": feature_set_digest(es, feature_set_name), "index": index_fingerprint(es, index_name),
+        "max_ids": max_ids, "value_type": value_type})
+    start = time.perf_counter()
+    if not force and stages.fresh("features", logging_fingerprint):
+        Logger.logger.info("*** Features of %s are up to date, skipping the logging" % features_file)
+        arrays = None
+    else:
+        Logger.logger.info("*** Logging features")
+        with Profiler.span("pipeline_logging"):
+            arrays = log_to_arrays(logged_queries(es, queries_file, judgments_file, feature_set_name, index_name,
+                                                  batch_size, concurrency, cache_file, max_ids),
+                                   features_file, value_type, compression, queue_size)
+        stages.record("features", logging_fingerprint, [features_file])
+        Logger.logger.info("*** Logged %d rows in %.1fs" % (arrays.rows, time.perf_counter() - start))
+
+    training_fingerprint = content_hash({"features": logging_fingerprint, "protected": protected_feature_name,
+                                         "parameters": train_parameters})
+    if not force and stages.fresh("model", training_fingerprint):
+        Logger.logger.info("*** Model %s is up to date, skipping the training" % model_output)
+    else:
+        if arrays is None:
+            with Profiler.span("read_features"):
+                arrays = TrainingArrays.from_features_file(features_file)
+        if protected_feature_name not in arrays.feature_names:
+            raise ValueError("The name of the protected feature does not appear in the logged features")
+        dtr = create_trainer(protected_feature_name, **train_parameters)
+        query_ids, feature_matrix, judgements = arrays.arrays()
+        start = time.perf_counter()
+        Logger.logger.info("*** Training...")
+        with Profiler.span("train"):
+            model = dtr.train_arrays(query_ids, feature_matrix, judgements,
+                                     arrays.feature_names.index(protected_feature_name))
+        Profiler.count("train.iterations", dtr.iterations)
+        Logger.logger.info("*** Trained %d iterations in %.1fs" % (dtr.iterations, time.perf_counter() - start))
+        save_trained_model(dtr, model, arrays.feature_names, model_output, protected_feature_name,
+                           train_parameters.get("standardize", True), log)
+        stages.record("model", training_fingerprint, [model_output])
+
+    return registry.deploy_model(model_output, model_name, feature_set_name)
+
+
+if __name__ == "__main__":
+    from utils import elastic_connection, FEATURE_SET_NAME, MODEL_NAME
+
+    pipeline_registry = Registry()
+    train_pipeline(elastic_connection(), pipeline_registry,
+                   pipeline_registry.resolve("feature_sets", FEATURE_SET_NAME), MODEL_NAME)
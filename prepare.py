@@ -1,8 +1,6 @@
 import json
-import requests
 
-from utils import Logger, ES_AUTH, ES_HOST, FEATURE_SET_FILE, FEATURE_SET_NAME
-from urllib.parse import urljoin
+from utils import AlreadyExistsError, Logger, LazyJson, es_request, FEATURE_SET_FILE, FEATURE_SET_NAME
 
 
 def load_features(feature_set_file: str, feature_set_name: str):
@@ -14,30 +12,27 @@ def load_features(feature_set_file: str, feature_set_name: str):
     """
     feature_set = json.loads(open(feature_set_file).read())
     path = "_ltr/_featureset/%s" % feature_set_name
-    full_path = urljoin(ES_HOST, path)
 
-    Logger.logger.info("POST %s" % full_path)
-    Logger.logger.info(json.dumps(feature_set, indent=2))
+    Logger.logger.info("POST %s" % path)
+    Logger.logger.debug("%s", LazyJson(feature_set, indent=2))
 
-    head = {'Content-Type': 'application/json'}
-    resp = requests.post(full_path, data=json.dumps(feature_set), headers=head, auth=ES_AUTH)
+    resp = es_request('POST', path, feature_set)
 
-    Logger.logger.info("%s" % resp.status_code)
-    Logger.logger.info("%s" % resp.text)
+    Logger.logger.info("%s" % resp)
 
 
 def init_default_store():
     """
     Initialize the default feature store.
     """
-    path = urljoin(ES_HOST, '_ltr')
-
-    Logger.logger.info("Trying to create %s" % path)
-    Logger.logger.info("PUT %s" % path)
-
-    resp = requests.put(path, auth=ES_AUTH)
-
-    Logger.logger.info("%s" % resp.status_code)
+    Logger.logger.info("Trying to create _ltr")
+    Logger.logger.info("PUT _ltr")
+
+    try:
+        resp = es_request('PUT', '_ltr')
+        Logger.logger.info("%s" % resp)
+    except AlreadyExistsError:
+        Logger.logger.info("The default feature store already exists")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import time
+from os import replace
+from os.path import exists
+
+from utils import Logger, NotFoundError, es_request, ES_HOST, REGISTRY_FILE
+
+
+def content_hash(content):
+    """ returns a short hash of a JSON serializable artifact """
+    return hashlib.sha1(json.dumps(content, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()[:12]
+
+
+def versioned_name(name: str, digest: str):
+    return "%s-%s" % (name, digest)
+
+
+class Registry(object):
+    """
+    Keeps track of the feature sets and models deployed to an Elasticsearch cluster. Every artifact is uploaded
+    under a name versioned with the hash of its content, so an unchanged artifact is never uploaded twice and the
+    old versions stay available. Which version of a feature set or model is used by the commands is a pointer in a
+    local manifest, so rolling back is a manifest write instead of a retrain and upload. Optionally the plain name
+    is also kept in Elasticsearch as a copy of the active version, for the clients that search with it.
+    """
+
+    def __init__(self, manifest_file: str = REGISTRY_FILE, url: str = ES_HOST, publish_plain_names=False):
+        """
+        :param manifest_file:       the local manifest file path
+        :param url:                 the Elasticsearch URL the artifacts are deployed to
+        :param publish_plain_names: whether to copy the active version to the plain name on every deploy and
+                                    activation, which costs a few requests and leaves the plain name missing for a
+                                    moment, since the LTR store cannot update an artifact
+        """
+        self._manifest_file = manifest_file
+        self._url = url
+        self._publish_plain_names = publish_plain_names
+        manifest = {}
+        if exists(manifest_file):
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+        self._manifest = manifest
+        self._cluster = manifest.setdefault(url, {"feature_sets": {}, "models": {}})
+
+    def _save(self):
+        with open(self._manifest_file + ".tmp", 'w') as f:
+            json.dump(self._manifest, f, indent=2)
+        replace(self._manifest_file + ".tmp", self._manifest_file)
+
+    def _exists(self, path):
+        try:
+            return es_request('GET', path, url=self._url).get('found', True)
+        except NotFoundError:
+            return False
+
+    def _register(self, kind, name, version, **info):
+        entry = self._cluster[kind].setdefault(name, {"active": None, "versions": {}})
+        if version not in entry["versions"]:
+            info["created"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            entry["versions"][version] = info
+        entry["active"] = version
+        if self._publish_plain_names:
+            self._publish(kind, name)
+        self._save()
+
+    def _stored(self, kind, version):
+        store = "_model" if kind == "models" else "_featureset"
+        return es_request('GET', "_ltr/%s/%s" % (store, version), url=self._url)["_source"]
+
+    def _upload_copy(self, kind, name, version, stored):
+        if kind == "models":
+            es_request('POST', "_ltr/_featureset/%s/_createmodel" % self._cluster[kind][name]["versions"][version]
+                       ["feature_set"], {"model": {"name": name, "model": stored["model"]["model"]}}, url=self._url)
+        else:
+            es_request('POST', "_ltr/_featureset/%s" % name,
+                       {"featureset": dict(stored.get("featureset", stored), name=name)}, url=self._url)
+
+    def _publish(self, kind, name):
+        """
+        Replaces the artifact stored under the plain name with a copy of the active version, read back from
+        Elasticsearch since the file it was deployed from may have changed. The LTR store cannot update an artifact,
+        so the plain name is missing between the delete and the upload, and the previous copy is uploaded again if
+        the upload fails.
+        """
+        entry = self._cluster[kind][name]
+        version, previous = entry["active"], entry.get("published")
+        path = "_ltr/%s/%s" % ("_model" if kind == "models" else "_featureset", name)
+        exists = self._exists(path)
+        if previous == version and exists:
+            return
+        # both copies are read before the plain name is deleted, so restoring the previous one is a single request
+        stored = self._stored(kind, version)
+        restore = self._stored(kind, previous) if exists and previous in entry["versions"] else None
+        if exists:
+            es_request('DELETE', path, url=self._url)
+        try:
+            self._upload_copy(kind, name, version, stored)
+        except Exception:
+            if restore is not None:
+                Logger.logger.error("*** Failed to copy %s to %s, restoring %s" % (version, name, previous))
+                self._upload_copy(kind, name, previous, restore)
+            raise
+        entry["published"] = version
+        Logger.logger.info("*** %s points to %s" % (name, version))
+
+    def deploy_feature_set(self, feature_set_file: str, name: str):
+        """
+        Uploads a feature set under a versioned name unless the same definition is already deployed, and activates it
+        :param feature_set_file:    the file path where the feature set JSON is stored
+        :param name:                the name of the feature set
+        :return:                    the versioned name of the feature set
+        """
+        with open(feature_set_file) as f:
+            feature_set = json.load(f)
+        version = versioned_name(name, content_hash(feature_set))
+        path = "_ltr/_featureset/%s" % version
+        if self._exists(path):
+            Logger.logger.info("*** Feature set %s is already deployed" % version)
+        else:
+            Logger.logger.info("*** Uploading feature set %s" % version)
+            es_request('POST', path, feature_set, url=self._url)
+        self._register("feature_sets", name, version, file=feature_set_file)
+        return version
+
+    def deploy_model(self, model_file: str, name: str, feature_set: str):
+        """
+        Uploads a model under a versioned name unless the same model is already deployed, and activates it
+        :param model_file:          the model JSON file
+        :param name:                the name of the model
+        :param feature_set:         the (versioned) name of the feature set the model is created in
+        :return:                    the versioned name of the model
+        """
+        with open(model_file) as f:
+            model = json.load(f)
+        version = versioned_name(name, content_hash({"model": model, "feature_set": feature_set}))
+        if self._exists("_ltr/_model/%s" % version):
+            Logger.logger.info("*** Model %s is already deployed" % version)
+        else:
+            # the training stack is only imported when a model is actually uploaded
+            from train import save_model
+            save_model(version, feature_set, model_file, url=self._url)
+        self._register("models", name, version, file=model_file, feature_set=feature_set)
+        return version
+
+    def activate(self, kind: str, name: str, version: str):
+        """
+        Points a feature set or model name to one of its registered versions
+        :param kind:                `models` or `feature_sets`
+        :param name:                the name of the model or feature set
+        :param version:             the versioned name, or just its hash
+        """
+        versions = self._cluster[kind].get(name, {}).get("versions", {})
+        if version not in versions:
+            version = versioned_name(name, version)
+        if version not in versions:
+            raise ValueError("`%s` is not a registered version of %s" % (version, name))
+        self._cluster[kind][name]["active"] = version
+        if self._publish_plain_names:
+            self._publish(kind, name)
+        self._save()
+        Logger.logger.info("*** Activated %s" % version)
+
+    def resolve(self, kind: str, name: str):
+        """
+        :param kind:                `models` or `feature_sets`
+        :param name:                the name of the model or feature set
+        :return:                    the active version of the name, or the name itself if it is not registered
+        """
+        return self._cluster[kind].get(name, {}).get("active") or name
+
+    def versions(self, kind: str, name: str):
+        """ returns the registered versions of a name with their info, the oldest first """
+        return list(self._cluster[kind].get(name, {"versions": {}})["versions"].items())
+
+    def report(self):
+        for kind in ("feature_sets", "models"):
+            for name, entry in self._cluster[kind].items():
+                for version, info in self.versions(kind, name):
+                    Logger.logger.info("%s %-40s %s%s" % (kind[:-1], version, info["created"],
+                                                         " (active)" if version == entry["active"] else ""))
+
+
+if __name__ == "__main__":
+    Registry().report()
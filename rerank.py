@@ -0,0 +1,186 @@
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from features import read_features
+from utils import Logger, FEATURES_FILE, MODEL_FILE
+
+
+def standardization_file(model_file: str):
+    """ returns the path of the standardization sidecar written next to a model file """
+    return model_file + ".standardization.json"
+
+
+def save_standardization(model_file: str, protected_feature_name: str, mu=None, sigma=None):
+    """
+    Stores the standardization applied in training next to the model, so the model can be applied outside of
+    Elasticsearch. The DELTR trainer standardizes with one mean and deviation over the whole feature matrix and
+    keeps the protected feature as is.
+    :param model_file:              the model file path
+    :param protected_feature_name:  the name of the protected feature
+    :param mu:                      the mean used in training, None if the data was not standardized
+    :param sigma:                   the deviation used in training, None if the data was not standardized
+    """
+    with open(standardization_file(model_file), 'w') as f:
+        json.dump({"protected_feature": protected_feature_name,
+                   "mu": None if mu is None else float(mu),
+                   "sigma": None if sigma is None else float(sigma)}, f)
+
+
+class Reranker(object):
+    """
+    Applies a trained DELTR model to logged features without Elasticsearch. The standardization is folded into the
+    weights, so scoring is a single matrix-vector product over the raw feature matrix.
+    """
+
+    def __init__(self, weights: dict, protected_feature_name=None, mu=None, sigma=None):
+        """
+        :param weights:                 the model, feature name -> weight
+        :param protected_feature_name:  the name of the protected feature, which is not standardized
+        :param mu:                      the mean used in training, None if the data was not standardized
+        :param sigma:                   the deviation used in training, None if the data was not standardized
+        """
+        self.feature_names = list(weights)
+        omega = np.array([weights[name] for name in self.feature_names], dtype=np.float64)
+        self.intercept = 0.0
+        if mu is not None:
+            standardized = np.array([name != protected_feature_name for name in self.feature_names])
+            # ((x - mu) / sigma) . w  ==  x . (w / sigma) - mu / sigma * sum(w) over the standardized features
+            self.intercept = -mu / sigma * omega[standardized].sum()
+            omega = np.where(standardized, omega / sigma, omega)
+        self.omega = omega
+
+    @classmethod
+    def from_files(cls, model_file: str = MODEL_FILE, standardization=None):
+        """
+        Loads a model written by `train.train_model` or `sweep.sweep`
+        :param model_file:              the model JSON file
+        :param standardization:         the standardization sidecar, `<model_file>.standardization.json` if not set.
+                                        Without a sidecar the model is applied to the raw features.
+        :return:
+        """
+        with open(model_file) as f:
+            weights = json.load(f)
+        standardization = standardization or standardization_file(model_file)
+        if not os.path.exists(standardization):
+            Logger.logger.info("*** No standardization found for %s, scoring the raw features" % model_file)
+            return cls(weights)
+        with open(standardization) as f:
+            params = json.load(f)
+        return cls(weights, params["protected_feature"], params["mu"], params["sigma"])
+
+    def _columns(self, feature_names):
+        position = {name: i for i, name in enumerate(feature_names)}
+        missing = [name for name in self.feature_names if name not in position]
+        if missing:
+            raise ValueError("The features %s of the model are missing from the feature matrix" % missing)
+        return [position[name] for name in self.feature_names]
+
+    def score(self, feature_matrix, feature_names=None):
+        """
+        :param feature_matrix:          the features of every document
+        :param feature_names:           the names of the columns of the matrix, the model features in model order
+                                        if not set
+        :return:                        the score of every document
+        """
+        feature_matrix = np.asarray(feature_matrix)
+        if feature_names is not None and list(feature_names) != self.feature_names:
+            feature_matrix = feature_matrix[:, self._columns(feature_names)]
+        return feature_matrix.dot(self.omega) + self.intercept
+
+    def rerank(self, features: pd.DataFrame, k=10, chunk_queries=4096):
+        """
+        Ranks the documents of every query in a features data frame (see `features.read_features`)
+        :param features:                data frame with the query id, document id, feature and judgement columns
+        :param k:                       number of top documents returned per query
+        :param chunk_queries:           number of queries ranked at once
+        :return:                        data frame with the query id, document id, rank, score and judgement of the
+                                        top-k documents of every query
+        """
+        feature_names = features.columns.tolist()[2:-1]
+        columns = self._columns(feature_names)
+        scores = self.score(np.asarray(features.iloc[:, 2:-1].iloc[:, columns], dtype=np.float64))
+        query_ids = np.asarray(features.iloc[:, 0])
+        rows, ranks = top_k(query_ids, scores, k, chunk_queries)
+        return pd.DataFrame({"query_id": query_ids[rows],
+                             "document_id": np.asarray(features.iloc[:, 1])[rows],
+                             "rank": ranks + 1,
+                             "score": scores[rows],
+                             "judgement": np.asarray(features.iloc[:, -1])[rows]})
+
+
+def top_k(query_ids, scores, k, chunk_queries=4096):
+    """
+    Selects the k best scored rows of every query with a partial sort. The queries are ranked in chunks, the scores
+    of a chunk are padded into a (queries x longest query) matrix.
+    :param query_ids:               the query id of every row
+    :param scores:                  the score of every row
+    :param k:                       number of rows selected per query
+    :param chunk_queries:           number of queries ranked at once
+    :return:                        (rows, ranks): the selected rows ordered by query and descending score, and their
+                                    0-based rank in the query
+    """
+    query_ids = np.asarray(query_ids)
+    scores = np.asarray(scores, dtype=np.float64)
+    order = np.argsort(query_ids, kind='stable')
+    sorted_ids = query_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]]) if len(order) else np.array([], int)
+    counts = np.diff(np.append(starts, len(order)))
+
+    selected_rows, selected_ranks = [], []
+    for first in range(0, len(starts), chunk_queries):
+        chunk_starts = starts[first:first + chunk_queries]
+        chunk_counts = counts[first:first + chunk_queries]
+        base, end = chunk_starts[0], chunk_starts[-1] + chunk_counts[-1]
+        width = chunk_counts.max()
+        kk = min(k, width)
+
+        padded = np.full((len(chunk_starts), width), -np.inf)
+        columns = np.arange(end - base) - np.repeat(chunk_starts - base, chunk_counts)
+        padded[np.repeat(np.arange(len(chunk_starts)), chunk_counts), columns] = scores[order[base:end]]
+
+        if kk < width:
+            best = np.argpartition(-padded, kk - 1, axis=1)[:, :kk]
+        else:
+            best = np.broadcast_to(np.arange(width), padded.shape)
+        best = np.take_along_axis(best, np.argsort(-np.take_along_axis(padded, best, 1), axis=1, kind='stable'), 1)
+
+        valid = best < chunk_counts[:, None]
+        selected_rows.append(order[(chunk_starts[:, None] + best)[valid]])
+        selected_ranks.append(np.broadcast_to(np.arange(kk), best.shape)[valid])
+
+    if not selected_rows:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(selected_rows), np.concatenate(selected_ranks)
+
+
+def rerank_file(features_file: str, model_file: str, output_file: str, k=10, standardization=None):
+    """
+    Reranks the logged features of many queries with a model and writes the top-k documents of every query
+    :param features_file:           the features file (CSV or Arrow)
+    :param model_file:              the model JSON file
+    :param output_file:             the CSV file where the ranking is written
+    :param k:                       number of top documents written per query
+    :param standardization:         the standardization sidecar of the model (see `Reranker.from_files`)
+    :return:                        the ranking data frame
+    """
+    reranker = Reranker.from_files(model_file, standardization)
+    features = read_features(features_file)
+    start = time.perf_counter()
+    ranking = reranker.rerank(features, k)
+    elapsed = time.perf_counter() - start
+    Logger.logger.info("*** Reranked %d documents of %d queries in %.3fs (%.0f documents/s)"
+                       % (len(features), ranking["query_id"].nunique(), elapsed,
+                          len(features) / elapsed if elapsed else 0.0))
+    ranking.to_csv(output_file, index=False)
+    return ranking
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    rerank_file(argv[1] if len(argv) > 1 else FEATURES_FILE, argv[2] if len(argv) > 2 else MODEL_FILE,
+                argv[3] if len(argv) > 3 else "ranking.csv")
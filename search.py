@@ -1,51 +1,305 @@
-from utils import Logger, elastic_connection, INDEX_NAME, MODEL_NAME
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import lru_cache
 
-baseQuery = {
-    "query": {
-        "multi_match": {
-            "query": "w3c",
-        }
-    },
-    "rescore": {
+from utils import Logger, LazyJson, Param, Profiler, QueryTemplate, async_elastic_connection, batches, \
+    elastic_connection, ordered_map, placeholders, INDEX_NAME, JUDGMENTS_FILE, MODEL_NAME, QUERIES_FILE
+
+# first-phase queries that can be selected by name, `fields` are added to them when set
+FIRST_PHASE_QUERIES = {
+    "multi_match": {"multi_match": {"query": Param("keywords")}},
+    "cross_fields": {"multi_match": {"query": Param("keywords"), "type": "cross_fields"}},
+    "phrase": {"multi_match": {"query": Param("keywords"), "type": "phrase"}},
+}
+
+
+def first_phase_query(first_phase="multi_match", fields=None):
+    """
+    Creates the first-phase query, which selects the documents that are rescored by the model
+    :param first_phase:     the name of a query in `FIRST_PHASE_QUERIES`, or the path of a JSON file with a query
+                            clause in which the string "{{keywords}}" stands for the keywords
+    :param fields:          the fields searched by the named queries, all fields if not set
+    :return:                a query clause with `Param` placeholders
+    """
+    if first_phase in FIRST_PHASE_QUERIES:
+        query = deepcopy(FIRST_PHASE_QUERIES[first_phase])
+        if fields:
+            query['multi_match']['fields'] = list(fields)
+        return query
+    with open(first_phase) as f:
+        return placeholders(json.load(f))
+
+
+@lru_cache(maxsize=64)
+def search_template(window_size=None, first_phase="multi_match", fields=None, source=None, log_features=True):
+    """
+    Compiles the LTR search template for a combination of options, the templates are cached
+    :param window_size:     Number of top first-phase hits per shard rescored by the model, the Elasticsearch
+                            default (10) if not set
+    :param first_phase:     The first-phase query (see `first_phase_query`)
+    :param fields:          Tuple of fields searched by the first-phase query
+    :param source:          Tuple of `_source` fields returned with the hits, False to return no `_source`, the whole
+                            `_source` if not set
+    :param log_features:    Whether the feature values of the hits are logged in the response (`ltr_log`)
+    :return:                a `QueryTemplate` with `keywords` and `model` parameters
+    """
+    rescore = {
         "query": {
             "rescore_query": {
                 "sltr": {
                     "params": {
-                        "keywords": ""
+                        "keywords": Param("keywords")
                     },
-                    "model": "",
+                    "model": Param("model"),
                 }
             }
         },
-    },
-    "ext": {
-        "ltr_log": {
-            "log_specs": {
-                "name": "log_entry",
-                "rescore_index": 0,
-                "missing_as_zero": True
+    }
+    if window_size is not None:
+        rescore["window_size"] = window_size
+    body = {
+        "query": first_phase_query(first_phase, fields),
+        "rescore": rescore,
+    }
+    if source is not None:
+        body["_source"] = list(source) if source else False
+    if log_features:
+        body["ext"] = {
+            "ltr_log": {
+                "log_specs": {
+                    "name": "log_entry",
+                    "rescore_index": 0,
+                    "missing_as_zero": True
+                }
             }
         }
-    }
-}
+    return QueryTemplate(body)
+
+
+baseQuery = search_template()
+
+
+def ltr_query(keywords, model_name, **options):
+    """
+    :param options:         the search options of `search_template`
+    """
+    body = search_template(**options).render(keywords=keywords, model=model_name)
+    Logger.logger.debug("%s", LazyJson(body))
+    return body
+
+
+def read_queries(lines):
+    """
+    Reads the queries of a batch search, one per line. A line is either the plain keywords or a JSON object with a
+    `query` and optionally an `id` field, e.g. a production query log exported as NDJSON.
+    :param lines:           an iterable of lines, e.g. an open file or `sys.stdin`
+    :return:                generator of (query id, keywords), the id defaults to the line number
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            entry = json.loads(line)
+            yield entry.get('id', number), entry['query']
+        else:
+            yield number, line
+
+
+def _result(query_id, keywords, response, latency, verbose):
+    result = {"id": query_id, "query": keywords, "latency_ms": round(latency * 1000, 3)}
+    if 'error' in response:
+        result["error"] = response['error']
+        return result
+    result["took"] = response.get('took')
+    hits = []
+    for hit in response['hits']['hits']:
+        entry = {"id": hit['_id'], "score": hit['_score']}
+        if verbose:
+            entry["features"] = {ll['name']: ll.get('value') for ll in hit['fields']['_ltrlog'][0]['log_entry']}
+        hits.append(entry)
+    result["hits"] = hits
+    return result
+
+
+def search_batch(es, queries, index_name: str, model_name: str, chunk_size=100, concurrency=1, verbose=False,
+                 **options):
+    """
+    Runs many LTR queries through `_msearch`. The chunks are sent from `concurrency` threads sharing the pooled
+    connections of the client, and the results are returned in the order of the queries.
+    :param es:              Elasticsearch client, created with `maxsize` >= `concurrency`
+    :param queries:         iterable of (query id, keywords), see `read_queries`
+    :param index_name:      The index to search on
+    :param model_name:      The model to rescore with
+    :param chunk_size:      Number of queries per `_msearch` request
+    :param concurrency:     Number of `_msearch` requests in flight
+    :param verbose:         Whether or not the results should contain the logged features, the features are only
+                            logged by Elasticsearch in verbose mode
+    :param options:         the search options of `search_template`
+    :return:                generator of result dicts; `latency_ms` is the round trip of the query's `_msearch`
+                            request and `took` the time Elasticsearch spent on the query itself. The queries of a
+                            failed `_msearch` request get its `error` instead of hits.
+    """
+    def run(chunk):
+        body = []
+        for _, keywords in chunk:
+            body.append({"index": index_name})
+            body.append(ltr_query(keywords, model_name, log_features=verbose, **options))
+        start = time.perf_counter()
+        try:
+            with Profiler.span("search_msearch"):
+                responses = es.msearch(body=body)['responses']
+        except Exception as e:
+            # a failed request (timeout, 5xx, connection error) fails only the queries of its chunk
+            Profiler.count("search.failed_requests")
+            responses = [{"error": str(e)}] * len(chunk)
+        Profiler.count("search.requests")
+        Profiler.count("search.queries", len(chunk))
+        return chunk, responses, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for chunk, responses, latency in ordered_map(executor, run, batches(queries, chunk_size), 2 * concurrency):
+            for (query_id, keywords), response in zip(chunk, responses):
+                yield _result(query_id, keywords, response, latency, verbose)
+
+
+async def async_search_batch(es, queries, index_name: str, model_name: str, concurrency=10, verbose=False,
+                             **options):
+    """
+    Runs many LTR queries over an `AsyncElasticsearch` client (see `utils.async_elastic_connection`) with at most
+    `concurrency` queries in flight. The results are yielded as soon as they arrive, so they are not in the order of
+    the queries.
+    :return:                async generator of result dicts, `latency_ms` is the round trip of the query
+    """
+    async def run(query_id, keywords):
+        start = time.perf_counter()
+        try:
+            response = await es.search(index=index_name, body=ltr_query(keywords, model_name, log_features=verbose,
+                                                                         **options))
+        except Exception as e:
+            response = {"error": str(e)}
+        return _result(query_id, keywords, response, time.perf_counter() - start, verbose)
+
+    pending = set()
+    for query_id, keywords in queries:
+        if len(pending) >= concurrency:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+        pending.add(asyncio.ensure_future(run(query_id, keywords)))
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield task.result()
+
+
+def write_results(results, output):
+    """
+    Writes the results of a batch search as NDJSON, one line per query
+    :return:                (number of queries, number of failed queries)
+    """
+    count = failures = 0
+    for result in results:
+        output.write(json.dumps(result) + '\n')
+        count += 1
+        failures += 'error' in result
+    output.flush()
+    return count, failures
+
+
+async def _write_async_results(results, output):
+    count = failures = 0
+    async for result in results:
+        output.write(json.dumps(result) + '\n')
+        count += 1
+        failures += 'error' in result
+    output.flush()
+    return count, failures
+
+
+def run_async_batch(queries, output, index_name: str, model_name: str, concurrency=10, verbose=False, **options):
+    """ Runs `async_search_batch` on a new client and writes its results as NDJSON """
+    async def main():
+        es = async_elastic_connection(maxsize=concurrency)
+        try:
+            return await _write_async_results(async_search_batch(es, queries, index_name, model_name, concurrency,
+                                                                 verbose, **options), output)
+        finally:
+            await es.close()
+
+    return asyncio.run(main())
+
+
+def window_sweep(es, window_sizes, index_name: str = INDEX_NAME, model_name: str = MODEL_NAME,
+                 queries_file: str = QUERIES_FILE, judgments_file: str = JUDGMENTS_FILE, k=10, output_file=None,
+                 **options):
+    """
+    Runs the judged queries with growing rescore windows and reports the latency against the NDCG, to pick the
+    smallest window that does not lose relevance. Unjudged hits count as not relevant.
+    :param es:              Elasticsearch client
+    :param window_sizes:    The rescore window sizes to try
+    :param k:               Cut-off of the NDCG, the searches return `k` hits
+    :param output_file:     CSV file where the report is written (optional)
+    :param options:         the other search options of `search_template`
+    :return:                data frame with the latency percentiles and the mean NDCG of every window size
+    """
+    import numpy as np
+    import pandas as pd
+
+    from judgements import JudgementStore
+    from metrics import ndcg
+
+    queries = pd.read_csv(queries_file)
+    judgements = JudgementStore.from_csv(judgments_file)
+    judged = {q_id: {str(doc_id): judgements.judgement(q_id, doc_id) for doc_id in judgements.ids(q_id)}
+              for q_id in queries['query_id'].tolist() if q_id in judgements}
+    keywords = [(q_id, kw) for q_id, kw in zip(queries['query_id'].tolist(), queries['keywords'].tolist())
+                if q_id in judged]
 
+    report = []
+    for window_size in window_sizes:
+        took, latency, query_ids, scores, gains = [], [], [], [], []
+        for i, (q_id, kw) in enumerate(keywords):
+            body = ltr_query(kw, model_name, window_size=window_size, log_features=False, **options)
+            body["size"] = k
+            start = time.perf_counter()
+            response = es.search(index=index_name, body=body)
+            latency.append((time.perf_counter() - start) * 1000)
+            took.append(response.get('took', np.nan))
+            # the judged documents that were not returned only count in the ideal ranking, they are ranked after
+            # the hits and the rows without gain that fill the hits up to k
+            hit_ids = [hit['_id'] for hit in response['hits']['hits']][:k]
+            missed = set(judged[q_id]).difference(hit_ids)
+            ranked = [judged[q_id].get(doc_id, 0) for doc_id in hit_ids] + [0] * (k - len(hit_ids)) + \
+                [judged[q_id][doc_id] for doc_id in missed]
+            query_ids.extend([i] * len(ranked))
+            scores.extend(-np.arange(len(ranked)))
+            gains.extend(ranked)
+        mean_ndcg = np.mean(ndcg(np.array(query_ids), np.array(scores), np.array(gains, dtype=np.float64), k))
+        report.append({"window_size": window_size, "queries": len(keywords),
+                       "latency_p50_ms": np.percentile(latency, 50), "latency_p95_ms": np.percentile(latency, 95),
+                       "took_p50_ms": np.nanpercentile(took, 50), "ndcg@%d" % k: mean_ndcg})
+        Logger.logger.info("*** Window %d: p50 %.1fms, p95 %.1fms, NDCG@%d %.4f"
+                           % (window_size, report[-1]["latency_p50_ms"], report[-1]["latency_p95_ms"], k,
+                              report[-1]["ndcg@%d" % k]))
 
-def ltr_query(keywords, model_name):
-    import json
-    baseQuery['rescore']['query']['rescore_query']['sltr']['model'] = model_name
-    baseQuery['query']['multi_match']['query'] = keywords
-    baseQuery['rescore']['query']['rescore_query']['sltr']['params']['keywords'] = keywords
-    Logger.logger.info("%s" % json.dumps(baseQuery))
-    return baseQuery
+    report = pd.DataFrame(report)
+    if output_file:
+        report.to_csv(output_file, index=False)
+    Logger.logger.info(report.to_string(index=False))
+    return report
 
 
 if __name__ == "__main__":
     from sys import argv
 
-    es = elastic_connection(timeout=1000)
+    es = elastic_connection()
     model = MODEL_NAME
     if len(argv) > 2:
         model = argv[2]
-    results = es.search(index=INDEX_NAME, body=ltr_query(argv[1], model))
+    results = es.search(index=INDEX_NAME, body=ltr_query(argv[1], model, log_features=False))
     for result in results['hits']['hits']:
         Logger.logger.info(result['_source']['name'])
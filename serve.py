@@ -0,0 +1,226 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from registry import Registry
+from search import _result, ltr_query, search_batch
+from utils import ElasticsearchHTTPError, Logger, Profiler, elastic_connection, ES_HOST, INDEX_NAME, MODEL_FILE, \
+    MODEL_NAME, REGISTRY_FILE
+
+# the search options a request can set, lists are turned into tuples for the template cache
+SEARCH_OPTIONS = ("window_size", "first_phase", "fields", "source")
+
+
+class SearchService(object):
+    """
+    Answers search and score requests with everything kept warm between them: the Elasticsearch client and its
+    pooled connections, the compiled search templates, the registry and the loaded models. The registry and the
+    model files are reloaded when they change on disk, so activating another version does not need a restart.
+    """
+
+    def __init__(self, index_name: str = INDEX_NAME, model_name: str = MODEL_NAME, model_file: str = MODEL_FILE,
+                 registry_file: str = REGISTRY_FILE, url: str = ES_HOST, pool_maxsize=10, **options):
+        """
+        :param index_name:          the index searched when a request does not name one
+        :param model_name:          the model searched with when a request does not name one
+        :param model_file:          the model file of the local scoring, requests cannot name another file
+        :param registry_file:       the manifest that resolves model names to their active versions
+        :param url:                 the Elasticsearch URL
+        :param pool_maxsize:        the connections kept alive, the most concurrent searches without waiting
+        :param options:             the default search options of `search.search_template`
+        """
+        self.index_name = index_name
+        self.model_name = model_name
+        self.model_file = model_file
+        self.options = options
+        self.es = elastic_connection(url=url, maxsize=pool_maxsize)
+        self._url = url
+        self._registry_file = registry_file
+        self._registry = (None, None)
+        self._reranker = (None, None)
+        self._lock = threading.Lock()
+
+    def _modified(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def resolve(self, model_name):
+        """ returns the active version of a model name, reloading the registry if its manifest changed """
+        modified = self._modified(self._registry_file)
+        with self._lock:
+            if self._registry[0] != modified or self._registry[1] is None:
+                self._registry = (modified, Registry(self._registry_file, self._url))
+            registry = self._registry[1]
+        return registry.resolve("models", model_name)
+
+    def reranker(self):
+        """ returns the model of the model file for local scoring, loaded again when the file changed """
+        from rerank import Reranker
+
+        modified = self._modified(self.model_file)
+        with self._lock:
+            if self._reranker[1] is None or self._reranker[0] != modified:
+                self._reranker = (modified, Reranker.from_files(self.model_file))
+            return self._reranker[1]
+
+    def _options(self, request):
+        options = dict(self.options)
+        for name in SEARCH_OPTIONS:
+            if name in request:
+                value = request[name]
+                options[name] = tuple(value) if isinstance(value, list) else value
+        return options
+
+    def warm_up(self):
+        """ opens a connection, compiles the default template and loads the default model file """
+        start = time.perf_counter()
+        self.es.info()
+        ltr_query("", self.resolve(self.model_name), **self.options)
+        if os.path.exists(self.model_file):
+            self.reranker()
+        Logger.logger.info("*** Warmed up in %.3fs" % (time.perf_counter() - start))
+
+    @Profiler.timed("serve_search")
+    def search(self, request: dict):
+        """
+        :param request:             `query` (the keywords), and optionally `model`, `index`, `size`, `verbose`,
+                                    `id` and the search options
+        :return:                    the result of the query (see `search.search_batch`)
+        """
+        verbose = bool(request.get("verbose"))
+        body = ltr_query(request["query"], self.resolve(request.get("model", self.model_name)),
+                         log_features=verbose, **self._options(request))
+        if "size" in request:
+            body = dict(body, size=request["size"])
+        start = time.perf_counter()
+        response = self.es.search(index=request.get("index", self.index_name), body=body)
+        return _result(request.get("id"), request["query"], response, time.perf_counter() - start, verbose)
+
+    @Profiler.timed("serve_batch")
+    def batch(self, request: dict):
+        """
+        :param request:             `queries` (a list of keywords or of objects with `query` and `id`), and
+                                    optionally `model`, `index`, `verbose`, `chunk_size` and the search options
+        :return:                    the results of the queries in their order
+        """
+        queries = [(entry.get("id", i), entry["query"]) if isinstance(entry, dict) else (i, entry)
+                   for i, entry in enumerate(request["queries"], 1)]
+        return list(search_batch(self.es, queries, request.get("index", self.index_name),
+                                 self.resolve(request.get("model", self.model_name)),
+                                 request.get("chunk_size", 100), 1, bool(request.get("verbose")),
+                                 **self._options(request)))
+
+    @Profiler.timed("serve_score")
+    def score(self, request: dict):
+        """
+        :param request:             `features` (a list of feature vectors), and optionally `feature_names` (the
+                                    model features in model order if not set). The vectors are scored with the model
+                                    file of the service, a request cannot make the server read another file.
+        :return:                    the scores of the feature vectors
+        """
+        reranker = self.reranker()
+        return reranker.score(request["features"], request.get("feature_names")).tolist()
+
+
+class SearchServer(object):
+    """
+    Serves a `SearchService` over HTTP on a local port:
+
+    - `POST /search` runs one query, `POST /batch` many queries through `_msearch`
+    - `POST /score` scores feature vectors with the model file of the service, without Elasticsearch
+    - `GET /health` reports the uptime and the number of answered requests
+    """
+
+    def __init__(self, service: SearchService, host="127.0.0.1", port=8765):
+        self.service = service
+        self.requests = 0
+        self.started = time.time()
+        self._requests_lock = threading.Lock()
+        routes = {"/search": service.search, "/batch": service.batch, "/score": service.score}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, status, body):
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if urlsplit(self.path).path != "/health":
+                    return self._respond(404, {"error": "unknown path %s" % self.path})
+                self._respond(200, {"status": "ok", "uptime_seconds": time.time() - server.started,
+                                    "requests": server.requests})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                route = routes.get(urlsplit(self.path).path)
+                if route is None:
+                    return self._respond(404, {"error": "unknown path %s" % self.path})
+                with server._requests_lock:
+                    server.requests += 1
+                try:
+                    status, body = 200, route(json.loads(raw or b'{}'))
+                except (KeyError, TypeError, ValueError) as e:
+                    status, body = 400, {"error": "bad request: %r" % e}
+                except ElasticsearchHTTPError as e:
+                    status, body = 502, {"error": str(e)}
+                except Exception as e:
+                    # the errors of the elasticsearch client
+                    status, body = 502, {"error": repr(e)}
+                self._respond(status, body)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        Logger.logger.info("*** Serving searches on %s" % self.url)
+        return self
+
+    def serve_forever(self):
+        Logger.logger.info("*** Serving searches on %s" % self.url)
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    search_service = SearchService()
+    search_service.warm_up()
+    SearchServer(search_service, port=int(argv[1]) if len(argv) > 1 else 8765).serve_forever()
@@ -20,6 +20,10 @@ setup(
         'scipy>=1.1.0',
         'fairsearchdeltr>=1.0.1'
     ],
+    extras_require={
+        'arrow': ['pyarrow>=2.0'],
+        'async': ['elasticsearch[async]>=7.8']
+    },
     tests_require=[
         'pytest>=2.8.0'
     ],
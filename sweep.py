@@ -0,0 +1,144 @@
+import itertools
+import json
+import random
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+import pandas as pd
+
+from engine import DeltrEngine
+from features import read_features
+from metrics import exposure_ratio, ndcg
+from rerank import save_standardization
+from utils import Logger, FEATURES_FILE, MODEL_FILE
+
+# arrays attached from shared memory in every worker
+_shared = {}
+
+
+def _share(arrays: dict):
+    """ copies the arrays into shared memory blocks, returns the blocks and their descriptions for the workers """
+    blocks, descriptions = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        descriptions[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, descriptions
+
+
+def _attach(descriptions: dict):
+    for name, (block_name, shape, dtype) in descriptions.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        # keep a reference to the block, otherwise the buffer is released
+        _shared[name + "_block"] = block
+        _shared[name] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+
+
+def _train_and_score(args):
+    config, train_parameters, protected_feature_name, protected_column, k, n_train = args
+    # the train rows come before the test rows, so both are slices of the shared arrays instead of copies
+    query_ids, feature_matrix, judgements = _shared["query_ids"], _shared["features"], _shared["judgements"]
+
+    np.random.seed(config["seed"])
+    dtr = DeltrEngine(protected_feature_name, config["gamma"], learning_rate=config["learning_rate"],
+                      lambdaa=config["lambdaa"], init_var=config["init_var"], **train_parameters)
+    omega = dtr.train_arrays(query_ids[:n_train], feature_matrix[:n_train], judgements[:n_train], protected_column)
+
+    test_features = feature_matrix[n_train:]
+    scores = dtr.predict(test_features)
+    test_queries = query_ids[n_train:]
+    result = dict(config)
+    result["ndcg"] = float(np.mean(ndcg(test_queries, scores, judgements[n_train:], k)))
+    result["exposure_disparity"] = float(np.nanmean(np.abs(1 - exposure_ratio(
+        test_queries, scores, test_features[:, protected_column] == 1, k))))
+    result["iterations"] = dtr.iterations
+    result["training_time"] = dtr.training_time
+    result["omega"] = omega.tolist()
+    result["mu"], result["sigma"] = dtr.mus, dtr.sigmas
+    return result
+
+
+def configurations(gammas, learning_rates, lambdas, init_vars, samples=None, seed=42):
+    """
+    Creates the grid of configurations to train
+    :param samples:             if set, only a random sample of this many configurations of the grid is returned
+    :return:                    list of configuration dicts
+    """
+    grid = [{"gamma": gamma, "learning_rate": learning_rate, "lambdaa": lambdaa, "init_var": init_var}
+            for gamma, learning_rate, lambdaa, init_var in itertools.product(gammas, learning_rates, lambdas,
+                                                                             init_vars)]
+    if samples is not None and samples < len(grid):
+        grid = random.Random(seed).sample(grid, samples)
+    for config in grid:
+        config["seed"] = seed
+    return grid
+
+
+def sweep(features_file: str, configs: list, leaderboard_file: str, model_output: str,
+          protected_feature_name="1", holdout=0.2, k=10, rank_by="ndcg", processes=None, seed=42,
+          **train_parameters):
+    """
+    Trains a model for every configuration and scores it on held-out queries. The features are read once and
+    shared with the worker processes through shared memory.
+    :param features_file:           The train file with features and judgements
+    :param configs:                 The configurations to train (see `configurations`)
+    :param leaderboard_file:        The CSV file where the scores of all configurations are written
+    :param model_output:            The file where the model of the best configuration is stored
+    :param protected_feature_name:  The name of the column in the data that contains protected attribute
+    :param holdout:                 Fraction of the queries held out for scoring
+    :param k:                       Cut-off for NDCG and the exposure
+    :param rank_by:                 `ndcg` (higher is better) or `exposure_disparity` (lower is better)
+    :param processes:               Number of worker processes
+    :param train_parameters:        Other `DeltrEngine` parameters shared by all configurations
+    :return:                        the result of the best configuration
+    """
+    Logger.logger.info("*** Reading train data ")
+    train_data = read_features(features_file)
+    feature_names = train_data.columns.tolist()[2:-1]
+    if protected_feature_name not in feature_names:
+        raise ValueError("The name of the protected feature does not appear in the features file")
+    protected_column = feature_names.index(protected_feature_name)
+
+    query_ids = pd.factorize(train_data.iloc[:, 0])[0].astype(np.int64)
+    unique_queries = np.unique(query_ids)
+    test_queries = np.random.RandomState(seed).permutation(unique_queries)[:max(1, int(len(unique_queries) *
+                                                                                         holdout))]
+    is_test = np.isin(query_ids, test_queries)
+    # the train rows first and the test rows after them, both in their original order
+    order = np.argsort(is_test, kind='stable')
+
+    blocks, descriptions = _share({
+        "query_ids": query_ids[order],
+        "features": np.asarray(train_data.iloc[:, 2:-1], dtype=np.float64)[order],
+        "judgements": np.asarray(train_data.iloc[:, -1], dtype=np.float64)[order],
+    })
+    n_train = int(np.count_nonzero(~is_test))
+    del train_data
+
+    Logger.logger.info("*** Training %d configurations on %d queries, scoring on %d held-out queries"
+                       % (len(configs), len(unique_queries) - len(test_queries), len(test_queries)))
+    try:
+        with Pool(processes, initializer=_attach, initargs=(descriptions,)) as pool:
+            results = pool.map(_train_and_score, [(config, train_parameters, protected_feature_name,
+                                                   protected_column, k, n_train) for config in configs])
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    leaderboard = pd.DataFrame(results).sort_values(rank_by, ascending=(rank_by != "ndcg"))
+    leaderboard.drop(columns=["omega", "mu", "sigma"]).to_csv(leaderboard_file, index=False)
+    Logger.logger.info(leaderboard.drop(columns=["omega", "mu", "sigma"]).head(10).to_string(index=False))
+
+    best = leaderboard.iloc[0].to_dict()
+    with open(model_output, 'w') as f:
+        json.dump(dict(zip(feature_names, best["omega"])), f)
+    save_standardization(model_output, protected_feature_name, best["mu"], best["sigma"])
+    Logger.logger.info("*** Saved the best model to %s" % model_output)
+    return best
+
+
+if __name__ == "__main__":
+    sweep(FEATURES_FILE, configurations([0, 0.5, 1], [0.001, 0.01], [0.001], [0.01]), "leaderboard.csv", MODEL_FILE,
+          number_of_iterations=100)
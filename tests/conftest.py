@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the modules are top-level scripts and `utils` reads `setup.cfg` from the working directory
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from engine import DeltrEngine, compare_with_reference
+from features import FeaturesWriter
+
+FEATURE_NAMES = ["1", "2", "3"]
+
+
+def _write_features(path, n_queries=12, seed=3):
+    rng = np.random.RandomState(seed)
+    with FeaturesWriter(str(path)) as writer:
+        for query_id in range(n_queries):
+            size = rng.randint(2, 7)
+            values = rng.rand(size, 3) * 4
+            # both groups in every query, the reference divides by the size of each group
+            values[:, 0] = rng.permutation(np.arange(size) % 2)
+            writer.write(query_id, ["d%d" % i for i in range(size)], FEATURE_NAMES, values.tolist(),
+                         rng.randint(0, 3, size).tolist())
+    return str(path)
+
+
+def test_the_engine_matches_the_reference(tmp_path):
+    pytest.importorskip("fairsearchdeltr")
+    difference, _ = compare_with_reference(_write_features(tmp_path / "features.csv"), number_of_iterations=20,
+                                           processes=1)
+    assert difference < 1e-8
+
+
+def test_sharded_training_matches_a_single_process(tmp_path):
+    from features import read_features
+
+    train_data = read_features(_write_features(tmp_path / "features.csv"))
+    weights = []
+    for processes in (1, 3):
+        np.random.seed(7)
+        weights.append(DeltrEngine("1", 1, number_of_iterations=10, processes=processes).train(train_data))
+    assert np.isfinite(weights[0]).all()
+    np.testing.assert_allclose(weights[0], weights[1], rtol=0, atol=1e-12)
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from features import FeaturesWriter, features_format, iter_features, read_features
+
+FEATURE_NAMES = ["1", "2", "3"]
+# (query id, document ids, feature values, judgements) of the logged queries
+QUERIES = [
+    (1, ["a", "b", "c"], [[1.0, 0.5, 2.0], [0.0, 1.5, 3.0], [1.0, 0.0, 0.25]], [2, 0, 1]),
+    (2, ["d"], [[0.0, 2.0, 1.0]], [0]),
+    (3, ["e", "f"], [[1.0, 1.0, 1.0], [0.0, 0.75, 4.0]], [1, 1]),
+]
+
+FORMATS = ["features.csv", "features.arrow"]
+
+
+def _write(path, batch_rows=65536, **options):
+    with FeaturesWriter(str(path), batch_rows=batch_rows, **options) as writer:
+        for query_id, document_ids, values, judgements in QUERIES:
+            writer.write(query_id, document_ids, FEATURE_NAMES, values, judgements)
+    return writer.rows
+
+
+def _expected():
+    rows = [[query_id, document_id] + row + [judgement]
+            for query_id, document_ids, values, judgements in QUERIES
+            for document_id, row, judgement in zip(document_ids, values, judgements)]
+    return pd.DataFrame(rows, columns=["query_id", "document_id"] + FEATURE_NAMES + ["judgement"])
+
+
+def _require_format(name):
+    if features_format(name) == "arrow":
+        pytest.importorskip("pyarrow")
+
+
+@pytest.mark.parametrize("name", FORMATS)
+def test_round_trip(tmp_path, name):
+    _require_format(name)
+    assert _write(tmp_path / name, batch_rows=2) == 6
+    features = read_features(str(tmp_path / name))
+    expected = _expected()
+
+    assert features.columns.tolist() == expected.columns.tolist()
+    assert features["query_id"].tolist() == expected["query_id"].tolist()
+    assert features["document_id"].astype(str).tolist() == expected["document_id"].tolist()
+    np.testing.assert_array_equal(np.asarray(features[FEATURE_NAMES], dtype=np.float64),
+                                  np.asarray(expected[FEATURE_NAMES], dtype=np.float64))
+    assert features["judgement"].tolist() == expected["judgement"].tolist()
+
+
+def test_judgements_have_the_same_type_in_both_formats(tmp_path):
+    pytest.importorskip("pyarrow")
+    _write(tmp_path / "features.csv")
+    _write(tmp_path / "features.arrow", compression="zstd")
+    assert read_features(str(tmp_path / "features.csv"))["judgement"].dtype == np.int64
+    assert read_features(str(tmp_path / "features.arrow"))["judgement"].dtype == np.int64
+
+
+def test_arrow_float32_values(tmp_path):
+    pytest.importorskip("pyarrow")
+    _write(tmp_path / "features.arrow", value_type="float32")
+    features = read_features(str(tmp_path / "features.arrow"))
+    assert (features[FEATURE_NAMES].dtypes == np.float32).all()
+
+
+@pytest.mark.parametrize("name", FORMATS)
+def test_chunks_keep_whole_queries(tmp_path, name):
+    _require_format(name)
+    _write(tmp_path / name, batch_rows=1)
+    chunks = list(iter_features(str(tmp_path / name), chunk_rows=2))
+    assert sum(len(chunk) for chunk in chunks) == 6
+    queries = [set(chunk["query_id"]) for chunk in chunks]
+    for i, first in enumerate(queries):
+        for second in queries[i + 1:]:
+            assert not first & second
+
+
+def test_feature_names_must_not_change(tmp_path):
+    with FeaturesWriter(str(tmp_path / "features.csv")) as writer:
+        writer.write(1, ["a"], FEATURE_NAMES, [[1.0, 2.0, 3.0]], [1])
+        with pytest.raises(ValueError):
+            writer.write(2, ["b"], ["1", "2"], [[1.0, 2.0]], [1])
@@ -0,0 +1,32 @@
+import pandas as pd
+
+from judgements import JudgementStore
+
+
+def _store():
+    return JudgementStore(pd.DataFrame({"query_id": [1, 1, 2, 1], "document_id": ["a", "b", "c", "a"],
+                                        "judgement": [2, 0, 1, 1]}))
+
+
+def test_lookup_by_query_and_document():
+    store = _store()
+    assert len(store) == 3
+    assert store.query_ids() == [1, 2]
+    assert 2 in store and 3 not in store
+    assert store.ids(1) == ["a", "b"]
+    assert store.ids(3) == []
+    assert store.judgement(2, "c") == 1
+    assert store.judgement(2, "a", default=-1) == -1
+
+
+def test_the_first_duplicate_judgement_is_kept():
+    assert _store().judgement(1, "a") == 2
+
+
+def test_from_csv(tmp_path):
+    judgments_file = str(tmp_path / "judgements.csv")
+    pd.DataFrame({"query_id": [5, 5], "document_id": ["x", "y"], "judgement": [1, 0],
+                  "comment": ["", ""]}).to_csv(judgments_file, index=False)
+    store = JudgementStore.from_csv(judgments_file)
+    assert store.ids(5) == ["x", "y"]
+    assert store.judgement(5, "y") == 0
@@ -0,0 +1,31 @@
+import pytest
+
+from mapping import lean_mapping
+from utils import FEATURE_SET_FILE
+
+SEARCH_FIELDS = ["mails.subject", "mails.body^2", "mails.email"]
+
+
+def test_only_the_queried_fields_are_indexed():
+    mapping = lean_mapping(FEATURE_SET_FILE, SEARCH_FIELDS)
+    assert mapping["dynamic"] is False
+    mails = mapping["properties"]["mails"]["properties"]
+    assert sorted(mails) == ["body", "email", "subject"]
+    assert all(field == {"type": "text", "index_options": "freqs"} for field in mails.values())
+
+
+def test_the_script_field_keeps_doc_values_only():
+    gender = lean_mapping(FEATURE_SET_FILE, SEARCH_FIELDS)["properties"]["gender"]
+    assert not gender["index"] and not gender["doc_values"]
+    assert gender["fields"]["keyword"]["doc_values"]
+    assert not gender["fields"]["keyword"]["index"]
+
+
+def test_phrase_first_phase_keeps_positions():
+    mails = lean_mapping(FEATURE_SET_FILE, SEARCH_FIELDS, first_phase="phrase")["properties"]["mails"]["properties"]
+    assert all(field == {"type": "text"} for field in mails.values())
+
+
+def test_a_named_first_phase_needs_the_searched_fields():
+    with pytest.raises(ValueError):
+        lean_mapping(FEATURE_SET_FILE)
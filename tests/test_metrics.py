@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from metrics import average_precision, exposure_ratio, group_exposure, ndcg
+
+
+def test_ndcg_of_a_single_query():
+    # ranked by score: judgements 0, 2, 1
+    dcg = (2 ** 2 - 1) / np.log2(3) + (2 ** 1 - 1) / np.log2(4)
+    ideal = (2 ** 2 - 1) / np.log2(2) + (2 ** 1 - 1) / np.log2(3)
+    result = ndcg(np.array([7, 7, 7]), np.array([3.0, 2.0, 1.0]), np.array([0, 2, 1]))
+    assert result == pytest.approx([dcg / ideal])
+
+
+def test_ndcg_is_per_query_in_ascending_query_order():
+    query_ids = np.array([2, 1, 2, 1])
+    scores = np.array([1.0, 1.0, 2.0, 2.0])
+    judgements = np.array([1, 1, 0, 0])
+    result = ndcg(query_ids, scores, judgements)
+    assert result.shape == (2,)
+    assert result[0] == pytest.approx(result[1])
+    assert result[0] < 1
+
+
+def test_ndcg_cut_off_and_unjudged_queries():
+    query_ids = np.array([1, 1, 1, 2, 2])
+    scores = np.array([3.0, 2.0, 1.0, 2.0, 1.0])
+    judgements = np.array([0, 0, 1, 0, 0])
+    result = ndcg(query_ids, scores, judgements, k=2)
+    # the relevant document is below the cut-off, and a query without relevant documents scores 0
+    assert result.tolist() == [0.0, 0.0]
+    assert ndcg(query_ids, -scores, judgements, k=2)[0] == pytest.approx(1.0)
+
+
+def test_average_precision():
+    # relevant documents at ranks 1 and 3
+    result = average_precision(np.array([1, 1, 1]), np.array([3.0, 2.0, 1.0]), np.array([1, 0, 2]))
+    assert result == pytest.approx([(1 / 1 + 2 / 3) / 2])
+
+
+def test_exposure_ratio_of_equal_groups():
+    query_ids = np.array([1, 1, 1, 1])
+    scores = np.array([4.0, 3.0, 2.0, 1.0])
+    protected = np.array([True, False, False, True])
+    exposure_protected, exposure_nonprotected = group_exposure(query_ids, scores, protected)
+    assert exposure_protected[0] == pytest.approx((1 + 1 / np.log2(5)) / 2)
+    assert exposure_nonprotected[0] == pytest.approx((1 / np.log2(3) + 1 / np.log2(4)) / 2)
+    assert exposure_ratio(query_ids, scores, protected)[0] == pytest.approx(
+        exposure_protected[0] / exposure_nonprotected[0])
+
+
+def test_exposure_ratio_of_one_sided_queries_is_nan():
+    query_ids = np.array([1, 1, 1, 2, 2, 2])
+    scores = np.array([3.0, 2.0, 1.0, 3.0, 2.0, 1.0])
+    # query 1 has only protected documents, the non-protected document of query 2 is below the cut-off
+    protected = np.array([True, True, True, True, True, False])
+    ratios = exposure_ratio(query_ids, scores, protected, k=2)
+    assert np.isnan(ratios).all()
+
+    # the one-sided queries are left out of the mean instead of making it infinite
+    query_ids = np.append(query_ids, [3, 3])
+    scores = np.append(scores, [2.0, 1.0])
+    protected = np.append(protected, [False, True])
+    mean = np.nanmean(exposure_ratio(query_ids, scores, protected, k=2))
+    assert np.isfinite(mean)
+    assert mean == pytest.approx(1 / np.log2(3))
+
+
+def test_exposure_ratio_without_protected_exposure_is_zero():
+    ratios = exposure_ratio(np.array([1, 1, 1]), np.array([3.0, 2.0, 1.0]), np.array([False, False, True]), k=2)
+    assert ratios.tolist() == [0.0]
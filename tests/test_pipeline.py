@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from pipeline import StageManifest, TrainingArrays, log_to_arrays
+
+FEATURE_NAMES = ["1", "2"]
+ROWS = [(1, ["a", "b"], FEATURE_NAMES, [[1.0, 0.5], [0.0, 2.0]], [1, 0]),
+        (2, ["c"], FEATURE_NAMES, [[1.0, 1.5]], [2])]
+
+
+def test_a_stage_is_fresh_with_the_same_fingerprint_and_its_outputs(tmp_path):
+    manifest_file = str(tmp_path / "stages.json")
+    output = tmp_path / "features.csv"
+    output.write_text("")
+    StageManifest(manifest_file).record("log", "abc", [str(output)])
+
+    manifest = StageManifest(manifest_file)
+    assert manifest.fresh("log", "abc")
+    assert not manifest.fresh("log", "def")
+    assert not manifest.fresh("train", "abc")
+    output.unlink()
+    assert not manifest.fresh("log", "abc")
+
+
+def test_logged_rows_become_arrays_and_a_features_file(tmp_path):
+    features_file = str(tmp_path / "features.csv")
+    arrays = log_to_arrays((row for row in ROWS), features_file, queue_size=1)
+    query_ids, matrix, judgements = arrays.arrays()
+    assert arrays.feature_names == FEATURE_NAMES
+    assert query_ids.tolist() == [1, 1, 2]
+    np.testing.assert_array_equal(matrix, [[1.0, 0.5], [0.0, 2.0], [1.0, 1.5]])
+    assert judgements.tolist() == [1.0, 0.0, 2.0]
+
+    from_file = TrainingArrays.from_features_file(features_file)
+    assert from_file.feature_names == FEATURE_NAMES
+    for logged, read in zip(arrays.arrays(), from_file.arrays()):
+        np.testing.assert_array_equal(logged, read)
+
+
+def test_a_logging_error_reaches_the_consumer(tmp_path):
+    def rows():
+        yield ROWS[0]
+        raise RuntimeError("logging failed")
+
+    with pytest.raises(RuntimeError):
+        log_to_arrays(rows(), str(tmp_path / "features.csv"), queue_size=1)
+
+
+def test_features_must_not_change():
+    arrays = TrainingArrays()
+    arrays.add(*ROWS[0])
+    with pytest.raises(ValueError):
+        arrays.add(3, ["d"], ["1"], [[1.0]], [0])
@@ -0,0 +1,93 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from rerank import Reranker, save_standardization, top_k
+
+WEIGHTS = {"1": 0.5, "2": -1.0, "3": 2.0}
+
+
+def _standardized_scores(matrix, protected_column, mu, sigma, omega):
+    standardized = (matrix - mu) / sigma
+    standardized[:, protected_column] = matrix[:, protected_column]
+    return standardized.dot(omega)
+
+
+def test_standardization_is_folded_into_the_weights():
+    rng = np.random.RandomState(0)
+    matrix = rng.rand(20, 3) * 10
+    matrix[:, 0] = rng.randint(0, 2, 20)
+    reranker = Reranker(WEIGHTS, "1", mu=3.5, sigma=2.5)
+    expected = _standardized_scores(matrix, 0, 3.5, 2.5, np.array(list(WEIGHTS.values())))
+    np.testing.assert_allclose(reranker.score(matrix), expected)
+
+
+def test_without_standardization_the_raw_features_are_scored():
+    matrix = np.array([[1.0, 2.0, 3.0], [0.0, 1.0, 0.5]])
+    np.testing.assert_allclose(Reranker(WEIGHTS).score(matrix), matrix.dot([0.5, -1.0, 2.0]))
+
+
+def test_columns_are_matched_by_name():
+    reranker = Reranker(WEIGHTS, "1", mu=1.0, sigma=2.0)
+    matrix = np.array([[1.0, 2.0, 3.0, 9.0], [0.0, 1.0, 0.5, 9.0]])
+    shuffled = matrix[:, [2, 0, 3, 1]]
+    np.testing.assert_allclose(reranker.score(shuffled, ["3", "1", "extra", "2"]), reranker.score(matrix[:, :3]))
+    with pytest.raises(ValueError):
+        reranker.score(matrix[:, :2], ["1", "2"])
+
+
+def test_from_files_reads_the_standardization_sidecar(tmp_path):
+    model_file = str(tmp_path / "model.txt")
+    with open(model_file, 'w') as f:
+        json.dump(WEIGHTS, f)
+    assert Reranker.from_files(model_file).intercept == 0.0
+
+    save_standardization(model_file, "1", 3.5, 2.5)
+    loaded = Reranker.from_files(model_file)
+    expected = Reranker(WEIGHTS, "1", 3.5, 2.5)
+    np.testing.assert_allclose(loaded.omega, expected.omega)
+    assert loaded.intercept == pytest.approx(expected.intercept)
+
+
+def test_scores_match_the_trained_engine():
+    pytest.importorskip("fairsearchdeltr")
+    from engine import DeltrEngine
+
+    rng = np.random.RandomState(1)
+    query_ids = np.repeat(np.arange(10), 5)
+    matrix = rng.rand(50, 3) * 5
+    matrix[:, 0] = rng.randint(0, 2, 50)
+    judgements = rng.randint(0, 3, 50).astype(np.float64)
+    np.random.seed(1)
+    dtr = DeltrEngine("1", 1, number_of_iterations=5, standardize=True)
+    omega = dtr.train_arrays(query_ids, matrix, judgements, 0)
+
+    reranker = Reranker(dict(zip(["1", "2", "3"], omega)), "1", dtr.mus, dtr.sigmas)
+    np.testing.assert_allclose(reranker.score(matrix), dtr.predict(matrix))
+
+
+def test_top_k_matches_a_full_sort():
+    rng = np.random.RandomState(2)
+    query_ids = rng.randint(0, 30, 300)
+    scores = rng.rand(300)
+    rows, ranks = top_k(query_ids, scores, 4, chunk_queries=7)
+
+    expected = []
+    for query_id in np.unique(query_ids):
+        candidates = np.flatnonzero(query_ids == query_id)
+        expected.extend(candidates[np.argsort(-scores[candidates], kind='stable')][:4])
+    assert rows.tolist() == expected
+    assert ranks.tolist() == [rank for query_id in np.unique(query_ids)
+                              for rank in range(min(4, np.count_nonzero(query_ids == query_id)))]
+
+
+def test_rerank_ranks_every_query():
+    features = pd.DataFrame({"query_id": [1, 1, 1, 2], "document_id": ["a", "b", "c", "d"],
+                             "1": [0, 1, 0, 1], "2": [1.0, 0.0, 3.0, 1.0], "3": [0.5, 0.5, 0.0, 0.0],
+                             "judgement": [1, 0, 2, 0]})
+    ranking = Reranker(WEIGHTS).rerank(features, k=2)
+    assert ranking["query_id"].tolist() == [1, 1, 2]
+    assert ranking["document_id"].tolist() == ["b", "a", "d"]
+    assert ranking["rank"].tolist() == [1, 2, 1]
@@ -1,28 +1,38 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 
 import pandas as pd
 from fairsearchdeltr import Deltr
 
-from utils import Logger, elastic_connection, ES_HOST, ES_AUTH, JUDGMENTS_FILE, \
+from cache import FeatureCache, feature_set_digest
+from engine import DeltrEngine
+from features import FeaturesWriter, read_features
+from judgements import JudgementStore
+from rerank import save_standardization
+from utils import Logger, LazyJson, Param, Profiler, QueryTemplate, batches, elastic_connection, es_request, \
+    ordered_map, JUDGMENTS_FILE, \
     FEATURE_SET_NAME, MODEL_FILE, QUERIES_FILE, FEATURES_FILE, INDEX_NAME
 
-log_query = {
-  "size": 1000,
+# the most judged document ids sent in a single logging (sub-)request, larger judgement lists are split
+MAX_LOG_IDS = 1000
+
+log_query = QueryTemplate({
+  "size": Param("size"),
   "query": {
     "bool": {
       "filter": [
         {
           "terms": {
-            "_id": [
-            ]
+            "_id": Param("ids")
           }
         },
         {
           "sltr": {
             "_name": "logged_featureset",
-            "featureset": "",
+            "featureset": Param("feature_set_name"),
             "params": {
-              "keywords": ""
+              "keywords": Param("keywords")
             }
           }
         }
@@ -38,62 +48,205 @@ log_query = {
       }
     }
   }
-}
+})
 
 
-def log_features(es, query_id: int, query: str, ids: list, feature_set_name: str, index_name: str):
+def _log_query_body(query: str, ids: list, feature_set_name: str):
     """
-    :param es:                      Elasicsearch client
+    Builds the body of a feature logging request
     :param query:                   Query to train on
     :param ids:                     Document IDs with known judgements for this query
     :param feature_set_name:        What feature set to get the score for
-    :param index_name:              What index to search against
-    :return:
+    :return:                        a new body rendered from `log_query`
     """
-    log_query['query']['bool']['filter'][0]['terms']['_id'] = ids
-    log_query['query']['bool']['filter'][1]['sltr']['params']['keywords'] = query
-    log_query['query']['bool']['filter'][1]['sltr']['featureset'] = feature_set_name
-    Logger.logger.info("*** POST " + str(query_id))
-    Logger.logger.info(json.dumps(log_query, indent=2))
-    resp = es.search(index=index_name, body=log_query)
-    return resp['hits']['hits']
+    return log_query.render(ids=ids, keywords=query, feature_set_name=feature_set_name, size=len(ids))
 
 
-def collect_train_data(es, queries_file, judgments_file, feature_set_name, index_name, features_file):
-    """ CCollects the train data from Elasticsearch
-    """
-    queries = pd.read_csv(queries_file)
-    judgements = pd.read_csv(judgments_file)
+def _id_chunks(ids: list, max_ids: int):
+    return [ids[i:i + max_ids] for i in range(0, len(ids), max_ids)] or [[]]
+
 
-    header_id = "query_id,document_id"
-    header_feat = None
-    header_judgement = "judgement"
+def _report_missing(query_id, ids: list, hits: list):
+    """ warns about the judged documents that Elasticsearch did not return for a query """
+    returned = {hit['_id'] for hit in hits}
+    missing = [doc_id for doc_id in ids if str(doc_id) not in returned]
+    if missing:
+        Profiler.count("log.missing", len(missing))
+        Logger.logger.warning("*** Query %s: %d of %d judged documents were not returned, e.g. %s"
+                              % (query_id, len(missing), len(ids), ", ".join(str(d) for d in missing[:10])))
+    return missing
 
-    with open(features_file, 'w') as f:
-        for q in range(queries.shape[0]):
-            q_id  = queries.loc[q]['query_id']
-            keywords = queries.loc[q]['keywords']
-            ids = judgements.loc[judgements['query_id'] == q_id]['document_id'].tolist()
-            hits = log_features(es, q_id, keywords, ids, feature_set_name, index_name)
 
+@Profiler.timed("log_features")
+def log_features(es, query_id: int, query: str, ids: list, feature_set_name: str, index_name: str,
+                 max_ids=MAX_LOG_IDS):
+    """
+    :param es:                      Elasicsearch client
+    :param query:                   Query to train on
+    :param ids:                     Document IDs with known judgements for this query
+    :param feature_set_name:        What feature set to get the score for
+    :param index_name:              What index to search against
+    :param max_ids:                 The most ids per request, longer id lists are logged with several requests
+    :return:                        the hits of all the requests
+    """
+    hits = []
+    for chunk in _id_chunks(ids, max_ids):
+        body = _log_query_body(query, chunk, feature_set_name)
+        Logger.logger.info("*** POST " + str(query_id))
+        Logger.logger.debug("%s", LazyJson(body, indent=2))
+        resp = es.search(index=index_name, body=body)
+        Profiler.count("log.requests")
+        Profiler.count("log.docs", len(resp['hits']['hits']))
+        hits.extend(resp['hits']['hits'])
+    _report_missing(query_id, ids, hits)
+    return hits
+
+
+@Profiler.timed("log_features_batch")
+def log_features_batch(es, batch: list, feature_set_name: str, index_name: str, max_ids=MAX_LOG_IDS):
+    """
+    Logs the features for several queries with a single `_msearch` request
+    :param es:                      Elasicsearch client
+    :param batch:                   List of (query_id, query, ids) tuples
+    :param feature_set_name:        What feature set to get the score for
+    :param index_name:              What index to search against
+    :param max_ids:                 The most ids per search, longer id lists are split over several searches
+    :return:                        list with the hits for each query, in the same order as `batch`
+    """
+    body, owners = [], []
+    for position, (_, query, ids) in enumerate(batch):
+        for chunk in _id_chunks(ids, max_ids):
+            body.append({"index": index_name})
+            body.append(_log_query_body(query, chunk, feature_set_name))
+            owners.append(position)
+
+    Logger.logger.info("*** MSEARCH " + ",".join([str(q_id) for q_id, _, _ in batch]))
+    Logger.logger.debug("%s", LazyJson(body))
+    resp = es.msearch(body=body, index=index_name)
+    Profiler.count("log.requests")
+
+    hits = [[] for _ in batch]
+    for position, response in zip(owners, resp['responses']):
+        if 'error' in response:
+            raise RuntimeError("Feature logging failed for query %s: %s" % (batch[position][0], response['error']))
+        hits[position].extend(response['hits']['hits'])
+        Profiler.count("log.docs", len(response['hits']['hits']))
+    for (q_id, _, ids), query_hits in zip(batch, hits):
+        _report_missing(q_id, ids, query_hits)
+    return hits
+
+
+def logged_queries(es, queries_file, judgments_file, feature_set_name, index_name, batch_size=None, concurrency=1,
+                   cache_file=None, max_ids=MAX_LOG_IDS):
+    """
+    Logs the features of the judged documents of every query, see `collect_train_data` for the parameters
+    :return:                        generator of (query id, document ids, feature names, feature values, judgements)
+                                    of every query with logged documents, in the order of the queries file
+    """
+    queries = pd.read_csv(queries_file)
+    judgements = JudgementStore.from_csv(judgments_file)
+
+    requests = []
+    for q_id, keywords in zip(queries['query_id'].tolist(), queries['keywords'].tolist()):
+        ids = judgements.ids(q_id)
+        if not ids:
+            Logger.logger.info("*** Skipping query %s without judgements" % q_id)
+            continue
+        requests.append((q_id, keywords, ids))
+
+    cache = None
+    if cache_file:
+        cache = FeatureCache(cache_file, index_name, feature_set_name, feature_set_digest(es, feature_set_name))
+
+    def pending():
+        for q_id, keywords, ids in requests:
+            cached = cache.get(keywords, ids) if cache is not None else {}
+            yield q_id, keywords, ids, cached, [doc_id for doc_id in ids if doc_id not in cached]
+
+    def log_query(item):
+        q_id, keywords, _, _, missing = item
+        hits = log_features(es, q_id, keywords, missing, feature_set_name, index_name, max_ids) if missing else []
+        return item, hits
+
+    def log_batch(batch):
+        to_log = [(q_id, keywords, missing) for q_id, keywords, _, _, missing in batch if missing]
+        logged = iter(log_features_batch(es, to_log, feature_set_name, index_name, max_ids) if to_log else [])
+        return [(item, next(logged) if item[4] else []) for item in batch]
+
+    if batch_size:
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        logged_batches = ordered_map(executor, log_batch, batches(pending(), batch_size), concurrency * 2)
+        results = (result for batch_results in logged_batches for result in batch_results)
+    else:
+        executor = None
+        results = (log_query(item) for item in pending())
+
+    not_returned = 0
+    try:
+        for (q_id, keywords, ids, cached, missing), hits in results:
+            logged = {}
             for doc in hits:
-                doc_id = doc['_id']
                 log = doc['fields']['_ltrlog'][0]['log_entry']
-
-                if not header_feat:
-                    header_feat = ",".join([a["name"] for a in log])
-                    f.write("{0},{1},{2}\n".format(header_id, header_feat, header_judgement))
-
-                values = ",".join([str(a["value"]) for a in log])
-
-                judgement = judgements.loc[judgements['document_id'] == doc_id]['judgement'].iloc[0]
-
-                f.write("{0},{1},{2},{3}\n".format(q_id, doc_id, values, judgement))
+                logged[doc['_id']] = ([a["name"] for a in log], [a["value"] for a in log])
+
+            if cache is not None:
+                if missing:
+                    cache.put(keywords, missing, logged)
+                logged.update(cached)
+                doc_ids = [doc_id for doc_id in ids if logged.get(doc_id) is not None]
+            else:
+                doc_ids = [doc['_id'] for doc in hits]
+            not_returned += len(ids) - len(doc_ids)
+
+            if not doc_ids:
+                continue
+
+            yield (q_id, doc_ids, logged[doc_ids[0]][0], [logged[doc_id][1] for doc_id in doc_ids],
+                   [judgements.judgement(q_id, doc_id) for doc_id in doc_ids])
+        if not_returned:
+            Logger.logger.warning("*** %d judged documents were not returned by Elasticsearch and have no features"
+                                  % not_returned)
+    finally:
+        if executor is not None:
+            # cancels the batches that were not sent and waits for the requests in flight, which use the cache
+            logged_batches.close()
+            executor.shutdown(wait=True)
+        if cache is not None:
+            cache.report()
+            cache.close()
+
+
+@Profiler.timed("collect_train_data")
+def collect_train_data(es, queries_file, judgments_file, feature_set_name, index_name, features_file,
+                       batch_size=None, concurrency=1, value_type="float64", compression=None, cache_file=None,
+                       max_ids=MAX_LOG_IDS):
+    """ Collects the train data from Elasticsearch
+    :param batch_size:              Number of queries to log per `_msearch` request. When not set every query is
+                                    logged with a separate search request.
+    :param concurrency:             Number of `_msearch` requests kept in flight at the same time (only used
+                                    together with `batch_size`)
+    :param value_type:              Type of the stored feature values (`float32` or `float64`, Arrow files only)
+    :param compression:             Compression of the features file (`lz4` or `zstd`, Arrow files only)
+    :param cache_file:              Path of a feature cache. When set only the (keywords, document) pairs that are
+                                    not in the cache are logged from Elasticsearch and the rows of every query are
+                                    written in the order of the judgements.
+    :param max_ids:                 The most judged ids per logging search, the judged documents of a query are
+                                    split over several searches when there are more
+    """
+    with closing(logged_queries(es, queries_file, judgments_file, feature_set_name, index_name, batch_size,
+                                concurrency, cache_file, max_ids)) as rows, \
+            FeaturesWriter(features_file, value_type, compression) as writer:
+        for q_id, doc_ids, feature_names, feature_values, judged in rows:
+            with Profiler.span("write_features"):
+                writer.write(q_id, doc_ids, feature_names, feature_values, judged)
+        Profiler.count("features.rows", writer.rows)
 
 
+@Profiler.timed("train_model")
 def train_model(features_file: str, model_output: str,
                 protected_feature_name="1", gamma=1, number_of_iterations=10, learning_rate=0.001,
-                lambdaa=0.001, init_var=0.01, standardize=True, log=None):
+                lambdaa=0.001, init_var=0.01, standardize=True, log=None, engine="numpy", processes=None,
+                batch_queries=None, optimizer="gd", tolerance=None, patience=10, time_budget=None):
     """
     Trains the DELTR model with the specified parameters
     :param features_file:           The train file with features and judgements
@@ -107,11 +260,20 @@ def train_model(features_file: str, model_output: str,
     :param init_var                 range of values for initialization of weights (optional)
     :param standardize              boolean indicating whether the data should be standardized or not (optional)
     :param log                      file name where the train log should be stored (optional)
+    :param engine                   `numpy` for the vectorized `DeltrEngine` or `deltr` for the reference
+                                    `fairsearchdeltr.Deltr` implementation (optional)
+    :param processes                number of processes the `numpy` engine splits the queries over (optional)
+    :param batch_queries            number of queries sampled per step by the `numpy` engine (optional)
+    :param optimizer                `gd`, `momentum` or `adam` update of the `numpy` engine (optional)
+    :param tolerance                relative loss change under which the `numpy` engine stops early (optional)
+    :param patience                 number of iterations the loss has to stay under the tolerance (optional)
+    :param time_budget              maximum training time in seconds of the `numpy` engine (optional)
     :return:
     """
 
     Logger.logger.info("*** Reading train data ")
-    train_data = pd.read_csv(features_file)
+    with Profiler.span("read_features"):
+        train_data = read_features(features_file)
 
     # get the feature names
     feature_names = train_data.columns.tolist()[2:-1]
@@ -120,15 +282,48 @@ def train_model(features_file: str, model_output: str,
     # protected_feature = train_data.columns.tolist().index(protected_feature_name) - 2  # minus  for the query and doc id
 
     # create the Deltr object
-    dtr = Deltr(protected_feature_name, gamma, number_of_iterations, learning_rate, lambdaa, init_var, standardize)
+    dtr = create_trainer(protected_feature_name, gamma, number_of_iterations, learning_rate, lambdaa, init_var,
+                         standardize, engine, processes, batch_queries, optimizer, tolerance, patience, time_budget)
 
     Logger.logger.info("*** Training...")
-    model = dtr.train(train_data)
+    with Profiler.span("train"):
+        model = dtr.train(train_data)
+    Profiler.count("train.iterations", dtr.iterations if engine == "numpy" else number_of_iterations)
     Logger.logger.info("*** Done training")
 
+    save_trained_model(dtr, model, feature_names, model_output, protected_feature_name, standardize, log)
+
+
+def create_trainer(protected_feature_name="1", gamma=1, number_of_iterations=10, learning_rate=0.001, lambdaa=0.001,
+                   init_var=0.01, standardize=True, engine="numpy", processes=None, batch_queries=None,
+                   optimizer="gd", tolerance=None, patience=10, time_budget=None):
+    """ Creates the DELTR trainer of an engine, see `train_model` for the parameters """
+    if engine == "numpy":
+        return DeltrEngine(protected_feature_name, gamma, number_of_iterations, learning_rate, lambdaa, init_var,
+                           standardize, processes, batch_queries, optimizer, tolerance, patience, time_budget)
+    elif engine == "deltr":
+        if batch_queries or optimizer != "gd" or tolerance is not None or time_budget is not None:
+            raise ValueError("Mini-batches, optimizers and early stopping are only supported by the `numpy` engine")
+        return Deltr(protected_feature_name, gamma, number_of_iterations, learning_rate, lambdaa, init_var,
+                     standardize)
+    raise ValueError("Unknown training engine `%s`" % engine)
+
+
+def save_trained_model(dtr, model, feature_names: list, model_output: str, protected_feature_name="1",
+                       standardize=True, log=None):
+    """
+    Writes a trained model, its standardization sidecar and optionally the train log
+    :param dtr:                     the trainer (see `create_trainer`)
+    :param model:                   the trained weights, in the order of `feature_names`
+    """
+    engine = "numpy" if isinstance(dtr, DeltrEngine) else "deltr"
     Logger.logger.info("*** Saving model")
     with(open(model_output, 'w')) as f:
         json.dump(dict(zip(feature_names, model)), f)
+    mus, sigmas = (dtr.mus, dtr.sigmas) if engine == "numpy" else (getattr(dtr, '_mus', None),
+                                                                   getattr(dtr, '_sigmas', None))
+    save_standardization(model_output, protected_feature_name, mus if standardize else None,
+                         sigmas if standardize else None)
     Logger.logger.info("*** Done saving model")
 
     if log:
@@ -142,14 +337,12 @@ def train_model(features_file: str, model_output: str,
         Logger.logger.info("*** Done saving log")
 
 
-def save_model(script_name, feature_set, model_fname):
+@Profiler.timed("save_model")
+def save_model(script_name, feature_set, model_fname, url=None):
     """
     Save the DELTR model in Elasticsearch
+    :param url:                     The Elasticsearch URL, `ES_HOST` if not set
     """
-    import requests
-    import json
-    from urllib.parse import urljoin
-
     model_payload = {
         "model": {
             "name": script_name,
@@ -164,21 +357,18 @@ def save_model(script_name, feature_set, model_fname):
     with open(model_fname) as modelFile:
         model_content = modelFile.read()
         path = "_ltr/_featureset/%s/_createmodel" % feature_set
-        full_path = urljoin(ES_HOST, path)
         model_payload['model']['model']['definition'] = model_content
 
         Logger.logger.info("*** Uploading model")
-        Logger.logger.info("POST %s" % full_path)
+        Logger.logger.info("POST %s" % path)
 
-        head = {'Content-Type': 'application/json'}
-        resp = requests.post(full_path, data=json.dumps(model_payload), headers=head, auth=ES_AUTH)
+        resp = es_request('POST', path, model_payload, url=url)
 
-        Logger.logger.info(resp.status_code)
-        Logger.logger.error(resp.text)
+        Logger.logger.info("%s" % resp)
 
 
 if __name__ == "__main__":
-    es = elastic_connection(timeout=1000)
+    es = elastic_connection()
 
     # Train DELTR and store as linear regression type
     Logger.logger.info("*** Training DELTR ")
@@ -1,9 +1,19 @@
 import configparser
+import cProfile
+import functools
+import json
 import logging.config
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urljoin
 
-import elasticsearch
-from requests.auth import HTTPBasicAuth
-
+# the HTTP clients are imported by the functions that create them, so importing the configuration stays cheap for the
+# commands that do not talk to Elasticsearch
 config = configparser.ConfigParser()
 config.read('setup.cfg')
 
@@ -13,10 +23,8 @@ config_set = 'default'
 ES_HOST = config[config_set]['ESHost']
 if 'ESUser' in config[config_set]:
     auth = (config[config_set]['ESUser'], config[config_set]['ESPassword'])
-    ES_AUTH = HTTPBasicAuth(*auth)
 else:
     auth = None
-    ES_AUTH = None
 
 FEATURE_SET_NAME = config[config_set]['FeatureSetName']
 FEATURE_SET_FILE = config[config_set]['FeatureSetNameFile']
@@ -28,12 +36,229 @@ FEATURES_FILE = config[config_set]['FeaturesFile']
 MODEL_NAME = config[config_set]['ModelName']
 DOCUMENT_DIR = config[config_set]['DocumentDir']
 TRAIN_LOG_FILE = config[config_set]['TrainLogFile']
+LOG_LEVEL = config[config_set].get('LogLevel', 'INFO')
+REGISTRY_FILE = config[config_set].get('RegistryFile', 'registry.json')
+# the connection settings shared by the REST calls of the LTR plugin (`es_request`) and the search, logging and
+# indexing requests of the Elasticsearch clients (`elastic_connection`)
+# (connect, read) timeouts in seconds of the REST calls made through `es_request`
+HTTP_TIMEOUT = (float(config[config_set].get('HttpConnectTimeout', 5)),
+                float(config[config_set].get('HttpReadTimeout', 120)))
+# timeout in seconds of the search, logging and indexing requests, which can take much longer than a REST call
+SEARCH_TIMEOUT = float(config[config_set].get('SearchTimeout', 1000))
+# number of retries of a failed request, and the statuses that are retried
+HTTP_RETRIES = int(config[config_set].get('HttpRetries', 3))
+HTTP_BACKOFF_FACTOR = float(config[config_set].get('HttpBackoffFactor', 0.5))
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+def _client_options(kwargs):
+    """ the shared retry settings, for the requests of the clients: searches, `_msearch` and `_bulk` with ids """
+    kwargs.setdefault('max_retries', HTTP_RETRIES)
+    kwargs.setdefault('retry_on_status', RETRY_STATUSES)
+    return kwargs
+
+
+def elastic_connection(url=None, timeout=SEARCH_TIMEOUT, http_auth=auth, **kwargs):
+    import elasticsearch
+
+    if url is None:
+        url = ES_HOST
+    return elasticsearch.Elasticsearch(url, timeout=timeout, http_auth=http_auth, **_client_options(kwargs))
 
 
-def elastic_connection(url=None, timeout=1000, http_auth=auth):
+def async_elastic_connection(url=None, timeout=SEARCH_TIMEOUT, http_auth=auth, **kwargs):
+    """ Creates an `AsyncElasticsearch` client, which requires elasticsearch>=7.8 installed with the `async` extra """
+    try:
+        from elasticsearch import AsyncElasticsearch
+    except ImportError:
+        raise ImportError("The async client requires `pip install elasticsearch[async]>=7.8`")
     if url is None:
         url = ES_HOST
-    return elasticsearch.Elasticsearch(url, timeout=timeout, http_auth=http_auth)
+    if http_auth is not None:
+        kwargs['http_auth'] = http_auth
+    return AsyncElasticsearch(url, timeout=timeout, **_client_options(kwargs))
+
+
+class ElasticsearchHTTPError(Exception):
+    """ A non-2xx response of Elasticsearch or the LTR plugin """
+
+    def __init__(self, method, url, status_code, body):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.body = body
+        error = body.get('error') if isinstance(body, dict) else None
+        self.error_type = error.get('type') if isinstance(error, dict) else None
+        super().__init__("%s %s failed with %d: %s" % (method, url, status_code, body))
+
+
+class NotFoundError(ElasticsearchHTTPError):
+    """ The resource (index, feature set, model, ...) does not exist """
+
+
+class AlreadyExistsError(ElasticsearchHTTPError):
+    """ The resource (feature store, feature set, model, ...) already exists """
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def http_session(pool_maxsize=10, retries=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR):
+    """
+    Returns the HTTP session shared by all the REST calls of the process. The session keeps the connections to every
+    node alive in a pool and retries connection errors and 429 responses with exponential backoff, and 502/503/504
+    responses of the idempotent methods (not the POSTs that create feature sets and models).
+    The arguments are only used when the session is created by the first call.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            class _Retry(Retry):
+                """ retries any method rejected with 429, but only the idempotent ones on 502/503/504, whose
+                request may have been carried out, e.g. a POST creating a feature set or a model """
+
+                def is_retry(self, method, status_code, has_retry_after=False):
+                    return super(_Retry, self).is_retry("GET" if status_code == 429 else method, status_code,
+                                                        has_retry_after)
+
+            retry = _Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUSES,
+                           raise_on_status=False)
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=retry))
+            session.mount('https://', HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=retry))
+            session.auth = auth
+            session.headers.update({'Content-Type': 'application/json'})
+            _session = session
+    return _session
+
+
+def es_request(method: str, path: str, body=None, timeout=HTTP_TIMEOUT, url=None):
+    """
+    Calls a REST endpoint of Elasticsearch or the LTR plugin over the shared session
+    :param method:          the HTTP method
+    :param path:            the path of the endpoint, e.g. `_ltr/_featureset/name`
+    :param body:            the request body, serialized to JSON
+    :param timeout:         (connect, read) timeouts in seconds
+    :param url:             the Elasticsearch URL, `ES_HOST` if not set
+    :return:                the decoded JSON response
+    :raises NotFoundError, AlreadyExistsError, ElasticsearchHTTPError: on non-2xx responses
+    """
+    full_path = urljoin(url or ES_HOST, path)
+    data = None if body is None else json.dumps(body)
+    resp = http_session().request(method, full_path, data=data, timeout=timeout)
+    Profiler.count("http.requests")
+    Profiler.count("http.bytes_sent", len(data or ""))
+    Profiler.count("http.bytes_received", len(resp.content))
+    try:
+        content = resp.json() if resp.content else {}
+    except ValueError:
+        content = resp.text
+    if 200 <= resp.status_code < 300:
+        return content
+
+    error = ElasticsearchHTTPError(method, full_path, resp.status_code, content)
+    if resp.status_code == 404:
+        error = NotFoundError(method, full_path, resp.status_code, content)
+    elif resp.status_code == 409 or error.error_type == 'resource_already_exists_exception':
+        error = AlreadyExistsError(method, full_path, resp.status_code, content)
+    raise error
+
+
+class Param(object):
+    """ Placeholder for a parameter in a `QueryTemplate` """
+
+    def __init__(self, name):
+        self.name = name
+
+
+def _compile(node):
+    if isinstance(node, Param):
+        name = node.name
+        return lambda params: params[name]
+    if isinstance(node, dict):
+        items = [(key, _compile(value)) for key, value in node.items()]
+        return lambda params: {key: build(params) for key, build in items}
+    if isinstance(node, list):
+        builders = [_compile(value) for value in node]
+        return lambda params: [build(params) for build in builders]
+    return lambda params: node
+
+
+def placeholders(template, pattern=re.compile(r"^{{(\w+)}}$")):
+    """ Replaces the strings "{{name}}" in a template read from JSON with `Param("name")` placeholders """
+    if isinstance(template, dict):
+        return {key: placeholders(value) for key, value in template.items()}
+    if isinstance(template, list):
+        return [placeholders(value) for value in template]
+    if isinstance(template, str):
+        match = pattern.match(template)
+        if match:
+            return Param(match.group(1))
+    return template
+
+
+class QueryTemplate(object):
+    """
+    A request body with `Param` placeholders. The template is compiled once into builder functions, so rendering
+    only fills in the parameters and returns a new body that the caller may change. The template itself is never
+    modified, which makes it safe to render from several threads or asyncio tasks.
+    """
+
+    def __init__(self, template: dict):
+        self._build = _compile(template)
+
+    def render(self, **params):
+        """
+        :param params:          the values of the placeholders
+        :return:                a new request body
+        """
+        return self._build(params)
+
+
+class LazyJson(object):
+    """ Serializes a request body to JSON only when a log record is actually emitted """
+
+    def __init__(self, body, indent=None):
+        self._body = body
+        self._indent = indent
+
+    def __str__(self):
+        return json.dumps(self._body, indent=self._indent)
+
+
+def ordered_map(executor, fn, items, window):
+    """
+    Like `executor.map`, but keeps at most `window` calls in flight and yields the results in input order. The calls
+    that did not start yet are cancelled when a call fails or the generator is closed.
+    """
+    pending = deque()
+    try:
+        for item in items:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def batches(items, batch_size):
+    """ splits the items in lists of `batch_size` items """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 # logging related
@@ -52,7 +277,7 @@ class Logger:
     def __init__(self):
         # logging.config.fileConfig('logging.conf')
         self.logger = logging.getLogger('__name__')
-        self.logger.setLevel(logging.DEBUG)
+        self.logger.setLevel(LOG_LEVEL)
 
         # create console handler and set level to debug
         ch = logging.StreamHandler()
@@ -62,3 +287,123 @@ class Logger:
         ch.setFormatter(formatter)
 
         self.logger.addHandler(ch)
+
+
+# instrumentation related
+@singleton
+class Profiler:
+    """
+    Process-wide timers and counters of the pipeline stages. A span times a named stage and a counter adds up the
+    requests, bytes, documents or iterations of a stage. When a cProfile directory is set, the outermost span of
+    every thread is also profiled and dumped to `<directory>/<span>.<n>.prof`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.timers = {}
+        self.samples = {}
+        self.counters = {}
+        self.cprofile_dir = None
+        self.reservoir = 10000
+        self._random = random.Random(0)
+        self._dumps = 0
+
+    def count(self, name: str, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def span(self, name: str):
+        """ times the enclosed block under `name` """
+        profile = None
+        if self.cprofile_dir is not None and not getattr(self._local, 'profiling', False):
+            profile = cProfile.Profile()
+            self._local.profiling = True
+            profile.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+                self._local.profiling = False
+            with self._lock:
+                count, total, longest = self.timers.get(name, (0, 0.0, 0.0))
+                self.timers[name] = (count + 1, total + elapsed, max(longest, elapsed))
+                # a uniform sample of the durations for the percentiles
+                samples = self.samples.setdefault(name, [])
+                if len(samples) < self.reservoir:
+                    samples.append(elapsed)
+                else:
+                    slot = self._random.randrange(count + 1)
+                    if slot < self.reservoir:
+                        samples[slot] = elapsed
+                if profile is not None:
+                    self._dumps += 1
+                    dump = os.path.join(self.cprofile_dir, "%s.%d.prof" % (name, self._dumps))
+            if profile is not None:
+                profile.dump_stats(dump)
+
+    def timed(self, name: str):
+        """ decorator that times every call of a function under `name` """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def percentiles(self, name: str, quantiles=(50, 95, 99)):
+        """ returns the percentiles of the durations of a span in seconds, estimated from a sample """
+        with self._lock:
+            samples = sorted(self.samples.get(name, []))
+        if not samples:
+            return {}
+        return {q: samples[min(len(samples) - 1, int(round(q / 100.0 * (len(samples) - 1))))] for q in quantiles}
+
+    def reset(self):
+        with self._lock:
+            self.timers, self.samples, self.counters = {}, {}, {}
+
+    def report(self):
+        """ returns the timers and the counters as a dict """
+        with self._lock:
+            names = sorted(self.timers)
+        spans = {}
+        for name in names:
+            count, total, longest = self.timers[name]
+            spans[name] = {"count": count, "seconds": total, "max_seconds": longest}
+            spans[name].update({"p%d_seconds" % q: value for q, value in self.percentiles(name).items()})
+        with self._lock:
+            return {"spans": spans, "counters": dict(sorted(self.counters.items()))}
+
+    def prometheus(self):
+        """ returns the timers and the counters in the Prometheus text format """
+        report = self.report()
+        lines = ["# TYPE deltr_span_seconds summary"]
+        for name, span in report["spans"].items():
+            lines.append('deltr_span_seconds_count{span="%s"} %d' % (name, span["count"]))
+            lines.append('deltr_span_seconds_sum{span="%s"} %f' % (name, span["seconds"]))
+            for key, value in span.items():
+                if key.startswith("p") and key.endswith("_seconds"):
+                    lines.append('deltr_span_seconds{span="%s",quantile="%s"} %f'
+                                 % (name, int(key[1:-len("_seconds")]) / 100.0, value))
+        lines.append("# TYPE deltr_span_max_seconds gauge")
+        for name, span in report["spans"].items():
+            lines.append('deltr_span_max_seconds{span="%s"} %f' % (name, span["max_seconds"]))
+        lines.append("# TYPE deltr_total counter")
+        for name, value in report["counters"].items():
+            lines.append('deltr_total{name="%s"} %s' % (name, value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, report_file: str):
+        """ writes the report as JSON for a `.json` file, in the Prometheus text format otherwise """
+        with open(report_file, 'w') as f:
+            if report_file.endswith(".json"):
+                json.dump(self.report(), f, indent=2)
+            else:
+                f.write(self.prometheus())
+        Logger.logger.info("*** Wrote the profile to %s" % report_file)